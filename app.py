@@ -1,12 +1,41 @@
 from getpass import getpass
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import argparse
+import copy
+from email.mime.base import MIMEBase
+from email.policy import compat32
+import array
+import asyncio
+import base64
+import bisect
+import collections
+import csv
+import fractions
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import mimetypes
+import mmap
+import multiprocessing
 import os
 import pathlib
+import pickle
+import queue
 import random
+import re
+import shutil
 import smtplib
+import socket
+import socketserver
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
 import time
+import types
+import typing
 from colorama import init as colorama_init
 from colorama import Fore
 from colorama import Style
@@ -20,6 +49,7 @@ import tomli
 if os.name == 'nt': # Windows
   import msvcrt
 else:
+  import resource
   import tty
   import termios
 
@@ -74,17 +104,26 @@ def display_menu(options, selected_index, written=False):
 
 # === File Handling ===
 
-# Gets the settings.toml data
-def get_toml_data():
-  path = pathlib.Path(__file__).parent / "settings.toml"
-  settings_file = path.open(mode="rb")
-  settings_toml = tomli.load(settings_file)
-  settings_file.close()
-  return settings_toml
+SETTINGS_PATH = pathlib.Path(__file__).parent / "settings.toml"
+
+# Parsed settings files, keyed by path and only re-parsed when the file changes on disk
+toml_cache = {}
+
+# Gets the settings.toml data (a fresh copy callers are free to edit)
+def get_toml_data(path=SETTINGS_PATH):
+  path = pathlib.Path(path).resolve()
+  stat = path.stat()
+  cached = toml_cache.get(path)
+  if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+    settings_file = path.open(mode="rb")
+    cached = ((stat.st_mtime_ns, stat.st_size), tomli.load(settings_file))
+    settings_file.close()
+    toml_cache[path] = cached
+  return copy.deepcopy(cached[1])
 
 # Checks if the important values are empty
-def is_toml_empty():
-  settings_toml = get_toml_data()
+def is_toml_empty(settings_toml=None):
+  settings_toml = settings_toml or get_toml_data()
   if str(settings_toml["smtp"]["username"]).strip() == "": return True
   if str(settings_toml["smtp"]["passkey"]).strip() == "": return True
   if str(settings_toml["smtp"]["smtp_server"]).strip() == "": return True
@@ -100,10 +139,2701 @@ def is_toml_empty():
 
 # Save data to settings.toml file
 def save_to_toml(toml_data):
-  path = pathlib.Path(__file__).parent / "settings.toml"
-  settings_file = path.open(mode="wb")
+  settings_file = SETTINGS_PATH.open(mode="wb")
   tomli_w.dump(toml_data, settings_file)
   settings_file.close()
+  toml_cache.pop(SETTINGS_PATH.resolve(), None)
+
+# === Campaign Config ===
+
+# Read-only view of the settings a campaign needs, with its lookups worked out once up front
+class CampaignConfig(typing.NamedTuple):
+  smtp: typing.Mapping
+  accounts: typing.Mapping
+  domains: typing.Mapping
+  ids: tuple
+  subjects: tuple
+  writeups: tuple
+  titles: tuple
+  placeholders: tuple
+  output_folder: str
+  segregate_by_writeups: bool
+  segregate_by_ids: bool
+  journal: bool
+  dedupe: bool
+  suppression: str
+  email_placeholder: int
+  writeup_index: typing.Mapping
+  id_index: typing.Mapping
+  writeup_names: tuple
+  id_names: tuple
+  metrics: typing.Mapping
+  dry_run: typing.Mapping
+  writeup_weights: tuple
+  id_weights: tuple
+  seed: int
+  stratify: str
+  attachments: tuple
+
+  # Pickles the read-only mappings (which pickle can't handle itself) as PickledMappings, so configs can be handed to
+  # shard worker processes
+  def __reduce__(self):
+    return (unpickle_campaign_config, (tuple(thaw_mappings(value) for value in self),))
+
+# Stands in for one of a CampaignConfig's read-only mappings while it is pickled
+class PickledMapping(dict):
+  pass
+
+# Swaps read-only mappings, and the ones nested in them, for PickledMappings
+def thaw_mappings(value):
+  if isinstance(value, types.MappingProxyType):
+    return PickledMapping({key: thaw_mappings(item) for key, item in value.items()})
+  return value
+
+# Turns PickledMappings back into read-only mappings
+def freeze_mappings(value):
+  if isinstance(value, PickledMapping):
+    return types.MappingProxyType({key: freeze_mappings(item) for key, item in value.items()})
+  return value
+
+# Rebuilds a pickled CampaignConfig
+def unpickle_campaign_config(values):
+  return CampaignConfig(*(freeze_mappings(value) for value in values))
+
+# The output-*.csv files every campaign may write, whose names segregated write-up and sender ID outputs must not take
+RESERVED_OUTPUTS = ("failed", "filtered", "rejected")
+
+# Raises ValueError if a segregated write-up or sender ID output would land in the same output-*.csv file as another write-up,
+# sender ID or built-in output (names compared ignoring case, as Windows and macOS file systems do)
+def check_output_names(writeups, writeup_names, ids, id_names, segregate_by_writeups, segregate_by_ids):
+  owners = {name: f"the built-in output-{name}.csv" for name in RESERVED_OUTPUTS}
+  segregated = ([("write-up", writeup, name) for writeup, name in zip(writeups, writeup_names)] if segregate_by_writeups else []) + ([("sender ID", sending_email, name) for sending_email, name in zip(ids, id_names)] if segregate_by_ids else [])
+  for kind, source, name in segregated:
+    owner = owners.setdefault(name.lower(), f"{kind} {source}")
+    if owner != f"{kind} {source}":
+      raise ValueError(f"The {kind} {source} would write to output-{name}.csv, the same file as {owner}. Rename it or turn off that segregation.")
+
+# Builds a CampaignConfig from parsed settings.toml data
+def campaign_config(settings_toml):
+  freeze = types.MappingProxyType
+  ids = tuple(settings_toml["emails"]["ids"])
+  for sending_email in ids:
+    if EMAIL_PATTERN.fullmatch(sending_email) is None:
+      raise ValueError(f"The sender ID {sending_email} is not a valid email address (only ASCII addresses are supported).")
+  writeups = tuple(settings_toml["emails"]["writeups"])
+  placeholders = tuple(settings_toml["csv"]["placeholders"])
+  writeup_names = tuple(os.path.splitext(os.path.basename(writeup))[0] for writeup in writeups)
+  id_names = tuple(sending_email.split("@")[0] for sending_email in ids)
+  check_output_names(writeups, writeup_names, ids, id_names, bool(settings_toml["csv"]["segregate_by_writeups"]), bool(settings_toml["csv"]["segregate_by_ids"]))
+  return CampaignConfig(
+    smtp=freeze(dict(settings_toml["smtp"])),
+    accounts=freeze({sending_email: freeze(dict(account)) for sending_email, account in settings_toml.get("accounts", {}).items()}),
+    domains=freeze({domain.lower(): freeze(dict(entry)) for domain, entry in settings_toml.get("domains", {}).items()}),
+    ids=ids,
+    subjects=tuple(settings_toml["emails"]["subjects"]),
+    writeups=writeups,
+    titles=tuple(settings_toml["csv"]["titles"]),
+    placeholders=placeholders,
+    output_folder=settings_toml["csv"]["output_folder"],
+    segregate_by_writeups=bool(settings_toml["csv"]["segregate_by_writeups"]),
+    segregate_by_ids=bool(settings_toml["csv"]["segregate_by_ids"]),
+    journal=bool(settings_toml["csv"].get("journal", True)),
+    dedupe=bool(settings_toml["csv"].get("dedupe", True)),
+    suppression=str(settings_toml["csv"].get("suppression", "")).strip(),
+    email_placeholder=placeholders.index("email"),
+    writeup_index=freeze({writeup: i for i, writeup in reversed(list(enumerate(writeups)))}),
+    id_index=freeze({sending_email: i for i, sending_email in reversed(list(enumerate(ids)))}),
+    writeup_names=writeup_names,
+    id_names=id_names,
+    metrics=freeze(dict(settings_toml.get("metrics", {}))),
+    dry_run=freeze(dict(settings_toml.get("dry_run", {}))),
+    writeup_weights=tuple(settings_toml["emails"].get("writeup_weights", [])),
+    id_weights=tuple(settings_toml["emails"].get("id_weights", [])),
+    seed=int(settings_toml["emails"].get("seed", 0)),
+    stratify=str(settings_toml["emails"].get("stratify", "")).strip(),
+    attachments=tuple(tuple(paths) for paths in settings_toml["emails"].get("attachments", [])),
+  )
+
+# Campaign configs, keyed by path and rebuilt only when the settings file changes
+config_cache = {}
+
+# Loads the CampaignConfig for a settings file, reusing the cached one while the file is unchanged
+def load_campaign_config(path=SETTINGS_PATH):
+  path = pathlib.Path(path).resolve()
+  stat = path.stat()
+  cached = config_cache.get(path)
+  if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+    cached = ((stat.st_mtime_ns, stat.st_size), campaign_config(get_toml_data(path)))
+    config_cache[path] = cached
+  return cached[1]
+
+# Returns a copy of a CampaignConfig with some [smtp] values overridden
+def override_smtp(config, **smtp_settings):
+  return config._replace(smtp=types.MappingProxyType({**config.smtp, **smtp_settings}))
+
+# Returns a copy of a CampaignConfig with some [metrics] values overridden
+def override_metrics(config, **metrics_settings):
+  return config._replace(metrics=types.MappingProxyType({**config.metrics, **metrics_settings}))
+
+# Returns a copy of a CampaignConfig with some [dry_run] values overridden
+def override_dry_run(config, **dry_run_settings):
+  return config._replace(dry_run=types.MappingProxyType({**config.dry_run, **dry_run_settings}))
+
+# === Contacts CSV ===
+
+# Opens a contacts file as text, decompressing .gz files on the fly
+def open_contacts(contacts_csv):
+  if contacts_csv.endswith(".gz"):
+    return gzip.open(contacts_csv, mode='rt', encoding='utf-8', newline='')
+  return open(contacts_csv, mode='r', encoding='utf-8', newline='')
+
+# Names a contacts file's journal, validation report and metrics summary: the file name without its .gz/.csv extensions,
+# then a hash of its absolute path, so leads.2024-05.csv and leads.csv.gz (or two leads.csv in different folders) never share one
+def contacts_name(contacts_csv):
+  stem = os.path.basename(contacts_csv)
+  for extension in (".gz", ".csv"):
+    if stem.endswith(extension): stem = stem[:-len(extension)]
+  return stem + "-" + hashlib.sha1(os.path.abspath(contacts_csv).encode("utf-8")).hexdigest()[:8]
+
+# Decoded lines of a binary contacts file from byte offset position[0] up to end, advancing position[0] past each line read
+def contact_lines(contacts_file, position, end=None):
+  contacts_file.seek(position[0])
+  while end is None or position[0] < end:
+    line = contacts_file.readline()
+    if not line: break
+    position[0] += len(line)
+    yield line.decode("utf-8")
+
+# Yields the header row and then every contact row, one at a time. Given a byte range or a position list (uncompressed files only),
+# yields just the records in [start, end) and keeps position[0] at the offset just past the last record read
+def read_contacts(contacts_csv, start=None, end=None, position=None):
+  if start is None and position is None:
+    contacts_file = open_contacts(contacts_csv)
+    try:
+      for contact_details in csv.reader(contacts_file):
+        if contact_details: yield contact_details
+    finally:
+      contacts_file.close()
+    return
+  position = position if position is not None else [0]
+  contacts_file = open(contacts_csv, mode='rb')
+  try:
+    position[0] = 0
+    yield next(csv.reader(contact_lines(contacts_file, position)), [])
+    if start is not None: position[0] = start
+    for contact_details in csv.reader(contact_lines(contacts_file, position, end)):
+      if contact_details: yield contact_details
+  finally:
+    contacts_file.close()
+
+# === Contact Filtering ===
+
+# Canonical form of an address for duplicate, suppression and journal lookups
+def normalise_email(contact_email):
+  return contact_email.strip().lower()
+
+# 64-bit fingerprint of a normalised address, so millions of them fit in a few dozen MB
+def email_fingerprint(contact_email):
+  return int.from_bytes(hashlib.blake2b(contact_email.encode("utf-8"), digest_size=8).digest(), "little")
+
+# Unsubscribed/bounced addresses, kept as a sorted array of fingerprints and searched by bisection
+class SuppressionList:
+  def __init__(self, fingerprints=None):
+    self.fingerprints = fingerprints if fingerprints is not None else array.array("Q")
+
+  def __len__(self):
+    return len(self.fingerprints)
+
+  def __contains__(self, fingerprint):
+    i = bisect.bisect_left(self.fingerprints, fingerprint)
+    return i < len(self.fingerprints) and self.fingerprints[i] == fingerprint
+
+# Fingerprints of the addresses seen so far, for duplicate checks: an open-addressing table of 64-bit slots with linear probing,
+# kept between a third and two thirds full, so each address costs 12-24 bytes instead of a Python set's ~80. 0 marks a free slot,
+# so a fingerprint of 0 is stored as 1
+class FingerprintSet:
+  def __init__(self, capacity=1024):
+    self.slots = array.array("Q", bytes(8 * capacity))
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    return (fingerprint for fingerprint in self.slots if fingerprint)
+
+  # Index of the slot in slots holding fingerprint, or of the free slot where it belongs
+  @staticmethod
+  def find(slots, fingerprint):
+    mask = len(slots) - 1
+    i = fingerprint & mask
+    while True:
+      current = slots[i]
+      if current == 0 or current == fingerprint: return i
+      i = (i + 1) & mask
+
+  def __contains__(self, fingerprint):
+    return self.slots[self.find(self.slots, fingerprint or 1)] != 0
+
+  # Adds a fingerprint, returning whether it was new
+  def add(self, fingerprint):
+    fingerprint = fingerprint or 1
+    slots = self.slots
+    i = self.find(slots, fingerprint)
+    if slots[i]: return False
+    slots[i] = fingerprint
+    self.count += 1
+    if self.count * 3 >= len(slots) * 2:
+      self.slots = array.array("Q", bytes(16 * len(slots)))
+      for fingerprint in slots:
+        if fingerprint: self.slots[self.find(self.slots, fingerprint)] = fingerprint
+    return True
+
+  def update(self, fingerprints):
+    for fingerprint in fingerprints:
+      self.add(fingerprint)
+
+# Loads a suppression file (.txt/.csv/.gz, the address in the first column), reusing its .idx sidecar while the file is unchanged.
+# The sidecar's header holds the file's mtime and size and the number of fingerprints; one that doesn't match (or was cut short)
+# is rebuilt, so a partial index can never let suppressed addresses through
+def load_suppression_list(path):
+  stat = os.stat(path)
+  index_path = path + ".idx"
+  signature = array.array("q", [stat.st_mtime_ns, stat.st_size])
+  try:
+    index_file = open(index_path, mode='rb')
+    try:
+      header = array.array("q")
+      header.fromfile(index_file, 3)
+      if header[:2] == signature and header[2] >= 0:
+        fingerprints = array.array("Q")
+        fingerprints.fromfile(index_file, header[2])
+        if not index_file.read(1):
+          return SuppressionList(fingerprints)
+    finally:
+      index_file.close()
+  except (OSError, EOFError, ValueError):
+    pass
+  suppression_file = open_contacts(path)
+  try:
+    fingerprints = array.array("Q", sorted({email_fingerprint(normalise_email(row[0])) for row in csv.reader(suppression_file) if row and "@" in row[0]}))
+  finally:
+    suppression_file.close()
+  # Written to a temporary file and renamed over the old sidecar, so an interrupted write leaves no half-written index behind
+  try:
+    index_file = open(index_path + ".tmp", mode='wb')
+    try:
+      (signature + array.array("q", [len(fingerprints)])).tofile(index_file)
+      fingerprints.tofile(index_file)
+    finally:
+      index_file.close()
+    os.replace(index_path + ".tmp", index_path)
+  except OSError:
+    pass
+  return SuppressionList(fingerprints)
+
+# === Contact Validation ===
+
+# Practical address syntax: a dot-separated ASCII local part, then domain labels ending in a letters-only (or punycode) TLD.
+# Non-ASCII addresses are rejected too: sending to them needs SMTPUTF8, which most servers don't offer and this program doesn't use
+EMAIL_PATTERN = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*@(?:[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?\.)+(?:[A-Za-z]{2,}|xn--[A-Za-z0-9-]+)")
+
+# Why a contact row can't be sent (wrong number of columns, missing or malformed address), or None if it looks fine
+def contact_problem(contact_details, columns, email_column):
+  if len(contact_details) != columns: return "column count"
+  contact_email = contact_details[email_column].strip()
+  if not contact_email: return "missing email"
+  if EMAIL_PATTERN.fullmatch(contact_email) is None: return "invalid email"
+  return None
+
+# Scans a whole contacts file before anything is sent, checking its header against [csv].titles and every row's columns and address;
+# with an output_folder, bad rows go to output-rejected.csv and the report to validation-<contacts>.json. With a ShardPlan
+# the same scan also splits the file into shards, and with an AssignmentPlan it picks every contact's write-up and sender ID
+def validate_contacts(contacts_csv, config, output_folder=None, plan=None, assignment=None):
+  started = time.perf_counter()
+  position = [0] if plan is not None else None
+  contacts = read_contacts(contacts_csv, position=position)
+  contacts_headers = next(contacts, [])
+  email_title = config.titles[config.email_placeholder] if config.email_placeholder < len(config.titles) else None
+  report = {
+    "contacts_csv": contacts_csv,
+    "rows": 0,
+    "valid": 0,
+    "rejected": 0,
+    "reasons": {},
+    "missing_titles": [title for title in config.titles if title not in contacts_headers],
+    "error": None,
+  }
+  if email_title not in contacts_headers:
+    contacts.close()
+    report["error"] = f"The contacts file has no \"{email_title}\" column for the {{email}} placeholder." if email_title else "[csv].titles has no title for the {email} placeholder."
+    return report
+
+  columns = len(contacts_headers)
+  email_column = contacts_headers.index(email_title)
+  if assignment is not None:
+    try:
+      assignment.begin(contacts_headers, email_column)
+    except ValueError as error:
+      contacts.close()
+      report["error"] = str(error)
+      return report
+  rejected_outputs = None
+  if output_folder is not None:
+    rejected_outputs = OutputWriters(output_folder, ["rejected"], contacts_headers + ["Reject Reason"])
+  reasons = report["reasons"]
+  rows = 0
+  if plan is not None: plan.begin(position[0])
+  try:
+    for contact_details in contacts:
+      rows += 1
+      problem = contact_problem(contact_details, columns, email_column)
+      if plan is not None: plan.add(position[0], contact_details[email_column] if problem is None else None)
+      if assignment is not None: assignment.add(contact_details if problem is None else None)
+      if problem is None: continue
+      reasons[problem] = reasons.get(problem, 0) + 1
+      if rejected_outputs is not None: rejected_outputs.write(0, contact_details + [problem])
+  finally:
+    if rejected_outputs is not None: rejected_outputs.close()
+  if plan is not None: plan.end(position[0])
+  if assignment is not None: assignment.end()
+  report["rows"] = rows
+  report["rejected"] = sum(reasons.values())
+  report["valid"] = rows - report["rejected"]
+  report["seconds"] = round(time.perf_counter() - started, 3)
+  if assignment is not None: report["plan"] = assignment.preview()
+
+  if output_folder is not None:
+    report_name = "validation-" + contacts_name(contacts_csv) + ".json"
+    report_file = open(os.path.join(output_folder, report_name), mode='w', encoding='utf-8')
+    json.dump(report, report_file, indent=2)
+    report_file.close()
+  return report
+
+# === Assignment Plan ===
+
+# Marks the rows that failed validation, which get no write-up or sender ID, in an AssignmentPlan's index arrays
+UNASSIGNED = 0xFFFF
+
+# The smallest whole numbers in the same ratios as a list of [emails] weights, or equal weights if the list is empty
+def integer_weights(weights, count, setting):
+  if not weights: return [1] * count
+  if len(weights) != count:
+    raise ValueError(f"[emails].{setting} has {len(weights)} weights for {count} entries.")
+  try:
+    ratios = [fractions.Fraction(str(weight)).limit_denominator(1000) for weight in weights]
+  except (ValueError, ZeroDivisionError):
+    raise ValueError(f"[emails].{setting} must be a list of numbers.")
+  if min(ratios) < 0 or sum(ratios) == 0:
+    raise ValueError(f"[emails].{setting} must not be negative or all zero.")
+  scale = math.lcm(*(ratio.denominator for ratio in ratios))
+  whole = [int(ratio * scale) for ratio in ratios]
+  divisor = math.gcd(*whole)
+  return [weight // divisor for weight in whole]
+
+# Picks the write-up and sender ID of every contact up front, during validate_contacts' scan. Each stratum (recipient domain or
+# value of a contacts column, per [emails].stratify) works through its own blocks holding every index in the ratio of its weights,
+# each block a random permutation from a seeded pool, so the split stays balanced within each stratum and at any point in the file
+class AssignmentPlan:
+  def __init__(self, config):
+    self.writeup_weights = integer_weights(config.writeup_weights, len(config.writeups), "writeup_weights")
+    self.id_weights = integer_weights(config.id_weights, len(config.ids), "id_weights")
+    self.writeup_paths = config.writeups
+    self.sender_ids = config.ids
+    self.seed = config.seed or random.SystemRandom().randrange(1, 1 << 32)
+    self.stratify = config.stratify
+    self.random = random.Random(self.seed)
+    self.writeup_blocks = self.permutations(self.writeup_weights)
+    self.id_blocks = self.permutations(self.id_weights)
+    self.stratum_column = None
+    self.stratum_domain = False
+    self.strata = {}
+    self.strata_count = 0
+    self.writeups = array.array("H")
+    self.ids = array.array("H")
+    self.split = [[0] * len(self.id_weights) for _ in self.writeup_weights]
+
+  # A pool of random orderings of one block (up to 1024 of them, fewer for large blocks)
+  def permutations(self, weights):
+    block = [i for i, weight in enumerate(weights) for _ in range(weight)]
+    blocks = []
+    for _ in range(max(min(1024, 65536 // len(block)), 16)):
+      self.random.shuffle(block)
+      blocks.append(tuple(block))
+    return blocks
+
+  # Finds the column each row's stratum comes from (a contacts column of that title takes precedence over "domain")
+  def begin(self, contacts_headers, email_column):
+    if not self.stratify: return
+    if self.stratify in contacts_headers:
+      self.stratum_column = contacts_headers.index(self.stratify)
+    elif self.stratify == "domain":
+      self.stratum_column = email_column
+      self.stratum_domain = True
+    else:
+      raise ValueError(f"The contacts file has no \"{self.stratify}\" column for [emails].stratify.")
+
+  # Assigns the next row of the file (contact_details is None for rows that failed validation)
+  def add(self, contact_details=None):
+    if contact_details is None:
+      self.writeups.append(UNASSIGNED)
+      self.ids.append(UNASSIGNED)
+      return
+    stratum = None
+    if self.stratum_column is not None:
+      stratum = contact_details[self.stratum_column].strip().lower()
+      if self.stratum_domain: stratum = stratum.rpartition("@")[2]
+    blocks = self.strata.get(stratum)
+    if blocks is None:
+      blocks = self.strata[stratum] = [iter(()), iter(())]
+    email_writeup_index = next(blocks[0], None)
+    if email_writeup_index is None:
+      blocks[0] = iter(self.writeup_blocks[int(self.random.random() * len(self.writeup_blocks))])
+      email_writeup_index = next(blocks[0])
+    sending_email_index = next(blocks[1], None)
+    if sending_email_index is None:
+      blocks[1] = iter(self.id_blocks[int(self.random.random() * len(self.id_blocks))])
+      sending_email_index = next(blocks[1])
+    self.writeups.append(email_writeup_index)
+    self.ids.append(sending_email_index)
+    self.split[email_writeup_index][sending_email_index] += 1
+
+  # Drops the per-stratum blocks once the scan is over, keeping just the index arrays
+  def end(self):
+    self.strata_count = len(self.strata)
+    self.strata = {}
+
+  # How many contacts each write-up and sender ID got, for checking the split before sending
+  def preview(self):
+    return {
+      "seed": self.seed,
+      "stratify": self.stratify or None,
+      "strata": self.strata_count,
+      "writeups": [{"writeup": writeup, "weight": self.writeup_weights[i], "contacts": sum(self.split[i])} for i, writeup in enumerate(self.writeup_paths)],
+      "ids": [{"id": sending_email, "weight": self.id_weights[i], "contacts": sum(row[i] for row in self.split)} for i, sending_email in enumerate(self.sender_ids)],
+      "split": self.split,
+    }
+
+# === Output CSVs ===
+
+# Segregated output-*.csv files written through buffered csv writers, flushed every few thousand rows or seconds
+class OutputWriters:
+  def __init__(self, output_folder, names, contacts_headers, append=False, flush_rows=5000, flush_seconds=2.0):
+    self.flush_rows = flush_rows
+    self.flush_seconds = flush_seconds
+    self.pending = 0
+    self.flushed_at = time.monotonic()
+    self.files = []
+    self.writers = []
+    for name in names:
+      output_file = open(os.path.join(output_folder, "output-" + name + ".csv"), mode='a' if append else 'w', encoding='utf-8', newline='', buffering=1 << 16)
+      writer = csv.writer(output_file)
+      if output_file.tell() == 0: writer.writerow(contacts_headers)
+      self.files.append(output_file)
+      self.writers.append(writer)
+
+  # Appends a contact row to the i-th output file
+  def write(self, i, contact_details):
+    self.writers[i].writerow(contact_details)
+    self.pending += 1
+    if self.pending >= self.flush_rows or time.monotonic() - self.flushed_at >= self.flush_seconds:
+      self.flush()
+
+  def flush(self):
+    for output_file in self.files:
+      output_file.flush()
+    self.pending = 0
+    self.flushed_at = time.monotonic()
+
+  def close(self):
+    for output_file in self.files:
+      output_file.close()
+
+# === Send Journal ===
+
+# Durable SQLite (WAL) record of every recipient's send status, committed in batches
+class SendJournal:
+  def __init__(self, path, resume=False, batch_size=1000, batch_seconds=2.0):
+    self.lock = threading.Lock()
+    self.batch_size = batch_size
+    self.batch_seconds = batch_seconds
+    self.pending = []
+    self.committed_at = time.monotonic()
+    self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS sends (email TEXT PRIMARY KEY, status TEXT NOT NULL, writeup TEXT, sender TEXT, updated_at REAL NOT NULL) WITHOUT ROWID")
+    if not resume:
+      self.connection.execute("DELETE FROM sends")
+    self.connection.commit()
+
+  # Records a recipient's status, writing the batch in one short transaction once it is full or old enough
+  # (so shard processes sharing the journal only hold its write lock briefly)
+  def record(self, contact_email, status, writeup=None, sender=None):
+    with self.lock:
+      self.pending.append((normalise_email(contact_email), status, writeup, sender, time.time()))
+      if len(self.pending) >= self.batch_size or time.monotonic() - self.committed_at >= self.batch_seconds:
+        self.commit()
+
+  # Whether a previous run already delivered to this address (primary key lookup)
+  def is_sent(self, contact_email):
+    with self.lock:
+      return self.connection.execute("SELECT 1 FROM sends WHERE email = ? AND status = 'sent'", (normalise_email(contact_email),)).fetchone() is not None
+
+  # Messages each sender ID has sent since local midnight, to carry daily caps across restarts
+  def sent_today(self):
+    midnight = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+    with self.lock:
+      return dict(self.connection.execute("SELECT sender, COUNT(*) FROM sends WHERE status = 'sent' AND updated_at >= ? GROUP BY sender", (midnight,)).fetchall())
+
+  def commit(self):
+    if self.pending:
+      self.connection.executemany("INSERT OR REPLACE INTO sends VALUES (?, ?, ?, ?, ?)", self.pending)
+    self.connection.commit()
+    self.pending = []
+    self.committed_at = time.monotonic()
+
+  def close(self):
+    with self.lock:
+      self.commit()
+      self.connection.close()
+
+# === Write-up Templates ===
+
+# Compiled write-ups, keyed by path and the placeholder mapping they were bound to
+writeup_cache = {}
+
+# Parses a write-up into literal segments and CSV column slots, re-parsing only when the file changes
+def compile_writeup(path, placeholders, placeholder_index):
+  mtime = os.stat(path).st_mtime_ns
+  key = (path, tuple(placeholders), tuple(placeholder_index))
+  cached = writeup_cache.get(key)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+  writeup_file = open(path, mode='r', encoding='utf-8')
+  text = writeup_file.read()
+  writeup_file.close()
+  columns = {}
+  for i, placehold in enumerate(placeholder_index):
+    if placehold == -1: continue
+    columns.setdefault("{" + placeholders[i] + "}", placehold)
+  literals = []
+  slots = []
+  position = 0
+  if columns:
+    for match in re.finditer("|".join(re.escape(token) for token in columns), text):
+      literals.append(text[position:match.start()])
+      slots.append(columns[match.group()])
+      position = match.end()
+  literals.append(text[position:])
+  template = (tuple(literals), tuple(slots))
+  writeup_cache[key] = (mtime, template)
+  return template
+
+# Fills a compiled write-up with a contact's CSV values in a single join
+def render_writeup(template, contact_details):
+  literals, slots = template
+  if not slots:
+    return literals[0]
+  parts = [None] * (len(literals) + len(slots))
+  parts[0::2] = literals
+  parts[1::2] = [contact_details[slot] for slot in slots]
+  return "".join(parts)
+
+# === Attachments ===
+
+# A file encoded once for sending: its filename, MIME type and base64 body (CRLF lines), shared by every message carrying it
+class Attachment(typing.NamedTuple):
+  filename: str
+  content_type: str
+  encoded: bytes
+
+# Encoded attachments, keyed by path and re-encoded only when the file changes
+attachment_cache = {}
+
+# Memory-maps a file and base64-encodes it straight from the mapping, reusing the cached encoding while the file is unchanged
+def load_attachment(path):
+  stat = os.stat(path)
+  cached = attachment_cache.get(path)
+  if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+    return cached[1]
+  encoded = b""
+  if stat.st_size:
+    with open(path, mode='rb') as attachment_file, mmap.mmap(attachment_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+      encoded = base64.b64encode(mapped)
+    encoded = b"\r\n".join([encoded[i:i + 76] for i in range(0, len(encoded), 76)])
+  attachment = Attachment(os.path.basename(path), mimetypes.guess_type(path)[0] or "application/octet-stream", encoded)
+  attachment_cache[path] = ((stat.st_mtime_ns, stat.st_size), attachment)
+  return attachment
+
+# Loads what goes into each write-up's messages as (text subtype, attachments, inline images). Write-ups ending in .html are
+# sent as HTML, and any of their [emails].attachments they reference as "cid:<filename>" are sent inline instead
+def writeup_parts(config):
+  parts = []
+  for i, writeup in enumerate(config.writeups):
+    attachments = tuple(load_attachment(path) for path in (config.attachments[i] if i < len(config.attachments) else ()))
+    if os.path.splitext(writeup)[1].lower() not in (".html", ".htm"):
+      parts.append(("plain", attachments, ()))
+      continue
+    writeup_file = open(writeup, mode='r', encoding='utf-8')
+    text = writeup_file.read()
+    writeup_file.close()
+    inline = tuple(attachment for attachment in attachments if "cid:" + attachment.filename in text)
+    parts.append(("html", tuple(attachment for attachment in attachments if attachment not in inline), inline))
+  return parts
+
+# === Message Factory ===
+
+# A message held as byte chunks, so the encoded attachments inside it are the shared Attachment bytes rather than copies.
+# Only the first chunk (headers and text) can hold lines starting with "."; the rest are MIME boundaries, headers and base64
+class MessageChunks(tuple):
+  def __bytes__(self):
+    return b"".join(self)
+
+# Builds the exact bytes smtplib.send_message would produce for MIMEMultipart("alternative") with one MIMEText part,
+# reusing the header/boundary skeleton of each subject and sender instead of going through the email package per message.
+# Messages with attachments or inline images come out as MessageChunks, their attachment parts cached per boundary
+class MessageFactory:
+  policy = compat32.clone(linesep="\r\n")
+  newlines = re.compile(r"\r\n|\r|\n")
+  from_lines = re.compile(r"^From ", re.MULTILINE)
+
+  def __init__(self):
+    self.skeletons = {}
+    self.tails = {}
+    self.text_headers = {
+      (subtype, charset): self.fold("Content-Type", f'text/{subtype}; charset="{charset}"') + self.fold("MIME-Version", "1.0") + self.fold("Content-Transfer-Encoding", "7bit" if charset == "us-ascii" else "base64") + b"\r\n"
+      for subtype in ("plain", "html") for charset in ("us-ascii", "utf-8")
+    }
+
+  def fold(self, name, value):
+    return self.policy.fold_binary(name, value)
+
+  # Random boundary in the same format the email package generates
+  def make_boundary(self):
+    return "=" * 15 + str(random.randrange(sys.maxsize)).zfill(len(repr(sys.maxsize - 1))) + "=="
+
+  # Headers up to (not including) To, plus the boundary, for one subject, sender and multipart subtype
+  def skeleton(self, email_subject, sending_email, boundary=None, multipart="alternative"):
+    key = (email_subject, sending_email, multipart)
+    if boundary is None and key in self.skeletons:
+      return self.skeletons[key]
+    boundary = boundary or self.make_boundary()
+    skeleton = (
+      self.fold("Content-Type", f'multipart/{multipart}; boundary="{boundary}"') + self.fold("MIME-Version", "1.0") + self.fold("Subject", email_subject) + self.fold("From", sending_email),
+      boundary.encode("ascii"),
+    )
+    self.skeletons.setdefault(key, skeleton)
+    return skeleton
+
+  # MIME part for an attachment, without its payload: inline ones get a Content-ID for HTML write-ups' cid: references
+  def attachment_part(self, attachment, inline):
+    part = MIMEBase(*attachment.content_type.split("/", 1), name=attachment.filename)
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "inline" if inline else "attachment", filename=attachment.filename)
+    if inline: part["Content-ID"] = f"<{attachment.filename}>"
+    return part
+
+  # Chunks after the text part for one boundary: each attachment's part headers followed by its shared encoded bytes.
+  # Inline images sit in a multipart/related part next to the text, nested inside multipart/mixed when there are attachments too
+  def tail(self, boundary, attachments, inline):
+    key = (boundary, attachments, inline)
+    if key in self.tails:
+      return self.tails[key]
+    related = b"related_" + boundary if attachments and inline else boundary
+    chunks = []
+    for attachment in inline:
+      chunks += [b"\r\n--" + related + b"\r\n" + b"".join(self.fold(name, value) for name, value in self.attachment_part(attachment, True).items()) + b"\r\n", attachment.encoded]
+    if attachments and inline:
+      chunks.append(b"\r\n--" + related + b"--\r\n")
+    for attachment in attachments:
+      chunks += [b"\r\n--" + boundary + b"\r\n" + b"".join(self.fold(name, value) for name, value in self.attachment_part(attachment, False).items()) + b"\r\n", attachment.encoded]
+    chunks.append(b"\r\n--" + boundary + b"--\r\n")
+    return self.tails.setdefault(key, tuple(chunks))
+
+  # Returns the message as bytes ready for sendmail, or as MessageChunks when it carries attachments or inline images.
+  # Addresses are always ASCII: contact_problem rejects any other, and campaign_config any other sender ID
+  def build(self, sending_email, contact_email, email_subject, email_writeup, subtype="plain", attachments=(), inline=()):
+    multipart = "mixed" if attachments else "related" if inline else "alternative"
+    head, boundary = self.skeleton(email_subject, sending_email, multipart=multipart)
+    if boundary.decode("ascii") in email_writeup:
+      head, boundary = self.skeleton(email_subject, sending_email, self.make_boundary(), multipart)
+    if email_writeup.isascii():
+      body = self.newlines.sub("\r\n", self.from_lines.sub(">From ", email_writeup)).encode("ascii")
+      text_headers = self.text_headers[subtype, "us-ascii"]
+    else:
+      body = base64.encodebytes(email_writeup.encode("utf-8")).replace(b"\n", b"\r\n")
+      text_headers = self.text_headers[subtype, "utf-8"]
+    if multipart == "alternative":
+      return b"".join((head, self.fold("To", contact_email), b"\r\n--", boundary, b"\r\n", text_headers, body, b"\r\n--", boundary, b"--\r\n"))
+    opening = b""
+    if attachments and inline:
+      opening = self.fold("Content-Type", f'multipart/related; boundary="related_{boundary.decode("ascii")}"') + self.fold("MIME-Version", "1.0") + b"\r\n--related_" + boundary + b"\r\n"
+    return MessageChunks((b"".join((head, self.fold("To", contact_email), b"\r\n--", boundary, b"\r\n", opening, text_headers, body)),) + self.tail(boundary, attachments, inline))
+
+# === Sender Accounts ===
+
+# Returns the [smtp] settings for one sender ID, overridden by its [accounts] entry if it has one
+def sender_smtp_settings(config, sending_email):
+  smtp_settings = dict(config.smtp)
+  smtp_settings.update(config.accounts.get(sending_email, {}))
+  return smtp_settings
+
+# Identifies the login a sender ID goes through, so IDs sharing one login share its connections
+def smtp_account_key(smtp_settings):
+  return (smtp_settings["smtp_server"], smtp_settings["smtp_port"], smtp_settings["username"])
+
+# Sends each message from its planned sender ID while that ID has quota, otherwise from the one with the most remaining
+# daily/per-minute quota. IDs with a weight of 0 are never used. With deferred_minute_caps, choosing a sender only charges its
+# daily cap, and the per-minute cap is charged by release() when the job actually goes out (the domain scheduler reads ahead)
+class SenderScheduler:
+  def __init__(self, sender_settings, sent_today=None, weights=None, deferred_minute_caps=False):
+    self.daily_caps = [int(smtp_settings.get("daily_cap", 0)) if not weights or weights[i] else -1 for i, smtp_settings in enumerate(sender_settings)]
+    self.minute_caps = [int(smtp_settings.get("minute_cap", 0)) for smtp_settings in sender_settings]
+    self.sent_today = list(sent_today) if sent_today else [0] * len(sender_settings)
+    self.sent_this_minute = [0] * len(sender_settings)
+    self.minute_started = [time.monotonic()] * len(sender_settings)
+    self.deferred_minute_caps = deferred_minute_caps
+
+  # Starts a sender's next minute once its current one is over
+  def roll_minute(self, i, now):
+    if now - self.minute_started[i] >= 60:
+      self.minute_started[i] = now
+      self.sent_this_minute[i] = 0
+
+  # Messages a sender may still send right now (caps of 0 mean unlimited, negative daily caps no quota at all)
+  def remaining(self, i, now):
+    self.roll_minute(i, now)
+    daily = self.daily_caps[i] - self.sent_today[i] if self.daily_caps[i] else float("inf")
+    minute = self.minute_caps[i] - self.sent_this_minute[i] if self.minute_caps[i] and not self.deferred_minute_caps else float("inf")
+    return min(daily, minute)
+
+  # Returns the chosen sender index, None once every daily cap is spent, or (as a float) the seconds to wait until a per-minute
+  # cap resets. It never sleeps itself, so the asyncio engine can await the wait instead of freezing its event loop
+  def choose(self, planned=None):
+    now = time.monotonic()
+    if planned is not None and self.remaining(planned, now) > 0:
+      best = planned
+    else:
+      best = max(range(len(self.daily_caps)), key=lambda i: (self.remaining(i, now), -self.sent_today[i]))
+    if self.remaining(best, now) > 0:
+      self.sent_today[best] += 1
+      if not self.deferred_minute_caps: self.sent_this_minute[best] += 1
+      return best
+    open_senders = [i for i, cap in enumerate(self.daily_caps) if cap == 0 or self.sent_today[i] < cap]
+    if not open_senders:
+      return None
+    return max(min(self.minute_started[i] + 60 for i in open_senders) - now, 0.01)
+
+  # Charges a job's recipients to its sender's per-minute cap as it is released, returning 0, or the seconds until the cap
+  # resets if they don't fit in this minute (a job bigger than the whole cap still goes at the start of a minute)
+  def release(self, i, recipients):
+    now = time.monotonic()
+    self.roll_minute(i, now)
+    if self.minute_caps[i] and self.sent_this_minute[i] and self.sent_this_minute[i] + recipients > self.minute_caps[i]:
+      return max(self.minute_started[i] + 60 - now, 0.01)
+    self.sent_this_minute[i] += recipients
+    return 0
+
+# === Rate Limiting ===
+
+# Reply codes providers use to say "slow down", and how many times a message is tried by default ([smtp].max_attempts)
+THROTTLE_CODES = (421, 450, 451, 452)
+SEND_ATTEMPTS = 5
+
+# Time constant (seconds) of the moving average of accepted messages a second, and the fraction of the current rate added back
+# after each second of clean sends when that is more than [smtp].rate_step
+RATE_AVERAGE_SECONDS = 5.0
+RATE_STEP_FRACTION = 0.02
+
+# Whether a recipient's refusal is really the server throttling the login: a 421 (the server is closing the connection), or a
+# 450/451/452 with a policy status code (4.7.x, which is how providers word rate limits) other than greylisting's 4.7.1
+def is_throttling_refusal(code, reply):
+  if code == 421: return True
+  reply = reply.decode("utf-8", "replace") if isinstance(reply, bytes) else str(reply)
+  return code in THROTTLE_CODES and re.match(r"4\.7\.(?!1\b)\d+", reply.strip()) is not None
+
+# Whether a send error means the server is throttling the login (or dropped the connection). Other temporary refusals of single
+# recipients (greylisting, full mailboxes) don't count: they are only retried later, without slowing the rest of the campaign
+def is_throttled(error):
+  if isinstance(error, smtplib.SMTPRecipientsRefused):
+    return any(is_throttling_refusal(code, reply) for code, reply in error.recipients.values())
+  if isinstance(error, smtplib.SMTPResponseException):
+    return error.smtp_code in THROTTLE_CODES
+  return isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError))
+
+# Whether a send error means no message will get through (login or sender address refused, or a missing server feature),
+# so the campaign stops rather than failing every recipient in turn
+def is_fatal(error):
+  if isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused, smtplib.SMTPHeloError)):
+    return error.smtp_code >= 500
+  return isinstance(error, smtplib.SMTPException) and not isinstance(error, (smtplib.SMTPResponseException, smtplib.SMTPServerDisconnected, smtplib.SMTPRecipientsRefused))
+
+# Whether the connection has to be reopened after a send error (it dropped, or the server is closing it with a 421, which can
+# also come as the reply to a RCPT)
+def needs_reconnect(error):
+  if isinstance(error, smtplib.SMTPRecipientsRefused):
+    return any(code == 421 for code, reply in error.recipients.values())
+  return getattr(error, "smtp_code", None) in (None, 421)
+
+# The refusal each recipient of a failed send got, as {address: (code, reply)}: the per-recipient replies if the server refused
+# them (recipients it accepted or never got to before closing with a 421 share that 421), otherwise the error's reply code
+# (None when the connection dropped) for every one of them
+def send_refusals(error, contact_emails):
+  if isinstance(error, smtplib.SMTPRecipientsRefused):
+    closing = next((refusal for refusal in error.recipients.values() if refusal[0] == 421), None)
+    if closing is None: return error.recipients
+    return {contact_email: error.recipients.get(contact_email, closing) for contact_email in contact_emails}
+  return dict.fromkeys(contact_emails, (getattr(error, "smtp_code", None), getattr(error, "smtp_error", None) or str(error) or type(error).__name__))
+
+# Seconds to wait before retry number attempt + 1: exponential backoff from [smtp].retry_backoff, capped at [smtp].retry_backoff_max,
+# with equal jitter (half fixed, half random) so throttled connections don't all come back at once
+def retry_delay(smtp_settings, attempt):
+  delay = min(float(smtp_settings.get("retry_backoff", 2)) * 2 ** attempt, float(smtp_settings.get("retry_backoff_max", 120)))
+  return delay / 2 + random.uniform(0, delay / 2)
+
+# Jobs waiting to be retried, ordered by when they come due
+class RetryQueue:
+  def __init__(self):
+    self.heap = []
+    self.count = 0
+
+  def __len__(self):
+    return len(self.heap)
+
+  def push(self, delay, attempt, job):
+    heapq.heappush(self.heap, (time.monotonic() + delay, self.count, attempt, job))
+    self.count += 1
+
+  # Returns the next (attempt, job) that is due, or None
+  def pop_due(self):
+    if self.heap and self.heap[0][0] <= time.monotonic():
+      return heapq.heappop(self.heap)[2:]
+    return None
+
+  # Seconds until the next retry comes due, or None if there are none
+  def wait(self):
+    return max(self.heap[0][0] - time.monotonic(), 0) if self.heap else None
+
+# Settles the refused recipients of a job's attempt: ones refused with a 4xx reply (or a dropped connection) go back on the retry
+# queue until [smtp].max_attempts is reached, and the rest are handed to on_failed. Returns whether anything was queued for retry
+def settle_refusals(job, attempt, refused, smtp_settings, retries, on_failed, metrics=None):
+  sending_email, contact_emails, message, batch = job
+  details_by_email = dict(zip(contact_emails, batch))
+  max_attempts = int(smtp_settings.get("max_attempts", SEND_ATTEMPTS))
+  retry_emails = []
+  for contact_email, (code, reply) in refused.items():
+    details = details_by_email[contact_email]
+    if (code is None or code < 500) and attempt + 1 < max_attempts:
+      retry_emails.append(contact_email)
+      if metrics is not None: metrics.count("retried", details[2], details[1])
+      continue
+    if metrics is not None: metrics.count("failed", details[2], details[1])
+    reason = reply.decode("utf-8", "replace") if isinstance(reply, bytes) else str(reply)
+    if code is None or code < 500: reason += f" (gave up after {attempt + 1} attempts)"
+    on_failed(details, code, reason)
+  if retry_emails:
+    retries.push(retry_delay(smtp_settings, attempt), attempt + 1, (sending_email, retry_emails, message, [details_by_email[contact_email] for contact_email in retry_emails]))
+  return bool(retry_emails)
+
+# Token bucket shared by one login's connections; halves its rate on throttling and adds back [smtp].rate_step/s (or 2% of the
+# rate, whichever is more, so a halved rate of 1000/s recovers in about half a minute) after each second of clean sends
+class AdaptiveRateLimiter:
+  def __init__(self, max_rate, rate_step=1.0, min_rate=0.1):
+    self.max_rate = float(max_rate) or None
+    self.rate = self.max_rate
+    self.rate_step = float(rate_step)
+    self.min_rate = min_rate
+    self.lock = threading.Lock()
+    self.tokens = 1.0
+    self.updated = time.monotonic()
+    self.successes = 0
+    self.started = self.updated
+    self.observed = 0.0
+    self.observed_at = self.updated
+
+  # Takes a token and returns how long the caller has to wait for it
+  def reserve(self):
+    with self.lock:
+      if self.rate is None:
+        return 0
+      now = time.monotonic()
+      self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate) - 1
+      self.updated = now
+      return -self.tokens / self.rate if self.tokens < 0 else 0
+
+  def acquire(self):
+    time.sleep(self.reserve())
+
+  async def acquire_async(self):
+    await asyncio.sleep(self.reserve())
+
+  # Accepted messages a second, as an exponentially weighted moving average over the last RATE_AVERAGE_SECONDS or so
+  # (corrected for the average starting at 0, so it is right from the first messages on)
+  def observed_rate(self, now):
+    decayed = self.observed * math.exp((self.observed_at - now) / RATE_AVERAGE_SECONDS)
+    return decayed / max(1 - math.exp((self.started - now) / RATE_AVERAGE_SECONDS), 1e-9)
+
+  # Additive increase: one step per second's worth of accepted messages
+  def on_success(self):
+    with self.lock:
+      now = time.monotonic()
+      self.observed = self.observed * math.exp((self.observed_at - now) / RATE_AVERAGE_SECONDS) + 1 / RATE_AVERAGE_SECONDS
+      self.observed_at = now
+      if self.rate is None: return
+      self.successes += 1
+      if self.successes >= self.rate:
+        self.successes = 0
+        self.rate = min(self.rate + max(self.rate_step, self.rate * RATE_STEP_FRACTION), self.max_rate or float("inf"))
+
+  # Multiplicative decrease, starting from the observed send rate if no ceiling was set
+  def on_throttle(self):
+    with self.lock:
+      if self.rate is None:
+        self.rate = max(self.observed_rate(time.monotonic()), self.min_rate * 2)
+      self.rate = max(self.rate / 2, self.min_rate)
+      self.tokens = 0.0
+      self.successes = 0
+
+# === Domain Scheduling ===
+
+# Recipient domain of an address, lowercased
+def email_domain(contact_email):
+  return contact_email.rpartition("@")[2].lower()
+
+# Whether the [smtp]/[domains] settings ask for domain-aware scheduling at all (otherwise jobs go out in CSV order)
+def domain_scheduling(config):
+  return bool(config.domains) or any(float(config.smtp.get(key, 0)) > 0 for key in ("domain_concurrency", "domain_max_rate", "window_hours"))
+
+# Interleaves a campaign's jobs across recipient domains. Jobs are read ahead into one queue per domain ([smtp].domain_lookahead
+# jobs in all) and handed out round-robin, each domain held to [smtp].domain_concurrency recipients in flight and
+# [smtp].domain_max_rate recipients a second, overridden per domain by [domains."<domain>"] entries. With [smtp].window_hours set,
+# the contacts are spread evenly over that many hours: each release waits the window's remaining time over the contacts left.
+# Sender per-minute caps are charged through the SenderScheduler when a job is released, not when it is read ahead
+class DomainScheduler:
+  def __init__(self, jobs, smtp_settings, domains, rows, settled, senders=None):
+    self.jobs = iter(jobs)
+    self.senders = senders
+    self.lookahead = max(int(smtp_settings.get("domain_lookahead", 1000)), 1)
+    self.default_caps = self.caps(smtp_settings)
+    self.domain_caps = {domain: self.caps({**smtp_settings, **entry}) for domain, entry in domains.items()}
+    self.queues = {}
+    self.order = collections.deque()
+    self.buffered = 0
+    self.exhausted = False
+    self.resume_at = 0
+    self.in_flight = collections.Counter()
+    self.next_allowed = {}
+    self.condition = threading.Condition()
+    self.changes = 0
+    self.changed = None
+    window = float(smtp_settings.get("window_hours", 0)) * 3600
+    self.window_end = time.monotonic() + window if window > 0 else None
+    self.next_release = 0
+    self.rows = rows
+    self.released = 0
+    self.settled = settled
+
+  # (recipients in flight, recipients a second) allowed by one set of settings, 0 meaning unlimited
+  def caps(self, settings):
+    return (int(settings.get("domain_concurrency", 0)) or math.inf, float(settings.get("domain_max_rate", 0)))
+
+  # Reads jobs into their domain's queue until the lookahead is full, stopping early (without waiting) if the job stream asks
+  # for a wait, so whatever is already buffered can go out in the meantime
+  def fill(self):
+    if time.monotonic() < self.resume_at:
+      return
+    while not self.exhausted and self.buffered < self.lookahead:
+      job = next(self.jobs, None)
+      if isinstance(job, float):
+        self.resume_at = time.monotonic() + job
+        break
+      if job is None:
+        self.exhausted = True
+        break
+      domain = email_domain(job[1][0])
+      if domain not in self.queues:
+        self.queues[domain] = collections.deque()
+        self.order.append(domain)
+      self.queues[domain].append(job)
+      self.buffered += 1
+
+  # Returns the next job that may go now, the seconds to wait before one may (math.inf: until a recipient in flight finishes),
+  # or None once every job has been handed out
+  def take(self):
+    self.fill()
+    now = time.monotonic()
+    if not self.buffered:
+      return None if self.exhausted else max(self.resume_at - now, 0.01)
+    if now < self.next_release:
+      return self.next_release - now
+    wait = math.inf
+    with self.condition:
+      for _ in range(len(self.order)):
+        domain = self.order[0]
+        self.order.rotate(-1)
+        concurrency, max_rate = self.domain_caps.get(domain, self.default_caps)
+        recipients = len(self.queues[domain][0][1])
+        if self.in_flight[domain] and self.in_flight[domain] + recipients > concurrency:
+          continue
+        if self.next_allowed.get(domain, 0) > now:
+          wait = min(wait, self.next_allowed[domain] - now)
+          continue
+        if self.senders is not None:
+          sender_wait = self.senders.release(self.queues[domain][0][3][0][2], recipients)
+          if sender_wait:
+            wait = min(wait, sender_wait)
+            continue
+        job = self.queues[domain].popleft()
+        if not self.queues[domain]:
+          del self.queues[domain]
+          self.order.pop()
+        self.buffered -= 1
+        self.in_flight[domain] += recipients
+        if max_rate: self.next_allowed[domain] = max(self.next_allowed.get(domain, 0), now) + recipients / max_rate
+        self.released += recipients
+        if self.window_end is not None:
+          self.next_release = now + max(self.window_end - now, 0) / max(self.rows - self.released - self.settled(), 1)
+        return job
+    if not self.exhausted and self.resume_at > now:
+      wait = min(wait, self.resume_at - now)
+    return wait
+
+  # Called once per recipient that was sent or failed for good, freeing its place in its domain's concurrency
+  def finished(self, contact_email):
+    domain = email_domain(contact_email)
+    with self.condition:
+      self.in_flight[domain] -= 1
+      if self.in_flight[domain] <= 0:
+        del self.in_flight[domain]
+        if domain not in self.queues and self.next_allowed.get(domain, 0) <= time.monotonic(): self.next_allowed.pop(domain, None)
+      self.changes += 1
+      self.condition.notify_all()
+    if self.changed is not None: self.changed.set()
+
+  # Yields jobs as they come due for the threads engine, sleeping in between; stops early once stopped() says sending has failed
+  def paced(self, stopped):
+    while True:
+      changes = self.changes
+      job = self.take()
+      if job is None: return
+      if not isinstance(job, float):
+        yield job
+        continue
+      if stopped(): return
+      with self.condition:
+        if self.changes == changes: self.condition.wait(min(job, 1.0))
+
+  # Yields jobs as they come due for the asyncio engine, awaiting in between so the event loop keeps sending
+  async def paced_async(self):
+    self.changed = asyncio.Event()
+    while True:
+      changes = self.changes
+      job = self.take()
+      if job is None: return
+      if not isinstance(job, float):
+        yield job
+        continue
+      self.changed.clear()
+      if self.changes != changes: continue
+      try:
+        await asyncio.wait_for(self.changed.wait(), None if job == math.inf else job)
+      except TimeoutError:
+        pass
+
+# === SMTP Sending ===
+
+# Opens an SMTP session and logs in with the given [smtp] settings
+def open_smtp_connection(smtp_settings):
+  SMTP_server = smtplib.SMTP(smtp_settings["smtp_server"], smtp_settings["smtp_port"])
+  SMTP_server.ehlo()
+  if smtp_settings.get("starttls", True):
+    SMTP_server.starttls()
+  SMTP_server.login(smtp_settings["username"], smtp_settings["passkey"])
+  return SMTP_server
+
+# Closes an SMTP session, ignoring errors from an already dropped connection
+def close_smtp_connection(SMTP_server):
+  try:
+    SMTP_server.quit()
+  except (smtplib.SMTPException, OSError):
+    SMTP_server.close()
+
+# Sends one message to one or more recipients in a single transaction, pipelining MAIL and RCPT commands when asked to and the
+# server advertises PIPELINING. MessageChunks are written to the socket chunk by chunk, so shared attachments are never copied
+# into a per-message buffer. Returns the refused recipients as {address: (code, reply)}, like SMTP.sendmail, which also closes the
+# connection and raises SMTPRecipientsRefused when a RCPT gets a 421
+def send_smtp_transaction(SMTP_server, sending_email, contact_emails, message, pipelining=False):
+  if pipelining and SMTP_server.has_extn("pipelining"):
+    SMTP_server.send(f"MAIL FROM:<{sending_email}>\r\n" + "".join(f"RCPT TO:<{contact_email}>\r\n" for contact_email in contact_emails))
+    code, reply = SMTP_server.getreply()
+    recipient_replies = []
+    for _ in contact_emails:
+      recipient_replies.append(SMTP_server.getreply())
+      if recipient_replies[-1][0] == 421: break
+  elif isinstance(message, MessageChunks):
+    code, reply = SMTP_server.mail(sending_email)
+    recipient_replies = []
+    for contact_email in contact_emails if code == 250 else ():
+      recipient_replies.append(SMTP_server.rcpt(contact_email))
+      if recipient_replies[-1][0] == 421: break
+  else:
+    return SMTP_server.sendmail(sending_email, contact_emails, message)
+  if code != 250:
+    if code == 421: SMTP_server.close()
+    else: SMTP_server.rset()
+    raise smtplib.SMTPSenderRefused(code, reply, sending_email)
+  refused = {contact_email: recipient_reply for contact_email, recipient_reply in zip(contact_emails, recipient_replies) if recipient_reply[0] not in (250, 251)}
+  if any(code == 421 for code, reply in refused.values()):
+    SMTP_server.close()
+    raise smtplib.SMTPRecipientsRefused(refused)
+  if len(refused) == len(contact_emails):
+    SMTP_server.rset()
+    raise smtplib.SMTPRecipientsRefused(refused)
+  if isinstance(message, MessageChunks):
+    SMTP_server.putcmd("data")
+    code, reply = SMTP_server.getreply()
+    if code != 354:
+      SMTP_server.rset()
+      raise smtplib.SMTPDataError(code, reply)
+    SMTP_server.send(re.sub(rb"(?m)^\.", b"..", message[0]))
+    for chunk in message[1:]:
+      SMTP_server.send(chunk)
+    SMTP_server.send(b".\r\n")
+    code, reply = SMTP_server.getreply()
+  else:
+    code, reply = SMTP_server.data(message)
+  if code != 250:
+    SMTP_server.rset()
+    raise smtplib.SMTPDataError(code, reply)
+  return refused
+
+# Pool of persistent SMTP sessions, each driven by its own worker thread. Failed sends wait on a retry queue, which the workers
+# serve ahead of new jobs once each retry comes due, so a retry never holds up the rest of the campaign
+class SMTPPool:
+  def __init__(self, smtp_settings, connections, on_sent, on_failed, lock=None, metrics=None):
+    self.smtp_settings = smtp_settings
+    self.on_sent = on_sent
+    self.on_failed = on_failed
+    self.lock = lock or threading.Lock()
+    self.metrics = metrics
+    self.limiter = AdaptiveRateLimiter(smtp_settings.get("max_rate", 0), smtp_settings.get("rate_step", 1))
+    self.error = None
+    self.jobs = queue.Queue(maxsize=connections * 4)
+    self.retries = RetryQueue()
+    self.condition = threading.Condition()
+    self.unfinished = 0
+    self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(connections)]
+    for worker in self.workers:
+      worker.start()
+
+  # Queues a (from, [to, ...], message, [details, ...]) job, blocking while the queue is full
+  def submit(self, job):
+    if self.error is not None:
+      raise self.error
+    with self.condition:
+      self.unfinished += 1
+    self.jobs.put(job)
+
+  # Marks a job as done with (sent, failed or dropped after an error)
+  def finish(self):
+    with self.condition:
+      self.unfinished -= 1
+      if self.unfinished == 0: self.condition.notify_all()
+
+  # Returns the next (attempt, job) to send: a retry that has come due, otherwise a new job. Once this worker has taken its
+  # closing marker (closing[0]), it only waits for retries, returning None when no job is left unfinished
+  def next_job(self, closing):
+    while True:
+      with self.condition:
+        retry = self.retries.pop_due()
+        if retry is not None: return retry
+        wait = self.retries.wait()
+        if closing[0]:
+          if self.unfinished == 0 or self.error is not None: return None
+          self.condition.wait(wait)
+          continue
+      try:
+        job = self.jobs.get(timeout=wait)
+      except queue.Empty:
+        continue
+      if job is None: closing[0] = True
+      else: return 0, job
+
+  # Opens a worker's connection, backing off between failed attempts; raises on a 5xx reply or after [smtp].max_attempts failures
+  def connect(self):
+    max_attempts = int(self.smtp_settings.get("max_attempts", SEND_ATTEMPTS))
+    for attempt in range(max_attempts):
+      try:
+        started = time.perf_counter()
+        SMTP_server = open_smtp_connection(self.smtp_settings)
+        if self.metrics is not None: self.metrics.observe("connect", time.perf_counter() - started)
+        return SMTP_server
+      except (smtplib.SMTPException, OSError) as error:
+        if getattr(error, "smtp_code", 0) >= 500 or attempt == max_attempts - 1: raise
+        time.sleep(retry_delay(self.smtp_settings, attempt))
+
+  # Sends jobs over one connection, reconnecting when the server drops it and queueing refused recipients for a later retry
+  def work(self):
+    SMTP_server = None
+    closing = [False]
+    while True:
+      next_job = self.next_job(closing)
+      if next_job is None: break
+      attempt, job = next_job
+      if self.error is not None:
+        self.finish()
+        continue
+      sending_email, contact_emails, message, batch = job
+      try:
+        self.limiter.acquire()
+        if SMTP_server is None:
+          SMTP_server = self.connect()
+        try:
+          started = time.perf_counter()
+          refused = send_smtp_transaction(SMTP_server, sending_email, contact_emails, message, self.smtp_settings.get("pipelining", False))
+          if self.metrics is not None: self.metrics.observe("smtp", time.perf_counter() - started)
+          self.limiter.on_success()
+        except (smtplib.SMTPException, OSError) as error:
+          if is_fatal(error): raise
+          if is_throttled(error): self.limiter.on_throttle()
+          if needs_reconnect(error):
+            close_smtp_connection(SMTP_server)
+            SMTP_server = None
+          refused = send_refusals(error, contact_emails)
+        with self.lock:
+          for contact_email, details in zip(contact_emails, batch):
+            if contact_email not in refused: self.on_sent(details)
+          with self.condition:
+            retrying = settle_refusals(job, attempt, refused, self.smtp_settings, self.retries, self.on_failed, self.metrics)
+            if retrying: self.condition.notify_all()
+        if not retrying: self.finish()
+      except Exception as error:
+        self.error = error
+        self.finish()
+        with self.condition:
+          self.condition.notify_all()
+    if SMTP_server is not None:
+      close_smtp_connection(SMTP_server)
+
+  # Stops the pool because sending failed elsewhere: queued jobs and retries are dropped, sends already under way still finish
+  def stop(self, error):
+    if self.error is None: self.error = error
+    with self.condition:
+      self.condition.notify_all()
+
+  # Waits for queued jobs (and their retries) to finish, closes every connection and returns the first send error
+  def close(self):
+    for _ in self.workers:
+      self.jobs.put(None)
+    for worker in self.workers:
+      worker.join()
+    return self.error
+
+# === Asyncio SMTP Sending ===
+
+# Reads one (possibly multi-line) SMTP reply as (code, text)
+async def read_smtp_reply(reader):
+  lines = []
+  while True:
+    line = await reader.readline()
+    if not line:
+      raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+    lines.append(line[4:].strip())
+    if line[3:4] != b"-":
+      return int(line[:3]), b"\n".join(lines)
+
+# Sends one SMTP command and raises unless the reply code is expected
+async def smtp_command(connection, command, expected=(250,)):
+  reader, writer = connection[:2]
+  writer.write(command + b"\r\n")
+  code, text = await read_smtp_reply(reader)
+  if code not in expected:
+    raise smtplib.SMTPResponseException(code, text)
+  return code, text
+
+# Opens an asyncio SMTP session and logs in with the given [smtp] settings, returning (reader, writer, EHLO features)
+async def open_smtp_connection_async(smtp_settings):
+  connection = await asyncio.open_connection(smtp_settings["smtp_server"], smtp_settings["smtp_port"])
+  await read_smtp_reply(connection[0])
+  code, features = await smtp_command(connection, b"EHLO " + socket.getfqdn().encode())
+  if smtp_settings.get("starttls", True):
+    await smtp_command(connection, b"STARTTLS", (220,))
+    await connection[1].start_tls(ssl.create_default_context(), server_hostname=smtp_settings["smtp_server"])
+    code, features = await smtp_command(connection, b"EHLO " + socket.getfqdn().encode())
+  username = str(smtp_settings["username"]).encode()
+  passkey = str(smtp_settings["passkey"]).encode()
+  try:
+    if re.search(rb"(?im)^auth[ =].*\bPLAIN\b", features) or not re.search(rb"(?im)^auth[ =].*\bLOGIN\b", features):
+      await smtp_command(connection, b"AUTH PLAIN " + base64.b64encode(b"\0" + username + b"\0" + passkey), (235,))
+    else:
+      await smtp_command(connection, b"AUTH LOGIN " + base64.b64encode(username), (334,))
+      await smtp_command(connection, base64.b64encode(passkey), (235,))
+  except smtplib.SMTPResponseException as error:
+    connection[1].close()
+    raise smtplib.SMTPAuthenticationError(error.smtp_code, error.smtp_error)
+  return connection + (features,)
+
+# Closes an asyncio SMTP session, ignoring errors from an already dropped connection
+async def close_smtp_connection_async(connection):
+  try:
+    await smtp_command(connection, b"QUIT", (221,))
+  except (smtplib.SMTPException, OSError):
+    pass
+  connection[1].close()
+
+# Sends one message (pre-encoded bytes or MessageChunks) to one or more recipients over an asyncio SMTP session,
+# pipelining MAIL and RCPT commands when asked to and the server advertises PIPELINING. Writes wait for the socket to drain after
+# each batch of commands and each chunk of the message, so a slow server can't pile whole messages up in the transport buffer.
+# Returns the refused recipients like SMTP.sendmail
+async def send_message_async(connection, sending_email, contact_emails, message, pipelining=False):
+  reader, writer, features = connection
+  if isinstance(message, MessageChunks):
+    data = [re.sub(rb"(?m)^\.", b"..", message[0]), *message[1:]]
+  else:
+    data = [re.sub(rb"(?m)^\.", b"..", message)]
+    if not data[0].endswith(b"\r\n"): data.append(b"\r\n")
+  if pipelining and re.search(rb"(?im)^pipelining\b", features):
+    writer.write(b"MAIL FROM:<" + sending_email.encode() + b">\r\n" + b"".join(b"RCPT TO:<" + contact_email.encode() + b">\r\n" for contact_email in contact_emails))
+    await writer.drain()
+    code, text = await read_smtp_reply(reader)
+    recipient_replies = []
+    for _ in contact_emails:
+      recipient_replies.append(await read_smtp_reply(reader))
+      if recipient_replies[-1][0] == 421: break
+  else:
+    writer.write(b"MAIL FROM:<" + sending_email.encode() + b">\r\n")
+    code, text = await read_smtp_reply(reader)
+    recipient_replies = []
+    for contact_email in contact_emails if code == 250 else ():
+      writer.write(b"RCPT TO:<" + contact_email.encode() + b">\r\n")
+      recipient_replies.append(await read_smtp_reply(reader))
+      if recipient_replies[-1][0] == 421: break
+  if code != 250:
+    if code != 421: await smtp_command(connection, b"RSET")
+    raise smtplib.SMTPSenderRefused(code, text, sending_email)
+  refused = {contact_email: recipient_reply for contact_email, recipient_reply in zip(contact_emails, recipient_replies) if recipient_reply[0] not in (250, 251)}
+  if any(code == 421 for code, reply in refused.values()):
+    raise smtplib.SMTPRecipientsRefused(refused)
+  if len(refused) == len(contact_emails):
+    await smtp_command(connection, b"RSET")
+    raise smtplib.SMTPRecipientsRefused(refused)
+  writer.write(b"DATA\r\n")
+  code, text = await read_smtp_reply(reader)
+  if code != 354:
+    await smtp_command(connection, b"RSET")
+    raise smtplib.SMTPDataError(code, text)
+  for chunk in data:
+    writer.write(chunk)
+    await writer.drain()
+  writer.write(b".\r\n")
+  await writer.drain()
+  code, text = await read_smtp_reply(reader)
+  if code != 250:
+    await smtp_command(connection, b"RSET")
+    raise smtplib.SMTPDataError(code, text)
+  return refused
+
+# One login's side of an asyncio campaign: its job queue, retry queue and rate limiter, shared by its connections
+class AsyncAccount:
+  def __init__(self, smtp_settings):
+    self.smtp_settings = smtp_settings
+    self.connections = smtp_settings.get("connections", 1)
+    self.jobs = asyncio.Queue(maxsize=self.connections * 4)
+    self.retries = RetryQueue()
+    self.limiter = AdaptiveRateLimiter(smtp_settings.get("max_rate", 0), smtp_settings.get("rate_step", 1))
+    self.unfinished = 0
+    self.changed = asyncio.Event()
+    self.error = None
+
+  # Marks a job as done with (sent or failed)
+  def finish(self):
+    self.unfinished -= 1
+    self.changed.set()
+
+  # Stops the account because sending failed: queued jobs and retries are dropped, and each connection exits once the send
+  # it has under way (if any) has finished
+  def stop(self, error):
+    self.error = error
+    while not self.jobs.empty():
+      self.jobs.get_nowait()
+    for _ in range(self.connections):
+      self.jobs.put_nowait(None)
+    self.changed.set()
+
+  # Returns the next (attempt, job) to send: a retry that has come due, otherwise a new job. Once this connection has taken its
+  # closing marker (closing[0]), it only waits for retries, returning None when no job is left unfinished
+  async def next_job(self, closing):
+    while True:
+      if self.error is not None: return None
+      retry = self.retries.pop_due()
+      if retry is not None: return retry
+      wait = self.retries.wait()
+      try:
+        if closing[0]:
+          if self.unfinished == 0: return None
+          self.changed.clear()
+          await asyncio.wait_for(self.changed.wait(), wait)
+          continue
+        job = await asyncio.wait_for(self.jobs.get(), wait)
+      except TimeoutError:
+        continue
+      if job is None: closing[0] = True
+      else: return 0, job
+
+# Sends a whole campaign's jobs (rendered lazily as they are pulled, from an iterator or a DomainScheduler's async one) on one
+# event loop, with one coroutine per SMTP session. A float in place of a job is a wait for a per-minute cap, awaited here.
+# Refused recipients wait on their login's retry queue, which is served ahead of new jobs once each retry comes due
+async def send_campaign_async(sender_settings, jobs, on_sent, on_failed, metrics=None):
+  accounts = {}
+  for smtp_settings in sender_settings:
+    key = smtp_account_key(smtp_settings)
+    if key not in accounts: accounts[key] = AsyncAccount(smtp_settings)
+  sender_accounts = [accounts[smtp_account_key(smtp_settings)] for smtp_settings in sender_settings]
+
+  async def campaign_jobs():
+    if hasattr(jobs, "__aiter__"):
+      async for job in jobs: yield job
+    else:
+      for job in jobs: yield job
+
+  async def produce():
+    async for job in campaign_jobs():
+      if isinstance(job, float):
+        await asyncio.sleep(job)
+        continue
+      account = sender_accounts[job[3][0][2]]
+      account.unfinished += 1
+      await account.jobs.put(job)
+    for account in accounts.values():
+      for _ in range(account.connections):
+        await account.jobs.put(None)
+
+  # Opens a connection, backing off between failed attempts; raises on a 5xx reply or after [smtp].max_attempts failures
+  async def connect(smtp_settings):
+    max_attempts = int(smtp_settings.get("max_attempts", SEND_ATTEMPTS))
+    for attempt in range(max_attempts):
+      try:
+        started = time.perf_counter()
+        connection = await open_smtp_connection_async(smtp_settings)
+        if metrics is not None: metrics.observe("connect", time.perf_counter() - started)
+        return connection
+      except (smtplib.SMTPException, OSError) as error:
+        if getattr(error, "smtp_code", 0) >= 500 or attempt == max_attempts - 1: raise
+        await asyncio.sleep(retry_delay(smtp_settings, attempt))
+
+  async def consume(account):
+    smtp_settings = account.smtp_settings
+    connection = None
+    closing = [False]
+    while True:
+      next_job = await account.next_job(closing)
+      if next_job is None: break
+      attempt, job = next_job
+      sending_email, contact_emails, message, batch = job
+      await account.limiter.acquire_async()
+      if connection is None:
+        connection = await connect(smtp_settings)
+      try:
+        started = time.perf_counter()
+        refused = await send_message_async(connection, sending_email, contact_emails, message, smtp_settings.get("pipelining", False))
+        if metrics is not None: metrics.observe("smtp", time.perf_counter() - started)
+        account.limiter.on_success()
+      except (smtplib.SMTPException, OSError) as error:
+        if is_fatal(error): raise
+        if is_throttled(error): account.limiter.on_throttle()
+        if needs_reconnect(error):
+          connection[1].close()
+          connection = None
+        refused = send_refusals(error, contact_emails)
+      for contact_email, details in zip(contact_emails, batch):
+        if contact_email not in refused: on_sent(details)
+      if settle_refusals(job, attempt, refused, smtp_settings, account.retries, on_failed, metrics): account.changed.set()
+      else: account.finish()
+    if connection is not None:
+      await close_smtp_connection_async(connection)
+
+  # On a failure, every connection finishes the send it has under way before the error is raised, so nothing that reached
+  # the server goes unrecorded
+  producer = asyncio.ensure_future(produce())
+  consumers = [asyncio.ensure_future(consume(account)) for account in accounts.values() for _ in range(account.connections)]
+  try:
+    await asyncio.gather(producer, *consumers)
+  except Exception as error:
+    producer.cancel()
+    for account in accounts.values(): account.stop(error)
+    await asyncio.gather(producer, *consumers, return_exceptions=True)
+    raise
+
+# === Dry Run ===
+
+# Where a dry run writes its messages: [dry_run].path, or Maildir/ or messages.mbox in the dry-run output folder.
+# Shards share one Maildir but each write their own mbox, which the parent process joins afterwards
+def dry_run_path(config, shard_index=None):
+  mbox = config.dry_run.get("format", "maildir") == "mbox"
+  path = config.dry_run.get("path", "") or os.path.join(config.output_folder, "messages.mbox" if mbox else "Maildir")
+  if mbox and shard_index is not None:
+    path = f"{os.path.splitext(path)[0]}-shard{shard_index}.mbox"
+  return path
+
+# Writes a dry run's messages to a Maildir (one file per message, delivered through tmp/ into new/) or an mbox file instead of
+# sending them. Messages are handed to a writer thread in batches, so rendering carries on while they hit the disk. With
+# [dry_run].sample set, every message is still rendered but only a seeded random sample of that many is kept and written at the end
+class DryRunWriter:
+  batch_size = 256
+
+  def __init__(self, dry_run_settings, path, seed=0, metrics=None):
+    self.mbox = dry_run_settings.get("format", "maildir") == "mbox"
+    self.path = path
+    self.metrics = metrics
+    self.sample = int(dry_run_settings.get("sample", 0))
+    self.random = random.Random(seed or None)
+    self.reservoir = []
+    self.seen = 0
+    self.pending = []
+    self.delivered = 0
+    self.hostname = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+    self.error = None
+    if self.mbox:
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+      self.mbox_file = open(path, mode='ab', buffering=1 << 20)
+    else:
+      for folder in ("tmp", "new", "cur"):
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+    self.batches = queue.Queue(maxsize=4)
+    self.writer = threading.Thread(target=self.work, daemon=True)
+    self.writer.start()
+
+  # Queues one message (bytes, MessageChunks or a MIME message) as sent from sending_email to contact_emails
+  def add(self, sending_email, contact_emails, message):
+    if self.error is not None:
+      raise self.error
+    entry = (sending_email, contact_emails, message)
+    if self.sample:
+      if self.seen < self.sample: self.reservoir.append((self.seen, entry))
+      else:
+        slot = self.random.randrange(self.seen + 1)
+        if slot < self.sample: self.reservoir[slot] = (self.seen, entry)
+      self.seen += 1
+      return
+    self.pending.append(entry)
+    if len(self.pending) >= self.batch_size:
+      self.batches.put(self.pending)
+      self.pending = []
+
+  # The message as it would be delivered: LF line endings, with the envelope as Return-Path and Delivered-To headers
+  def message_bytes(self, sending_email, contact_emails, message):
+    data = b"".join(message) if isinstance(message, MessageChunks) else message
+    envelope = b"Return-Path: <" + sending_email.encode() + b">\n" + b"".join(b"Delivered-To: " + contact_email.encode() + b"\n" for contact_email in contact_emails)
+    return envelope + data.replace(b"\r\n", b"\n")
+
+  # Writes one batch of messages, appending to the mbox or delivering each into the Maildir
+  def write(self, batch):
+    started = time.perf_counter()
+    for sending_email, contact_emails, message in batch:
+      data = self.message_bytes(sending_email, contact_emails, message)
+      if self.mbox:
+        self.mbox_file.write(b"From " + sending_email.encode() + b" " + time.asctime().encode() + b"\n" + re.sub(rb"(?m)^From ", b">From ", data) + b"\n")
+        continue
+      self.delivered += 1
+      name = f"{int(time.time())}.P{os.getpid()}Q{self.delivered}.{self.hostname}"
+      message_file = open(os.path.join(self.path, "tmp", name), mode='xb')
+      message_file.write(data)
+      message_file.close()
+      os.rename(os.path.join(self.path, "tmp", name), os.path.join(self.path, "new", name))
+    if self.metrics is not None: self.metrics.observe("write", time.perf_counter() - started)
+
+  def work(self):
+    while True:
+      batch = self.batches.get()
+      if batch is None: break
+      if self.error is not None: continue
+      try:
+        self.write(batch)
+      except OSError as error:
+        self.error = error
+
+  # Writes what is left (the whole sample, in campaign order, when sampling) and raises any write error
+  def close(self):
+    if self.reservoir:
+      self.pending = [entry for _, entry in sorted(self.reservoir, key=lambda item: item[0])]
+      self.reservoir = []
+    if self.pending:
+      self.batches.put(self.pending)
+      self.pending = []
+    self.batches.put(None)
+    self.writer.join()
+    if self.mbox: self.mbox_file.close()
+    if self.error is not None:
+      raise self.error
+
+# === Local SMTP Sink ===
+
+# One SMTP conversation with a local sink: feed it command lines, get back replies
+class LocalSMTPSession:
+  greeting = b"220 localhost Auto Email Sendr sink\r\n"
+
+  def __init__(self, sink):
+    self.sink = sink
+    self.state = "command"
+    self.closed = False
+    self.delay = 0
+    self.recipients = 0
+
+  def feed(self, line):
+    if self.state == "data":
+      if line != b".\r\n": return b""
+      self.state = "command"
+      with self.sink.lock:
+        self.sink.messages += 1
+        self.sink.recipients += self.recipients
+      self.delay = self.sink.latency
+      return b"250 OK\r\n"
+    if self.state == "auth_username":
+      self.state = "auth_passkey"
+      return b"334 UGFzc3dvcmQ6\r\n"
+    if self.state == "auth_passkey":
+      self.state = "command"
+      return b"235 Authentication successful\r\n"
+    command = line[:4].upper()
+    if command == b"EHLO":
+      return b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250-PIPELINING\r\n250 8BITMIME\r\n"
+    if command == b"AUTH":
+      auth = line.split()
+      if auth[1:2] == [b"LOGIN"]:
+        self.state = "auth_username" if len(auth) == 2 else "auth_passkey"
+        return b"334 VXNlcm5hbWU6\r\n" if len(auth) == 2 else b"334 UGFzc3dvcmQ6\r\n"
+      return b"235 Authentication successful\r\n"
+    if command == b"DATA":
+      self.state = "data"
+      return b"354 End data with <CR><LF>.<CR><LF>\r\n"
+    if command == b"QUIT":
+      self.closed = True
+      return b"221 Bye\r\n"
+    if command == b"RCPT" and self.sink.error_rate and self.sink.random.random() < self.sink.error_rate:
+      with self.sink.lock:
+        self.sink.rejected += 1
+      self.closed = self.sink.error_code == 421
+      return str(self.sink.error_code).encode() + b" Injected error\r\n"
+    if command in (b"MAIL", b"RSET"):
+      self.recipients = 0
+    if command == b"RCPT":
+      self.recipients += 1
+    if command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+      return b"250 OK\r\n"
+    return b"502 Command not implemented\r\n"
+
+# Answers one SMTP session on the threaded sink
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+  disable_nagle_algorithm = True
+
+  def handle(self):
+    session = LocalSMTPSession(self.server)
+    self.wfile.write(session.greeting)
+    while not session.closed:
+      line = self.rfile.readline()
+      if not line: break
+      reply = session.feed(line)
+      if session.delay:
+        time.sleep(session.delay)
+        session.delay = 0
+      self.wfile.write(reply)
+
+# Threaded SMTP server on localhost that counts the messages (and recipients) it receives,
+# optionally waiting `latency` seconds per message and rejecting `error_rate` of recipients with `error_code` (closing the
+# connection after a 421, as a real server does)
+class LocalSMTPSink(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+  request_queue_size = 128
+
+  def __init__(self, port=0, latency=0.0, error_rate=0.0, error_code=451):
+    super().__init__(("127.0.0.1", port), LocalSMTPHandler)
+    self.lock = threading.Lock()
+    self.messages = 0
+    self.recipients = 0
+    self.rejected = 0
+    self.latency = latency
+    self.error_rate = error_rate
+    self.error_code = error_code
+    self.random = random.Random()
+    self.port = self.server_address[1]
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+
+# Asyncio SMTP server on localhost with the same counters and fault injection as LocalSMTPSink
+class AsyncLocalSMTPSink:
+  def __init__(self, latency=0.0, error_rate=0.0, error_code=451):
+    self.lock = threading.Lock()
+    self.messages = 0
+    self.recipients = 0
+    self.rejected = 0
+    self.latency = latency
+    self.error_rate = error_rate
+    self.error_code = error_code
+    self.random = random.Random()
+    self.server = None
+    self.port = None
+
+  async def start(self, port=0):
+    self.server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def handle(self, reader, writer):
+    session = LocalSMTPSession(self)
+    writer.write(session.greeting)
+    while not session.closed:
+      line = await reader.readline()
+      if not line: break
+      reply = session.feed(line)
+      if session.delay:
+        await asyncio.sleep(session.delay)
+        session.delay = 0
+      writer.write(reply)
+      await writer.drain()
+    writer.close()
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+# === Metrics ===
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+METRIC_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Escapes a Prometheus label value
+def prometheus_label(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Per-stage latency histograms plus sent/retried/failed counts per sender ID and write-up, for one campaign
+class CampaignMetrics:
+  stages = ("setup", "validate", "csv", "filter", "render", "mime", "progress", "connect", "smtp", "write", "output")
+  statuses = ("sent", "retried", "failed")
+
+  def __init__(self, sender_names, writeup_names, shard=None):
+    self.sender_names = sender_names
+    self.labels = f"shard=\"{shard}\"," if shard is not None else ""
+    self.writeup_names = writeup_names
+    self.lock = threading.Lock()
+    self.buckets = {stage: [0] * len(METRIC_BUCKETS) for stage in self.stages}
+    self.seconds = dict.fromkeys(self.stages, 0.0)
+    self.counts = {status: [[0] * len(writeup_names) for _ in sender_names] for status in self.statuses}
+    self.stopped = threading.Event()
+    self.exporter = None
+    self.export_path = None
+
+  # Records how long one pass through a stage took
+  def observe(self, stage, seconds):
+    with self.lock:
+      self.buckets[stage][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+      self.seconds[stage] += seconds
+
+  # Counts one message as sent, retried or failed
+  def count(self, status, sending_email_index, email_writeup_index):
+    with self.lock:
+      self.counts[status][sending_email_index][email_writeup_index] += 1
+
+  # Upper bound of the bucket holding the q-th quantile of a stage, in milliseconds
+  def quantile(self, stage, q):
+    buckets = self.buckets[stage]
+    rank = q * sum(buckets)
+    seen = 0
+    for bound, count in zip(METRIC_BUCKETS, buckets):
+      seen += count
+      if seen >= rank: return round(bound * 1000, 3) if bound != float("inf") else None
+
+  # Stage timings and message counts as a JSON-ready dict
+  def summary(self):
+    with self.lock:
+      stages = {}
+      for stage in self.stages:
+        count = sum(self.buckets[stage])
+        if count == 0: continue
+        stages[stage] = {
+          "count": count,
+          "seconds": round(self.seconds[stage], 6),
+          "mean_ms": round(self.seconds[stage] / count * 1000, 3),
+          "p50_ms": self.quantile(stage, 0.50),
+          "p90_ms": self.quantile(stage, 0.90),
+          "p99_ms": self.quantile(stage, 0.99),
+          "buckets": list(self.buckets[stage]),
+        }
+      messages = {}
+      for i, sending_email in enumerate(self.sender_names):
+        for j, writeup in enumerate(self.writeup_names):
+          counts = {status: self.counts[status][i][j] for status in self.statuses}
+          if any(counts.values()):
+            messages.setdefault(sending_email, {})[writeup] = counts
+      return {"stages": stages, "messages": messages}
+
+  # Adds another run's summary (a shard's metrics-*.json) into these histograms and counts
+  def add_summary(self, summary):
+    sender_index = {sending_email: i for i, sending_email in enumerate(self.sender_names)}
+    writeup_index = {writeup: j for j, writeup in enumerate(self.writeup_names)}
+    with self.lock:
+      for stage, entry in summary["stages"].items():
+        self.buckets[stage] = [count + added for count, added in zip(self.buckets[stage], entry["buckets"])]
+        self.seconds[stage] += entry["seconds"]
+      for sending_email, writeups in summary["messages"].items():
+        for writeup, counts in writeups.items():
+          for status, count in counts.items():
+            self.counts[status][sender_index[sending_email]][writeup_index[writeup]] += count
+
+  # Stage timings and message counts in the Prometheus text exposition format
+  def prometheus(self):
+    lines = [
+      "# HELP autoemailsendr_stage_seconds Time spent in each campaign stage.",
+      "# TYPE autoemailsendr_stage_seconds histogram",
+    ]
+    with self.lock:
+      for stage in self.stages:
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS, self.buckets[stage]):
+          seen += count
+          lines.append(f"autoemailsendr_stage_seconds_bucket{{{self.labels}stage=\"{stage}\",le=\"{"+Inf" if bound == float("inf") else bound}\"}} {seen}")
+        lines.append(f"autoemailsendr_stage_seconds_sum{{{self.labels}stage=\"{stage}\"}} {self.seconds[stage]}")
+        lines.append(f"autoemailsendr_stage_seconds_count{{{self.labels}stage=\"{stage}\"}} {seen}")
+      lines.append("# HELP autoemailsendr_messages_total Messages sent, retried or failed, by sender ID and write-up.")
+      lines.append("# TYPE autoemailsendr_messages_total counter")
+      for status in self.statuses:
+        for i, sending_email in enumerate(self.sender_names):
+          for j, writeup in enumerate(self.writeup_names):
+            lines.append(f"autoemailsendr_messages_total{{{self.labels}status=\"{status}\",sender=\"{prometheus_label(sending_email)}\",writeup=\"{prometheus_label(writeup)}\"}} {self.counts[status][i][j]}")
+    return "\n".join(lines) + "\n"
+
+  # Rewrites a Prometheus textfile in one rename, so a collector never reads half a file
+  def write_textfile(self, path):
+    textfile = open(path + ".tmp", mode='w', encoding='utf-8')
+    textfile.write(self.prometheus())
+    textfile.close()
+    os.replace(path + ".tmp", path)
+
+  # Rewrites the textfile every interval seconds from a background thread until stop()
+  def export(self, path, interval):
+    def run():
+      while not self.stopped.wait(interval):
+        try:
+          self.write_textfile(path)
+        except OSError:
+          pass
+    self.export_path = path
+    self.exporter = threading.Thread(target=run, daemon=True)
+    self.exporter.start()
+
+  # Stops the textfile exporter after one last rewrite
+  def stop(self):
+    self.stopped.set()
+    if self.exporter is not None:
+      self.exporter.join()
+      self.write_textfile(self.export_path)
+
+# === Campaign ===
+
+# Contacts the campaign is done with: sent now, sent in a previous run, filtered out, rejected as malformed or failed for good
+def handled_contacts(stats):
+  return stats["sent"] + stats["skipped"] + stats["filtered"] + stats["rejected"] + stats["failed"]
+
+# Formats a number of seconds as H:MM:SS ("--:--:--" when unknown)
+def format_duration(seconds):
+  if seconds is None: return "--:--:--"
+  seconds = int(seconds)
+  return f"{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+
+# Live progress for the logging page. The send loop only notes the contact it is on; a renderer thread samples the shared
+# counters ten times a second and redraws the block in place, with throughput, ETA, failures and per-sender counts. When
+# stdout is not a terminal, it prints a plain log line every few seconds instead
+class ConsoleProgress:
+  interval = 0.1
+  log_interval = 5.0
+  rate_window = 5.0
+
+  def __init__(self):
+    self.tty = sys.stdout.isatty()
+    self.stats = None
+    self.current = None
+    self.started = None
+    self.samples = collections.deque()
+    self.stopped = threading.Event()
+    self.renderer = None
+
+  def sending(self, stats, contact_email, email_writeup, sending_email):
+    self.stats = stats
+    self.current = (contact_email, email_writeup, sending_email)
+    if self.renderer is None:
+      self.started = time.monotonic()
+      self.samples.append((self.started, stats["sent"], handled_contacts(stats)))
+      self.renderer = threading.Thread(target=self.render, daemon=True)
+      self.renderer.start()
+
+  def sent(self, stats, latency):
+    pass
+
+  # Emails sent and contacts handled per second, over the last rate_window seconds
+  def rates(self, now):
+    stats = self.stats
+    self.samples.append((now, stats["sent"], handled_contacts(stats)))
+    while now - self.samples[0][0] > self.rate_window and len(self.samples) > 2:
+      self.samples.popleft()
+    first, last = self.samples[0], self.samples[-1]
+    elapsed = last[0] - first[0]
+    if elapsed <= 0: return 0.0, 0.0
+    return (last[1] - first[1]) / elapsed, (last[2] - first[2]) / elapsed
+
+  # The progress block's lines, or a single log line when stdout is not a terminal
+  def lines(self, now):
+    stats = self.stats
+    handled = handled_contacts(stats)
+    sent_rate, handled_rate = self.rates(now)
+    eta = (stats["rows"] - handled) / handled_rate if handled_rate else None
+    senders = sorted(stats.get("senders", {}).items(), key=lambda sender: -sender[1])
+    per_sender = ", ".join(f"{sending_email} {count}" for sending_email, count in senders[:4]) + (f" (+{len(senders) - 4} more)" if len(senders) > 4 else "")
+    if not self.tty:
+      return [time.strftime("%H:%M:%S") + f" {handled}/{stats["rows"]} contacts, {stats["sent"]} sent, {stats["failed"]} failed, {sent_rate:.1f} emails/s, ETA {format_duration(eta)}" + (f", per ID: {per_sender}" if per_sender else "")]
+    loading_percentage = handled / stats["rows"] if stats["rows"] else 1
+    lines = [
+      "   [" + ("█" * round(50*loading_percentage)) + (" " * (50 - round(50*loading_percentage))) + "] " + str(handled) + " out of " + str(stats["rows"]),
+      f"   {sent_rate:.1f} emails/s, ETA {format_duration(eta)}" + (f", {Fore.RED}{stats["failed"]} failed{Style.RESET_ALL}" if stats["failed"] else "") + "".join(f", {stats[key]} {key}" for key in ("skipped", "filtered", "rejected") if stats[key]),
+    ]
+    if self.current is not None:
+      contact_email, email_writeup, sending_email = self.current
+      lines.append("   Currently sending to -> " + Fore.LIGHTBLACK_EX + contact_email + Style.RESET_ALL)
+      lines.append("   Sending write-up from " + Fore.LIGHTBLACK_EX + email_writeup + Style.RESET_ALL)
+      lines.append("   Sending via: " + Fore.LIGHTBLACK_EX + sending_email + Style.RESET_ALL)
+    if per_sender:
+      lines.append("   Sent per ID: " + Fore.LIGHTBLACK_EX + per_sender + Style.RESET_ALL)
+    return lines
+
+  # Cuts a line down to width visible characters, keeping its colour codes, so no line wraps and throws the redraw off
+  def clip(self, line, width):
+    parts = []
+    visible = 0
+    for part in re.split(r"(\033\[[0-9;]*m)", line):
+      if part.startswith("\033"):
+        parts.append(part)
+        continue
+      parts.append(part[:max(width - visible, 0)])
+      visible += len(part)
+    return "".join(parts)
+
+  # Redraws the block (clearing each line's leftovers, then moving the cursor back up) or prints a log line, until finished
+  def render(self):
+    while not self.stopped.wait(self.interval if self.tty else self.log_interval):
+      lines = self.lines(time.monotonic())
+      if self.tty:
+        width = shutil.get_terminal_size().columns - 1
+        sys.stdout.write("".join(self.clip(line, width) + "\033[K\n" for line in lines) + f"\033[{len(lines)}A")
+      else:
+        sys.stdout.write(lines[0] + "\n")
+      sys.stdout.flush()
+
+  # Stops the renderer and clears what is left of the progress block
+  def stop(self):
+    self.stopped.set()
+    if self.renderer is not None: self.renderer.join()
+    if self.tty: sys.stdout.write("\033[J")
+
+  def finished(self, stats):
+    self.stop()
+    elapsed = time.monotonic() - self.started if self.started is not None else 0
+    print("   [" + ("█" * 50) + "] " + str(handled_contacts(stats)) + " out of " + str(stats["rows"]))
+    if elapsed:
+      print(f"   Took {format_duration(elapsed)}, {stats["sent"] / elapsed:.1f} emails/s on average.")
+    if stats["skipped"]:
+      print(f"   {stats["skipped"]} contacts skipped, already sent in a previous run." + (" " * 60))
+    if stats["filtered"]:
+      print(f"   {stats["filtered"]} contacts filtered out as duplicates or suppressed, see output-filtered.csv." + (" " * 40))
+    if stats["rejected"]:
+      print(f"   {stats["rejected"]} contacts rejected as malformed, see output-rejected.csv." + (" " * 50))
+    if stats["failed"]:
+      print(f"   {stats["failed"]} emails failed (refused or out of retries), see output-failed.csv." + (" " * 50))
+    if handled_contacts(stats) < stats["rows"]:
+      print(f"   {stats["sent"]} emails sent, {stats["rows"] - handled_contacts(stats)} left unsent: every sender ID reached its daily cap." + (" " * 50))
+    elif stats["failed"]:
+      print(f"   {stats["sent"]} emails sent." + (" " * 110))
+    else:
+      print(f"   All {stats["rows"]} emails sent!" + (" " * 110))
+
+# Writes progress as JSON lines for headless runs. Like ConsoleProgress, the send loop only hands over the shared counters, and a
+# timer thread writes a line every interval from the first contact on, so lines keep coming while the campaign waits on
+# per-minute caps, a sending window or retries
+class JSONProgress:
+  def __init__(self, interval=1.0, stream=None):
+    self.interval = interval
+    self.stream = stream or sys.stdout
+    self.stats = None
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.timer = None
+
+  def emit(self, event, stats):
+    with self.lock:
+      self.stream.write(json.dumps({"event": event, "time": round(time.time(), 3), **stats}) + "\n")
+      self.stream.flush()
+
+  def sending(self, stats, contact_email, email_writeup, sending_email):
+    self.stats = stats
+    if self.timer is None:
+      self.timer = threading.Thread(target=self.tick, daemon=True)
+      self.timer.start()
+
+  def sent(self, stats, latency):
+    pass
+
+  # Writes a progress line now and then every interval, until stopped
+  def tick(self):
+    while True:
+      self.emit("progress", self.stats)
+      if self.stopped.wait(self.interval): return
+
+  # Stops the timer thread, so nothing is written after the final line
+  def stop(self):
+    self.stopped.set()
+    if self.timer is not None: self.timer.join()
+
+  def finished(self, stats):
+    self.stop()
+    self.emit("finished", stats)
+
+# Runs a whole campaign (or, given a shard, one worker's part of it) from a contacts CSV and returns its row/sent/skipped counts
+def run_campaign(config, contacts_csv, resume=False, progress=None, shard=None):
+  dry_run = config.dry_run.get("enabled", False)
+  if dry_run and shard is None:
+    config = config._replace(journal=False, output_folder=os.path.join(config.output_folder, "dry-run"))
+  if shard is None and int(config.smtp.get("processes", 1)) > 1:
+    if not contacts_csv.endswith(".gz"):
+      return run_sharded_campaign(config, contacts_csv, int(config.smtp["processes"]), resume, progress)
+    # Byte-range shards need a file that can be read from the middle, so a compressed list is sent by this process alone
+    print(f"{os.path.basename(contacts_csv)} is compressed, so it is sent in a single process ([smtp].processes needs an uncompressed .csv).", file=sys.stderr)
+  progress = progress or JSONProgress()
+  output_folder = config.output_folder if shard is None else os.path.join(config.output_folder, f"shard-{shard.index}")
+  
+  # Metrics, only collected when [metrics].enabled is set
+  metrics = None
+  if config.metrics.get("enabled", False):
+    metrics = CampaignMetrics(config.ids, config.writeup_names, shard.index if shard is not None else None)
+  started = time.perf_counter()
+  
+  # Write-up and Sender ID Weights (checked before the contacts file is opened)
+  assignment = AssignmentPlan(config) if shard is None else None
+  
+  # CSV Data
+  contacts = read_contacts(contacts_csv) if shard is None else read_contacts(contacts_csv, shard.start, shard.end)
+  contacts_headers = next(contacts)
+  placeholder_index = []
+  for placeholder_title_header in config.titles:
+    if placeholder_title_header in contacts_headers: placeholder_index.append(contacts_headers.index(placeholder_title_header))
+    else: placeholder_index.append(-1)
+  writeup_templates = [compile_writeup(writeup, config.placeholders, placeholder_index) for writeup in config.writeups]
+  message_parts = writeup_parts(config)
+  email_column = placeholder_index[config.email_placeholder]
+  
+  # Duplicate and Suppression Filters
+  seen_contacts = FingerprintSet() if config.dedupe else None
+  if seen_contacts is not None and shard is not None:
+    seen_contacts.update(shard.duplicates)
+  suppression_list = None
+  if config.suppression:
+    suppression_list = load_suppression_list(config.suppression)
+  if metrics is not None: metrics.observe("setup", time.perf_counter() - started)
+  
+  # Pre-flight Validation, a full scan of the contacts before any connection is opened (sharded campaigns validate before splitting)
+  # The same scan plans every contact's write-up and sender ID, stored as one index per row
+  os.makedirs(output_folder, exist_ok=True)
+  if shard is None:
+    started = time.perf_counter()
+    validation = validate_contacts(contacts_csv, config, output_folder, assignment=assignment)
+    if metrics is not None: metrics.observe("validate", time.perf_counter() - started)
+    if validation["error"] is not None:
+      contacts.close()
+      raise ValueError(validation["error"])
+    writeup_plan, id_plan = assignment.writeups, assignment.ids
+  else:
+    writeup_plan, id_plan = shard.writeups, shard.ids
+  rows = validation["rows"] if shard is None else shard.rows
+  columns = len(contacts_headers)
+  
+  # Output Set-up
+  writeup_outputs = None
+  id_outputs = None
+  if config.segregate_by_writeups:
+    writeup_outputs = OutputWriters(output_folder, config.writeup_names, contacts_headers, resume)
+  if config.segregate_by_ids:
+    id_outputs = OutputWriters(output_folder, config.id_names, contacts_headers, resume)
+  filtered_outputs = None
+  if seen_contacts is not None or suppression_list is not None:
+    filtered_outputs = OutputWriters(output_folder, ["filtered"], contacts_headers + ["Filter Reason"])
+  failed_outputs = OutputWriters(output_folder, ["failed"], contacts_headers + ["Error Code", "Error"], resume)
+  
+  # Send Journal, one for the whole campaign (shards share it, the parent process having already cleared it)
+  journal = None
+  if config.journal:
+    journal_name = "journal-" + contacts_name(contacts_csv) + ".sqlite3"
+    journal = SendJournal(os.path.join(config.output_folder, journal_name), resume or shard is not None)
+  output_lock = threading.Lock()
+  
+  # Progress Counters
+  stats = {"rows": rows, "sent": 0, "skipped": 0, "filtered": 0, "rejected": 0, "failed": 0, "senders": dict.fromkeys(config.ids, 0)}
+  
+  # Domain Scheduler, interleaving recipient domains under their caps and time window (set up once the jobs exist, below)
+  scheduler = None
+  
+  # Called by the SMTP workers once a message has been accepted by the server
+  def on_sent(details):
+    contact_details, email_writeup_index, sending_email_index, prepared_at = details
+    started = time.perf_counter()
+    if id_outputs is not None:
+      id_outputs.write(sending_email_index, contact_details)
+    if writeup_outputs is not None:
+      writeup_outputs.write(email_writeup_index, contact_details)
+    if journal is not None:
+      journal.record(contact_details[email_column], "sent", config.writeups[email_writeup_index], config.ids[sending_email_index])
+    stats["sent"] += 1
+    stats["senders"][config.ids[sending_email_index]] += 1
+    if scheduler is not None: scheduler.finished(contact_details[email_column])
+    if metrics is not None:
+      metrics.observe("output", time.perf_counter() - started)
+      metrics.count("sent", sending_email_index, email_writeup_index)
+    progress.sent(stats, time.perf_counter() - prepared_at)
+  
+  # Called by the SMTP workers when a recipient is refused for good (5xx) or runs out of retries: the dead-letter output-failed.csv
+  def on_failed(details, code, reason):
+    contact_details, email_writeup_index, sending_email_index, prepared_at = details
+    failed_outputs.write(0, contact_details + [code or "", reason])
+    if journal is not None:
+      journal.record(contact_details[email_column], "failed", config.writeups[email_writeup_index], config.ids[sending_email_index])
+    stats["failed"] += 1
+    if scheduler is not None: scheduler.finished(contact_details[email_column])
+  
+  # Sender IDs, each with its own login and quota (a dry run keeps the daily caps but never waits out per-minute ones)
+  sender_settings = [sender_smtp_settings(config, sending_email) for sending_email in config.ids]
+  if dry_run:
+    for smtp_settings in sender_settings: smtp_settings.pop("minute_cap", None)
+  sent_today = [0] * len(config.ids)
+  if journal is not None and resume and shard is None:
+    for sending_email, count in journal.sent_today().items():
+      if sending_email in config.id_index: sent_today[config.id_index[sending_email]] = count
+  scheduling = domain_scheduling(config)
+  sender_scheduler = SenderScheduler(sender_settings, sent_today, integer_weights(config.id_weights, len(config.ids), "id_weights"), scheduling and not dry_run)
+  
+  # Why a contact must not be mailed (duplicate or suppressed), or None if it can be
+  def filter_reason(contact_email):
+    fingerprint = email_fingerprint(normalise_email(contact_email))
+    if suppression_list is not None and fingerprint in suppression_list:
+      return "suppressed"
+    if seen_contacts is not None and not seen_contacts.add(fingerprint):
+      return "duplicate"
+    return None
+  
+  # Yields the contact rows that passed validation, with their row number in the plan (the rest are already in output-rejected.csv)
+  def valid_contacts():
+    for row, contact_details in enumerate(contacts):
+      if contact_problem(contact_details, columns, email_column) is None:
+        yield row, contact_details
+      else:
+        with output_lock:
+          stats["rejected"] += 1
+  
+  # Yields the contacts still to send to, filtering duplicates and suppressed addresses and skipping ones the journal shows as already sent
+  def pending_contacts():
+    started = time.perf_counter()
+    for row, contact_details in valid_contacts():
+      if metrics is not None: metrics.observe("csv", time.perf_counter() - started)
+      reason = None
+      if filtered_outputs is not None:
+        started = time.perf_counter()
+        reason = filter_reason(contact_details[email_column])
+        if metrics is not None: metrics.observe("filter", time.perf_counter() - started)
+      if reason is not None:
+        filtered_outputs.write(0, contact_details + [reason])
+        with output_lock:
+          stats["filtered"] += 1
+      elif resume and journal is not None and journal.is_sent(contact_details[email_column]):
+        with output_lock:
+          stats["skipped"] += 1
+      else:
+        yield row, contact_details
+      started = time.perf_counter()
+  
+  message_factory = MessageFactory()
+  
+  batch_recipients = [max(int(smtp_settings.get("batch_recipients", 1)), 1) for smtp_settings in sender_settings]
+  
+  # Builds the job handed to the send engine: one message for one or more recipients (who only see themselves in To if alone)
+  def make_job(email_writeup, contact_emails, batch):
+    email_writeup_index, sending_email_index = batch[0][1], batch[0][2]
+    sending_email = config.ids[sending_email_index]
+    started = time.perf_counter()
+    message = message_factory.build(sending_email, contact_emails[0] if len(contact_emails) == 1 else "undisclosed-recipients:;", config.subjects[email_writeup_index], email_writeup, *message_parts[email_writeup_index])
+    if metrics is not None: metrics.observe("mime", time.perf_counter() - started)
+    return (sending_email, contact_emails, message, batch)
+  
+  # Renders each contact's planned email and yields the send jobs, stopping once every quota is spent. While every sender is out of
+  # per-minute quota it yields the seconds to wait (a float) instead, for the send engine to sleep or await. With [smtp].batch_recipients > 1,
+  # consecutive contacts whose email comes out identical (same sender ID, write-up and rendered text) share one job, and with
+  # domain scheduling on, only contacts at the same recipient domain do, so each job counts against one domain's caps
+  def campaign_jobs():
+    open_batches = {}
+    for row, contact_details in pending_contacts():
+      contact_email = contact_details[email_column]
+      
+      email_writeup_index = writeup_plan[row]
+      started = time.perf_counter()
+      email_writeup = render_writeup(writeup_templates[email_writeup_index], contact_details)
+      if metrics is not None: metrics.observe("render", time.perf_counter() - started)
+      
+      sending_email_index = sender_scheduler.choose(id_plan[row])
+      while isinstance(sending_email_index, float):
+        yield sending_email_index
+        sending_email_index = sender_scheduler.choose(id_plan[row])
+      if sending_email_index is None:
+        break
+      started = time.perf_counter()
+      progress.sending(stats, contact_email, config.writeups[email_writeup_index], config.ids[sending_email_index])
+      if metrics is not None: metrics.observe("progress", time.perf_counter() - started)
+      
+      details = (contact_details, email_writeup_index, sending_email_index, time.perf_counter())
+      if batch_recipients[sending_email_index] == 1:
+        yield make_job(email_writeup, [contact_email], [details])
+        continue
+      key = (sending_email_index, email_writeup_index, email_domain(contact_email) if scheduling else None)
+      if key in open_batches and (open_batches[key][0] != email_writeup or contact_email in open_batches[key][1]):
+        yield make_job(*open_batches.pop(key))
+      open_batch = open_batches.setdefault(key, (email_writeup, [], []))
+      open_batch[1].append(contact_email)
+      open_batch[2].append(details)
+      if len(open_batch[1]) >= batch_recipients[sending_email_index]:
+        yield make_job(*open_batches.pop(key))
+    for open_batch in open_batches.values():
+      yield make_job(*open_batch)
+  
+  # Email Sending Loop
+  if metrics is not None and config.metrics.get("textfile", ""):
+    metrics.export(config.metrics["textfile"], config.metrics.get("interval", 5))
+  if scheduling and not dry_run:
+    scheduler = DomainScheduler(campaign_jobs(), config.smtp, config.domains, rows, lambda: stats["skipped"] + stats["filtered"] + stats["rejected"], sender_scheduler)
+  try:
+    if dry_run:
+      dry_run_writer = DryRunWriter(config.dry_run, dry_run_path(config, shard.index if shard is not None else None), config.seed, metrics)
+      try:
+        for job in campaign_jobs():
+          if isinstance(job, float):
+            time.sleep(job)
+            continue
+          sending_email, contact_emails, message, batch = job
+          dry_run_writer.add(sending_email, contact_emails, message)
+          for details in batch: on_sent(details)
+      finally:
+        dry_run_writer.close()
+    elif config.smtp.get("engine", "threads") == "asyncio":
+      asyncio.run(send_campaign_async(sender_settings, scheduler.paced_async() if scheduler is not None else campaign_jobs(), on_sent, on_failed, metrics))
+    else:
+      SMTP_pools = {}
+      for smtp_settings in sender_settings:
+        key = smtp_account_key(smtp_settings)
+        if key not in SMTP_pools:
+          SMTP_pools[key] = SMTPPool(smtp_settings, smtp_settings.get("connections", 1), on_sent, on_failed, output_lock, metrics)
+      sender_pools = [SMTP_pools[smtp_account_key(smtp_settings)] for smtp_settings in sender_settings]
+      jobs = campaign_jobs()
+      if scheduler is not None:
+        jobs = scheduler.paced(lambda: any(SMTP_pool.error is not None for SMTP_pool in SMTP_pools.values()))
+      # Every pool is stopped and its workers joined before the journal and outputs are closed, even when one of them failed
+      try:
+        for job in jobs:
+          if isinstance(job, float):
+            time.sleep(job)
+            continue
+          sender_pools[job[3][0][2]].submit(job)
+      except BaseException as error:
+        for SMTP_pool in SMTP_pools.values(): SMTP_pool.stop(error)
+        raise
+      finally:
+        errors = [SMTP_pool.close() for SMTP_pool in SMTP_pools.values()]
+      for error in errors:
+        if error is not None: raise error
+  finally:
+    if journal is not None: journal.close()
+    if id_outputs is not None: id_outputs.close()
+    if writeup_outputs is not None: writeup_outputs.close()
+    if filtered_outputs is not None: filtered_outputs.close()
+    failed_outputs.close()
+    if metrics is not None:
+      metrics.stop()
+      metrics_name = "metrics-" + contacts_name(contacts_csv) + ".json"
+      metrics_file = open(os.path.join(output_folder, metrics_name), mode='w', encoding='utf-8')
+      json.dump({"stats": stats, **metrics.summary()}, metrics_file, indent=2)
+      metrics_file.close()
+  
+  progress.finished(stats)
+  return stats
+
+# === Sharded Campaigns ===
+
+# One worker's byte range of the contacts file, with the fingerprints of its addresses that an earlier shard already has
+# and its rows' part of the AssignmentPlan
+class ContactShard(typing.NamedTuple):
+  index: int
+  start: int
+  end: int
+  rows: int
+  duplicates: array.array
+  writeups: array.array = None
+  ids: array.array = None
+
+# Splits a contacts file into byte ranges of roughly equal size that end on record boundaries, while validate_contacts scans it.
+# Addresses of earlier shards are kept in a FingerprintSet, and the current shard's in a flat array until the shard is closed
+class ShardPlan:
+  def __init__(self, size, count, dedupe=True):
+    self.size = size
+    self.count = count
+    self.shards = []
+    self.start = 0
+    self.rows = 0
+    self.earlier_contacts = FingerprintSet() if dedupe else None
+    self.shard_contacts = array.array("Q")
+    self.duplicates = array.array("Q")
+
+  def begin(self, start):
+    self.start = start
+
+  # Notes a record ending at byte offset end (contact_email is None for rows that failed validation)
+  def add(self, end, contact_email=None):
+    self.rows += 1
+    if contact_email is not None and self.earlier_contacts is not None:
+      fingerprint = email_fingerprint(normalise_email(contact_email))
+      if fingerprint in self.earlier_contacts: self.duplicates.append(fingerprint)
+      else: self.shard_contacts.append(fingerprint)
+    if len(self.shards) < self.count - 1 and end >= self.size * (len(self.shards) + 1) // self.count:
+      self.end(end)
+
+  # Closes the current shard at byte offset end
+  def end(self, end):
+    if self.rows == 0 and self.shards: return
+    self.shards.append(ContactShard(len(self.shards), self.start, end, self.rows, self.duplicates))
+    if self.earlier_contacts is not None:
+      self.earlier_contacts.update(self.shard_contacts)
+    self.start = end
+    self.rows = 0
+    self.shard_contacts = array.array("Q")
+    self.duplicates = array.array("Q")
+
+# A shard worker's share of the config: every daily/per-minute cap, rate ceiling and connection count (per login or per recipient
+# domain) split between the shards.
+# sent_today (sender ID -> count) comes off the daily caps first when resuming; a shard left with no daily quota gets a cap of -1
+def shard_campaign_config(config, index, count, sent_today=None):
+  def share(smtp_settings, sending_email=None):
+    smtp_settings = dict(smtp_settings)
+    if int(smtp_settings.get("daily_cap", 0)) > 0:
+      daily_cap = max(int(smtp_settings["daily_cap"]) - (sent_today or {}).get(sending_email, 0), 0)
+      smtp_settings["daily_cap"] = daily_cap // count + (index < daily_cap % count) or -1
+    if int(smtp_settings.get("minute_cap", 0)) > 0:
+      minute_cap = int(smtp_settings["minute_cap"])
+      smtp_settings["minute_cap"] = max(minute_cap // count + (index < minute_cap % count), 1)
+    if float(smtp_settings.get("max_rate", 0)) > 0:
+      smtp_settings["max_rate"] = float(smtp_settings["max_rate"]) / count
+    if "connections" in smtp_settings:
+      smtp_settings["connections"] = -(-int(smtp_settings["connections"]) // count)
+    if float(smtp_settings.get("domain_max_rate", 0)) > 0:
+      smtp_settings["domain_max_rate"] = float(smtp_settings["domain_max_rate"]) / count
+    if int(smtp_settings.get("domain_concurrency", 0)) > 0:
+      smtp_settings["domain_concurrency"] = -(-int(smtp_settings["domain_concurrency"]) // count)
+    if int(smtp_settings.get("domain_lookahead", 0)) > 0:
+      smtp_settings["domain_lookahead"] = -(-int(smtp_settings["domain_lookahead"]) // count)
+    return types.MappingProxyType(smtp_settings)
+  accounts = {sending_email: share(sender_smtp_settings(config, sending_email), sending_email) for sending_email in config.ids}
+  domains = {domain: share(entry) for domain, entry in config.domains.items()}
+  config = config._replace(smtp=share(config.smtp), accounts=types.MappingProxyType(accounts), domains=types.MappingProxyType(domains))
+  if config.metrics.get("textfile", ""):
+    textfile, extension = os.path.splitext(config.metrics["textfile"])
+    config = override_metrics(config, textfile=f"{textfile}-shard{index}{extension}")
+  if int(config.dry_run.get("sample", 0)) > 0:
+    sample = int(config.dry_run["sample"])
+    config = override_dry_run(config, sample=sample // count + (index < sample % count) or -1)
+  return config
+
+# Forwards a shard worker's progress, with the per-message latencies recorded since the last event, to the parent process
+# at most once per interval
+class ShardProgress:
+  def __init__(self, events, index, interval=0.1):
+    self.events = events
+    self.index = index
+    self.interval = interval
+    self.emitted_at = 0
+    self.stats = None
+    self.latencies = array.array("d")
+
+  # Hands over the latencies recorded since the last event
+  def take_latencies(self):
+    latencies, self.latencies = self.latencies, array.array("d")
+    return latencies
+
+  def sending(self, stats, contact_email, email_writeup, sending_email):
+    self.stats = stats
+    now = time.monotonic()
+    if now - self.emitted_at >= self.interval:
+      self.emitted_at = now
+      self.events.put(("sending", self.index, {**stats, "senders": dict(stats["senders"])}, self.take_latencies(), contact_email, email_writeup, sending_email))
+
+  def sent(self, stats, latency):
+    self.latencies.append(latency)
+
+  def finished(self, stats):
+    self.stats = stats
+
+# Runs one shard in a worker process and reports its counts and error (if any) back on the events queue
+def run_campaign_shard(config, contacts_csv, shard, resume, events):
+  progress = ShardProgress(events, shard.index)
+  stats = None
+  error = None
+  try:
+    stats = run_campaign(config, contacts_csv, resume, progress, shard)
+  except Exception as shard_error:
+    stats = dict(progress.stats) if progress.stats is not None else None
+    error = shard_error
+    try:
+      pickle.dumps(error)
+    except Exception:
+      error = ChildProcessError(f"{type(shard_error).__name__}: {shard_error}")
+  events.put(("finished", shard.index, stats, progress.take_latencies(), error))
+
+# Concatenates the shards' output-*.csv files into the campaign's output folder, keeping a single header
+def merge_shard_outputs(output_folder, shard_folders):
+  names = sorted({name for shard_folder in shard_folders if os.path.isdir(shard_folder) for name in os.listdir(shard_folder) if name.startswith("output-") and name.endswith(".csv")})
+  for name in names:
+    merged_file = open(os.path.join(output_folder, name), mode='wb')
+    header_written = False
+    for shard_folder in shard_folders:
+      if not os.path.exists(os.path.join(shard_folder, name)): continue
+      shard_file = open(os.path.join(shard_folder, name), mode='rb')
+      header = shard_file.readline()
+      if not header_written:
+        merged_file.write(header)
+        header_written = True
+      shutil.copyfileobj(shard_file, merged_file, 1 << 20)
+      shard_file.close()
+    merged_file.close()
+
+# Combines the shards' metrics-*.json summaries into the campaign's own metrics (holding the parent's validation pass)
+# and writes it to the campaign's output folder
+def merge_shard_metrics(metrics, path, shard_paths, stats):
+  for shard_path in shard_paths:
+    if not os.path.exists(shard_path): continue
+    shard_file = open(shard_path, mode='r', encoding='utf-8')
+    metrics.add_summary(json.load(shard_file))
+    shard_file.close()
+  metrics_file = open(path, mode='w', encoding='utf-8')
+  json.dump({"stats": stats, **metrics.summary()}, metrics_file, indent=2)
+  metrics_file.close()
+
+# Appends the shards' dry-run mbox files to the campaign's one, in shard order, and removes them
+def merge_dry_run_mbox(path, shard_paths):
+  merged_file = open(path, mode='ab')
+  for shard_path in shard_paths:
+    if not os.path.exists(shard_path): continue
+    shard_file = open(shard_path, mode='rb')
+    shutil.copyfileobj(shard_file, merged_file, 1 << 20)
+    shard_file.close()
+    os.remove(shard_path)
+  merged_file.close()
+
+# Adds up the shards' progress counters, per-sender counts included
+def sum_shard_stats(shard_stats):
+  stats = {key: sum(shard[key] for shard in shard_stats) for key in shard_stats[0] if key != "senders"}
+  stats["senders"] = dict(sum((collections.Counter(shard["senders"]) for shard in shard_stats), collections.Counter()))
+  return stats
+
+# Runs a campaign across worker processes, one per byte-range shard of the contacts file, and returns the combined counts
+def run_sharded_campaign(config, contacts_csv, processes, resume=False, progress=None):
+  progress = progress or JSONProgress()
+  if contacts_csv.endswith(".gz"):
+    raise ValueError("Sharded campaigns need an uncompressed contacts .csv file.")
+  os.makedirs(config.output_folder, exist_ok=True)
+
+  # Metrics for the validation pass here, joined by the shards' own at the end
+  metrics = None
+  if config.metrics.get("enabled", False):
+    metrics = CampaignMetrics(config.ids, config.writeup_names)
+  started = time.perf_counter()
+
+  # One validation scan splits the file, finds addresses repeated across shards and plans every contact's write-up and sender ID
+  plan = ShardPlan(os.path.getsize(contacts_csv), processes, config.dedupe)
+  assignment = AssignmentPlan(config)
+  validation = validate_contacts(contacts_csv, config, config.output_folder, plan, assignment)
+  if metrics is not None: metrics.observe("validate", time.perf_counter() - started)
+  if validation["error"] is not None:
+    raise ValueError(validation["error"])
+  first_row = 0
+  for i, shard in enumerate(plan.shards):
+    plan.shards[i] = shard._replace(writeups=assignment.writeups[first_row:first_row + shard.rows], ids=assignment.ids[first_row:first_row + shard.rows])
+    first_row += shard.rows
+  
+  # Suppression index and encoded attachments are loaded once here, where a bad file fails before any worker starts
+  # (workers started by fork inherit the encoded attachments instead of encoding them again)
+  if config.suppression:
+    load_suppression_list(config.suppression)
+  writeup_parts(config)
+
+  # The shared journal is cleared (or read for spent quotas) once, here, before the workers open it
+  sent_today = None
+  if config.journal:
+    journal_name = "journal-" + contacts_name(contacts_csv) + ".sqlite3"
+    journal = SendJournal(os.path.join(config.output_folder, journal_name), resume)
+    if resume: sent_today = journal.sent_today()
+    journal.close()
+
+  # Workers
+  events = multiprocessing.Queue()
+  workers = []
+  for shard in plan.shards:
+    shard_config = shard_campaign_config(config, shard.index, len(plan.shards), sent_today)
+    workers.append(multiprocessing.Process(target=run_campaign_shard, args=(shard_config, contacts_csv, shard, resume, events), daemon=True))
+  for worker in workers:
+    worker.start()
+
+  # Progress, summed over the shards
+  shard_stats = [{"rows": shard.rows, "sent": 0, "skipped": 0, "filtered": 0, "rejected": 0, "failed": 0, "senders": {}} for shard in plan.shards]
+  finished = [False] * len(workers)
+  errors = []
+  while not all(finished):
+    try:
+      event = events.get(timeout=1)
+    except queue.Empty:
+      for i, worker in enumerate(workers):
+        if not finished[i] and worker.exitcode not in (None, 0):
+          finished[i] = True
+          errors.append(ChildProcessError(f"Shard {i} worker exited with code {worker.exitcode}."))
+      continue
+    kind, index, stats, latencies = event[:4]
+    if stats is not None: shard_stats[index] = stats
+    stats = sum_shard_stats(shard_stats)
+    for latency in latencies:
+      progress.sent(stats, latency)
+    if kind == "sending":
+      progress.sending(stats, *event[4:])
+    else:
+      finished[index] = True
+      if event[4] is not None: errors.append(event[4])
+  for worker in workers:
+    worker.join()
+
+  shard_folders = [os.path.join(config.output_folder, f"shard-{shard.index}") for shard in plan.shards]
+  merge_shard_outputs(config.output_folder, shard_folders)
+  if metrics is not None:
+    metrics_name = "metrics-" + contacts_name(contacts_csv) + ".json"
+    merge_shard_metrics(metrics, os.path.join(config.output_folder, metrics_name), [os.path.join(shard_folder, metrics_name) for shard_folder in shard_folders], sum_shard_stats(shard_stats))
+  if config.dry_run.get("enabled", False) and config.dry_run.get("format", "maildir") == "mbox":
+    merge_dry_run_mbox(dry_run_path(config), [dry_run_path(config, shard.index) for shard in plan.shards])
+  if errors:
+    raise errors[0]
+  stats = sum_shard_stats(shard_stats)
+  progress.finished(stats)
+  return stats
+
+# === Benchmark ===
+
+# Keeps per-message latencies for the benchmark report and prints nothing
+class BenchmarkProgress:
+  def __init__(self):
+    self.latencies = array.array("d")
+
+  def sending(self, stats, contact_email, email_writeup, sending_email):
+    pass
+
+  def sent(self, stats, latency):
+    self.latencies.append(latency)
+
+  def finished(self, stats):
+    pass
+
+# Runs a LocalSMTPSink in a child process so its CPU time stays out of the measurement
+def serve_local_smtp_sink(pipe, latency, error_rate, error_code):
+  sink = LocalSMTPSink(0, latency, error_rate, error_code)
+  pipe.send(sink.port)
+  pipe.recv()
+  pipe.send({"received": sink.messages, "recipients": sink.recipients, "rejected": sink.rejected})
+
+# Writes a synthetic contacts CSV and write-ups into folder and returns the contacts path with a config to send them
+def make_benchmark_campaign(folder, contacts, writeups, writeup_size, placeholders, smtp_settings, attachment_size=0):
+  titles = ["Email"] + [f"Field{i}" for i in range(1, placeholders)]
+  names = ["email"] + [f"field{i}" for i in range(1, placeholders)]
+  used_names = names if placeholders > 0 else []
+  contacts_csv = os.path.join(folder, "contacts.csv")
+  contacts_file = open(contacts_csv, mode='w', encoding='utf-8', newline='')
+  writer = csv.writer(contacts_file)
+  writer.writerow(titles)
+  for n in range(contacts):
+    writer.writerow([f"user{n}@example{n % 50}.com"] + [f"value {i} for contact {n}" for i in range(1, placeholders)])
+  contacts_file.close()
+  writeup_paths = []
+  for w in range(writeups):
+    words = []
+    while sum(len(word) + 1 for word in words) < writeup_size:
+      words.append("{" + used_names[len(words) % len(used_names)] + "}" if used_names and len(words) % 12 == 0 else "lorem")
+    writeup_paths.append(os.path.join(folder, f"writeup{w}.txt"))
+    writeup_file = open(writeup_paths[-1], mode='w', encoding='utf-8')
+    writeup_file.write(" ".join(words))
+    writeup_file.close()
+  attachments = []
+  if attachment_size:
+    attachments = [os.path.join(folder, "attachment.pdf")]
+    attachment_file = open(attachments[0], mode='wb')
+    attachment_file.write(os.urandom(attachment_size))
+    attachment_file.close()
+  settings_toml = {
+    "smtp": smtp_settings,
+    "emails": {"ids": [f"sender{i}@example.org" for i in range(3)], "subjects": [f"Benchmark {w}" for w in range(writeups)], "writeups": writeup_paths, "isfromfile": [True] * writeups, "attachments": [attachments] * writeups},
+    "csv": {"titles": titles, "placeholders": names, "output_folder": os.path.join(folder, "output"), "segregate_by_writeups": True, "segregate_by_ids": True},
+  }
+  return contacts_csv, campaign_config(settings_toml)
+
+# Sends a synthetic campaign to a local sink and returns throughput, latency, memory and CPU figures
+def run_benchmark(contacts=10000, writeups=3, writeup_size=2000, placeholders=5, connections=4, engine="threads", latency=0.0, error_rate=0.0, error_code=451, processes=1, batch_recipients=1, pipelining=False, attachment_size=0, dry_run=None):
+  parameters = {"contacts": contacts, "writeups": writeups, "writeup_size": writeup_size, "placeholders": placeholders, "connections": connections, "engine": engine, "latency": latency, "error_rate": error_rate, "error_code": error_code, "processes": processes, "batch_recipients": batch_recipients, "pipelining": pipelining, "attachment_size": attachment_size, "dry_run": dry_run}
+  pipe, sink_pipe = multiprocessing.Pipe()
+  sink_process = multiprocessing.Process(target=serve_local_smtp_sink, args=(sink_pipe, latency, error_rate, error_code), daemon=True)
+  sink_process.start()
+  smtp_settings = {"username": "benchmark", "passkey": "benchmark", "smtp_server": "127.0.0.1", "smtp_port": pipe.recv(), "starttls": False, "connections": connections, "engine": engine, "processes": processes, "batch_recipients": batch_recipients, "pipelining": pipelining}
+  with tempfile.TemporaryDirectory() as folder:
+    contacts_csv, config = make_benchmark_campaign(folder, contacts, writeups, writeup_size, placeholders, smtp_settings, attachment_size)
+    if dry_run: config = override_dry_run(config, enabled=True, format=dry_run)
+    progress = BenchmarkProgress()
+    cpu_started = time.process_time() + os.times().children_user + os.times().children_system
+    started = time.perf_counter()
+    error = None
+    try:
+      stats = run_campaign(config, contacts_csv, False, progress)
+    except (OSError, smtplib.SMTPException, ValueError) as send_error:
+      stats = None
+      error = f"{type(send_error).__name__}: {send_error}"
+    seconds = time.perf_counter() - started
+    cpu_seconds = time.process_time() + os.times().children_user + os.times().children_system - cpu_started
+    # The shard workers have been joined by now but the sink hasn't, so the children's peak is the largest worker's
+    peak_rss_kb = shard_peak_rss_kb = None
+    if os.name != 'nt':
+      rss_unit = 1024 if sys.platform == "darwin" else 1
+      peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // rss_unit
+      if processes > 1: shard_peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // rss_unit
+  pipe.send("stop")
+  sink_counts = pipe.recv()
+  sink_process.join()
+  latencies = sorted(progress.latencies)
+  sent = stats["sent"] if stats is not None else len(latencies)
+  percentile = lambda q: round(latencies[int(q * (len(latencies) - 1))] * 1000, 3) if latencies else None
+  return {
+    "parameters": parameters,
+    "time": round(time.time(), 3),
+    "python": sys.version.split()[0],
+    "sent": sent,
+    "seconds": round(seconds, 3),
+    "messages_per_second": round(sent / seconds, 1) if seconds else None,
+    "latency_p50_ms": percentile(0.50),
+    "latency_p99_ms": percentile(0.99),
+    "peak_rss_kb": peak_rss_kb,
+    "shard_peak_rss_kb": shard_peak_rss_kb,
+    "cpu_seconds": round(cpu_seconds, 3),
+    "sink": sink_counts,
+    "stats": stats,
+    "error": error,
+  }
 
 # === Console Graphics ===
 
@@ -130,7 +2860,7 @@ def run_automation_page():
   show_title("Run Automation")
   print("   Enter the .CSV file of your contacts:")
   contacts_csv = input(" > ")
-  contacts_csv += "" if contacts_csv.endswith(".csv") else ".csv"
+  contacts_csv += "" if contacts_csv.endswith((".csv", ".csv.gz")) else ".csv"
   clearscreen()
   show_title("Run Automation / Before We Start...")
   print(f"   {Fore.YELLOW}DISCLAIMER!{Style.RESET_ALL}")
@@ -141,12 +2871,20 @@ def run_automation_page():
   print(f"   {Fore.CYAN}SMTP Settings{Style.RESET_ALL}")
   print(f"   Username: {settings_toml["smtp"]["username"]}")
   print(f"   SMTP Server & Port: {settings_toml["smtp"]["smtp_server"]}:{settings_toml["smtp"]["smtp_port"]}")
+  print(f"   Parallel Connections: {settings_toml["smtp"].get("connections", 1)} ({settings_toml["smtp"].get("engine", "threads")})" + (f", split across {settings_toml["smtp"]["processes"]} processes" if settings_toml["smtp"].get("processes", 1) > 1 else ""))
+  if settings_toml["smtp"].get("batch_recipients", 1) > 1:
+    print(f"   Recipients per Message: up to {settings_toml["smtp"]["batch_recipients"]} when their emails are identical" + (" (pipelined)" if settings_toml["smtp"].get("pipelining", False) else ""))
+  print(f"   Rate Ceiling: {str(settings_toml["smtp"].get("max_rate", 0)) + " emails/s per login" if settings_toml["smtp"].get("max_rate", 0) else "None (adapts to throttling)"}")
+  if settings_toml["smtp"].get("domain_concurrency", 0) or settings_toml["smtp"].get("domain_max_rate", 0) or settings_toml.get("domains"):
+    print(f"   Per Recipient Domain: {str(settings_toml["smtp"].get("domain_concurrency", 0)) + " in flight" if settings_toml["smtp"].get("domain_concurrency", 0) else "No concurrency cap"}, {str(settings_toml["smtp"].get("domain_max_rate", 0)) + " emails/s" if settings_toml["smtp"].get("domain_max_rate", 0) else "no rate cap"}" + (f" ({len(settings_toml.get("domains", {}))} domains overridden)" if settings_toml.get("domains") else ""))
+  if settings_toml["smtp"].get("window_hours", 0):
+    print(f"   Time Window: spread over {settings_toml["smtp"]["window_hours"]} hours")
   print("")
   print(f"   {Fore.CYAN}Email IDs and Write-ups{Style.RESET_ALL}")
   print(f"   {len(settings_toml["emails"]["ids"])} Email IDs: [", end='')
   for i, email_id in enumerate(settings_toml["emails"]["ids"]):
     if i % 4 == 0: print("\n     ", end='')
-    print(email_id + ", ", end='')
+    print(email_id + (" (own login)" if email_id in settings_toml.get("accounts", {}) else "") + ", ", end='')
   print("\n   ]")
   print(f"   {len(settings_toml["emails"]["writeups"])} Email Write-ups: [", end='')
   for i, writeup in enumerate(settings_toml["emails"]["writeups"]):
@@ -163,137 +2901,65 @@ def run_automation_page():
   print("   Filter based on Write-ups? " + ('Yes' if settings_toml["csv"]["segregate_by_writeups"] else 'No'))
   print("   Filter based on Email IDs? " + ('Yes' if settings_toml["csv"]["segregate_by_ids"] else 'No'))
   print("   Output .CSV folder: " + settings_toml["csv"]["output_folder"])
+  print("   Skip duplicate addresses? " + ('Yes' if settings_toml["csv"].get("dedupe", True) else 'No'))
+  print("   Suppression list: " + (settings_toml["csv"].get("suppression", "") or "None"))
   print("")
   print("   Contacts List .CSV file: " + contacts_csv)
+  assignment = None
+  try:
+    config = load_campaign_config()
+    assignment = AssignmentPlan(config)
+    validation = validate_contacts(contacts_csv, config, assignment=assignment)
+  except OSError as error:
+    validation = {"error": f"Could not read the contacts file ({error.strerror})."}
+  except ValueError as error:
+    validation = {"error": str(error)}
+  if validation["error"] is not None:
+    print(f"   {Fore.RED}{validation["error"]}{Style.RESET_ALL}")
+    print("")
+    input("   Press Enter to return...")
+    main_page()
+    return
+  print(f"   {validation["rows"]} contacts, {validation["valid"]} valid" + (f", {Fore.YELLOW}{validation["rejected"]} will be skipped{Style.RESET_ALL} (" + ", ".join(f"{count} {reason}" for reason, count in validation["reasons"].items()) + ")" if validation["rejected"] else ""))
+  if validation["missing_titles"]:
+    print(f"   {Fore.YELLOW}Columns not in the file, their placeholders stay as-is:{Style.RESET_ALL} " + ", ".join(validation["missing_titles"]))
+  plan = validation["plan"]
+  print(f"   Planned split (seed {plan["seed"]}" + (f", balanced within each of {plan["strata"]} {plan["stratify"]} values" if plan["stratify"] else "") + "):")
+  for writeup in plan["writeups"]:
+    print(f"     {writeup["writeup"]}: {writeup["contacts"]} contacts ({writeup["contacts"] * 100 / max(validation["valid"], 1):.1f}%)")
+  for sender in plan["ids"]:
+    print(f"     {sender["id"]}: {sender["contacts"]} contacts ({sender["contacts"] * 100 / max(validation["valid"], 1):.1f}%)")
   print("")
-  proceed = display_menu(['Back to Safety', 'Yes, Let\'s Do It!'], 0)
+  proceed = display_menu(['Back to Safety', 'Yes, Let\'s Do It!', 'Resume Previous Run (skip already sent)', f'Dry Run (write every message to a {settings_toml.get("dry_run", {}).get("format", "maildir")} instead of sending)'], 0)
   if proceed == 0:
     main_page()
   else:
-    logging_page(contacts_csv)
+    logging_page(contacts_csv, proceed == 2, assignment.seed, proceed == 3)
 
-# Logging Page
-def logging_page(contacts_csv):
-  settings_toml = get_toml_data()
+# Logging Page, sending with the plan seed shown on the page before so the split matches the preview
+def logging_page(contacts_csv, resume=False, seed=None, dry_run=False):
+  config = load_campaign_config()
+  if seed: config = config._replace(seed=seed)
+  if dry_run: config = override_dry_run(config, enabled=True)
   clearscreen()
-  show_title("Run Automation / Logging Page (Running)")
-  
-  # CSV Data
-  contacts_file = open(contacts_csv, mode='r', encoding='utf-8')
-  contacts = contacts_file.readlines()
-  contacts_headers = contacts[0].replace('\n', '').split(",")
-  rows = len(contacts) - 1
-  columns = len(contacts_headers)
-  placeholder_index = []
-  for placeholder_title_header in settings_toml["csv"]["titles"]:
-    if placeholder_title_header in contacts_headers: placeholder_index.append(contacts_headers.index(placeholder_title_header))
-    else: placeholder_index.append(-1)
-  contacts.pop(0)
-  
-  # Output Set-up
-  cwd = os.getcwd() + "\\"
-  writeup_outputs = None
-  writeup_output_data = []
-  id_outputs = None
-  id_output_data = []
-  output_path = cwd + settings_toml["csv"]["output_folder"]
-  if not os.path.exists(output_path):
-    os.makedirs(output_path)
-  if settings_toml["csv"]["segregate_by_writeups"]:
-    writeup_outputs = []
-    for file in settings_toml["emails"]["writeups"]:
-      try:
-        filex = open(".\\" + settings_toml["csv"]["output_folder"] + "\\output-" + file.split(".")[0] + ".csv", mode='x')
-        filex.close()
-      except:
-        pass
-      filex = open(".\\" + settings_toml["csv"]["output_folder"] + "\\output-" + file.split(".")[0] + ".csv", mode='w', encoding='utf-8')
-      filex.write(",".join(contacts_headers))
-      writeup_outputs.append(filex)
-      writeup_output_data.append(",".join(contacts_headers))
-  if settings_toml["csv"]["segregate_by_ids"]:
-    id_outputs = []
-    for file in settings_toml["emails"]["ids"]:
-      try:
-        filex = open(".\\" + settings_toml["csv"]["output_folder"] + "\\output-" + file.split("@")[0] + ".csv", mode='x')
-        filex.close()
-      except:
-        pass
-      filex = open(".\\" + settings_toml["csv"]["output_folder"] + "\\output-" + file.split("@")[0] + ".csv", mode='w', encoding='utf-8')
-      filex.write(",".join(contacts_headers))
-      id_outputs.append(filex)
-      id_output_data.append(",".join(contacts_headers))
-  
-  #Email SMTP Set-up
-  SMTP_server = smtplib.SMTP(settings_toml["smtp"]["smtp_server"], settings_toml["smtp"]["smtp_port"])
-  SMTP_server.ehlo()
-  SMTP_server.starttls()
-  
-  SMTP_server.login(settings_toml["smtp"]["username"], settings_toml["smtp"]["passkey"])
-  
-  # Loading Screen
-  emails_sent = 0
-  loading_percentage = emails_sent/rows
+  show_title("Run Automation / Logging Page (Running)" if not dry_run else "Run Automation / Logging Page (Dry Run)")
   print("")
-  
-  # Email Sending Loop
-  for contact in contacts:
-    print("   [" + ("█" * round(50*loading_percentage)) + (" " * round(50*(1-loading_percentage))) + "] " + str(emails_sent) + " out of " + str(rows) + (" " * 15))
-    
-    contact_details = contact.replace('\n', '').split(",")
-    
-    contact_email = contact_details[placeholder_index[settings_toml["csv"]["placeholders"].index("email")]]
-    print("   Currently sending to -> " + Fore.LIGHTBLACK_EX + contact_email + Style.RESET_ALL + (" " * (133 - len(contact_email))))
-    
-    email_writeup = random.choice(settings_toml["emails"]["writeups"])
-    email_writeup_index = settings_toml["emails"]["writeups"].index(email_writeup)
-    print("   Sending write-up from " + Fore.LIGHTBLACK_EX + email_writeup + Style.RESET_ALL)
-    email_writeup = str(open(email_writeup, mode='r', encoding='utf-8').read())
-    for i, placehold in enumerate(placeholder_index):
-      if placehold == -1: pass
-      else:
-        email_writeup = email_writeup.replace(("{" + settings_toml["csv"]["placeholders"][i] + "}"), (contact_details[placehold]))
-    email_subject = settings_toml["emails"]["subjects"][email_writeup_index]
-    
-    sending_email = random.choice(settings_toml["emails"]["ids"])
-    sending_email_index = settings_toml["emails"]["ids"].index(sending_email)
-    print("   Sending via: " + Fore.LIGHTBLACK_EX + sending_email + Style.RESET_ALL)
-    
-    message = MIMEMultipart("alternative")
-    message['Subject'] = email_subject
-    message['From'] = sending_email
-    message['To'] = contact_email
-    message.attach(MIMEText(email_writeup))
-    
-    SMTP_server.send_message(
-      from_addr=sending_email,
-      to_addrs=contact_email,
-      msg=message
-    )
-    
-    if settings_toml["csv"]["segregate_by_ids"]:
-      id_output_data[sending_email_index] += "\n" + ",".join(contact_details)
-      id_outputs[sending_email_index].write("\n" + ",".join(contact_details))
-    if settings_toml["csv"]["segregate_by_writeups"]:
-      writeup_output_data[email_writeup_index] += "\n" + ",".join(contact_details)
-      writeup_outputs[email_writeup_index].write("\n" + ",".join(contact_details))
-    
-    emails_sent += 1
-    loading_percentage = emails_sent/rows
-    print("\033[6A" if loading_percentage == 1 else "\033[6A")
-  
-  if settings_toml["csv"]["segregate_by_ids"]:
-    for filex in id_outputs:
-      filex.close()
-  if settings_toml["csv"]["segregate_by_writeups"]:
-    for filex in writeup_outputs:
-      filex.close()
-  
-  print("   [" + ("█" * 50) + "] " + str(emails_sent) + " out of " + str(rows))
-  print(f"   All {rows} emails sent!" + (" " * 110))
+  progress = ConsoleProgress()
+  try:
+    run_campaign(config, contacts_csv, resume, progress)
+  except (OSError, smtplib.SMTPException, ValueError) as error:
+    progress.stop()
+    print("")
+    print(f"   {Fore.RED}The campaign stopped: {type(error).__name__}: {error}{Style.RESET_ALL}")
+    print("")
+    input("   Press Enter to return...")
+    main_page()
+    return
   
   print(" " * 100)
   print(" " * 100)
+  if dry_run:
+    print(f"   Messages written to {dry_run_path(config._replace(output_folder=os.path.join(config.output_folder, "dry-run")))}")
   print(" " * 100)
   input("   Press Enter to return...")
   main_page()
@@ -346,7 +3012,7 @@ def settings_page(tried: bool = False):
       clearscreen()
       show_title(f"Settings / {options[2]}")
       print(f"   {len(settings_toml["emails"]["ids"])} Email IDs found")
-      print(f" > {Fore.LIGHTBLACK_EX}These email IDs are what are used to send emails (will be sent randomly).{Style.RESET_ALL}\n")
+      print(f" > {Fore.LIGHTBLACK_EX}These email IDs are what are used to send emails (balanced by remaining quota).{Style.RESET_ALL}\n")
       print(f"   {len(settings_toml["emails"]["writeups"])} Write-ups found")
       print(f" > {Fore.LIGHTBLACK_EX}These write-ups are the content of the emails to be sent (will be sent randomly).{Style.RESET_ALL}\n")
       print("   Choose what variable to edit: \n")
@@ -378,6 +3044,7 @@ def settings_page(tried: bool = False):
             new_input_data = input(" > ")
             if new_input_data.strip() != "":
               settings_toml["emails"]["ids"].append(new_input_data)
+              if settings_toml["emails"].get("id_weights"): settings_toml["emails"]["id_weights"].append(1)
               save_to_toml(settings_toml)
           else:
             print(f"   Edit the email address at use. {Fore.LIGHTBLACK_EX}({settings_toml["emails"]["ids"][email_id_selection - 1]}){Style.RESET_ALL}")
@@ -388,6 +3055,7 @@ def settings_page(tried: bool = False):
               save_to_toml(settings_toml)
             if new_input_data.strip() == "delete":
               settings_toml["emails"]["ids"].pop(email_id_selection - 1)
+              if settings_toml["emails"].get("id_weights"): settings_toml["emails"]["id_weights"].pop(email_id_selection - 1)
               save_to_toml(settings_toml)
       elif emails_selection == 2:
         while True:
@@ -416,6 +3084,8 @@ def settings_page(tried: bool = False):
             settings_toml["emails"]["subjects"].append(new_input_data_subjects)
             settings_toml["emails"]["writeups"].append(new_input_data_writeup)
             settings_toml["emails"]["isfromfile"].append(True)
+            if settings_toml["emails"].get("writeup_weights"): settings_toml["emails"]["writeup_weights"].append(1)
+            if settings_toml["emails"].get("attachments"): settings_toml["emails"]["attachments"].append([])
             save_to_toml(settings_toml)
           else:
             print("   Edit the subject to a new email write-up to use.")
@@ -428,6 +3098,8 @@ def settings_page(tried: bool = False):
               settings_toml["emails"]["subjects"].pop(writeup_selection - 1)
               settings_toml["emails"]["writeups"].pop(writeup_selection - 1)
               settings_toml["emails"]["isfromfile"].pop(writeup_selection - 1)
+              if settings_toml["emails"].get("writeup_weights"): settings_toml["emails"]["writeup_weights"].pop(writeup_selection - 1)
+              if len(settings_toml["emails"].get("attachments", [])) >= writeup_selection: settings_toml["emails"]["attachments"].pop(writeup_selection - 1)
               break
             print("   Edit the body of a new email write-up to use. (Filepath only, UTF-8 encoding)")
             print("   " + Fore.LIGHTBLACK_EX + ((settings_toml["emails"]["writeups"][writeup_selection - 1][0:50] + "...") if len(settings_toml["emails"]["writeups"][writeup_selection - 1]) > 52 else settings_toml["emails"]["writeups"][writeup_selection - 1]).replace('\n', ' ').replace('\r', '') + Style.RESET_ALL)
@@ -435,6 +3107,16 @@ def settings_page(tried: bool = False):
             new_input_data_writeup = input(" > ")
             if new_input_data_writeup.strip() == "":
               new_input_data_writeup = settings_toml["emails"]["writeups"][writeup_selection - 1]
+            attachments = settings_toml["emails"].setdefault("attachments", [])
+            attachments += [[] for _ in range(len(settings_toml["emails"]["writeups"]) - len(attachments))]
+            print("   Edit the attachments of this write-up. (Comma-separated filepaths; an .html write-up shows \"cid:<filename>\" ones inline)")
+            print("   " + Fore.LIGHTBLACK_EX + (", ".join(attachments[writeup_selection - 1]) or "No attachments") + Style.RESET_ALL)
+            print("   Return <empty> to discard this change. Return \"none\" to remove all attachments.")
+            new_input_data_attachments = input(" > ")
+            if new_input_data_attachments.strip() == "none":
+              attachments[writeup_selection - 1] = []
+            elif new_input_data_attachments.strip() != "":
+              attachments[writeup_selection - 1] = [path.strip() for path in new_input_data_attachments.split(",") if path.strip()]
             settings_toml["emails"]["subjects"][writeup_selection - 1] = new_input_data_subjects
             settings_toml["emails"]["writeups"][writeup_selection - 1] = new_input_data_writeup
             settings_toml["emails"]["isfromfile"][writeup_selection - 1] = True
@@ -559,10 +3241,11 @@ def main_page():
   clearscreen()
   show_title("Main Page")
   print("   Choose what action to perform: \n")
-  options = ['Run Automation', f'Settings {f'{Fore.RED}[Incomplete]{Style.RESET_ALL}' if is_toml_empty() else f'{Fore.GREEN}[OK]{Style.RESET_ALL}'}', 'Credits', 'Quit App']
+  settings_incomplete = is_toml_empty()
+  options = ['Run Automation', f'Settings {f'{Fore.RED}[Incomplete]{Style.RESET_ALL}' if settings_incomplete else f'{Fore.GREEN}[OK]{Style.RESET_ALL}'}', 'Credits', 'Quit App']
   selection = display_menu(options, 0)
   if selection == 0:
-    if is_toml_empty():
+    if settings_incomplete:
       settings_page(True)
     else:
       run_automation_page()
@@ -574,6 +3257,110 @@ def main_page():
     clearscreen()
     quit(0)
 
+# === Command Line ===
+
+# Parses the headless command line, e.g. app.py send contacts.csv --config settings.toml --workers 8
+def parse_arguments(arguments):
+  parser = argparse.ArgumentParser(prog="app.py", description="Automatic email mass-sender, for outreach and campaigns.")
+  commands = parser.add_subparsers(dest="command", required=True)
+  send = commands.add_parser("send", help="run a campaign without the interactive menus, printing JSON progress lines")
+  send.add_argument("contacts_csv", help="contacts list (.csv or .csv.gz)")
+  send.add_argument("--config", default=str(SETTINGS_PATH), help="settings file (default: settings.toml next to app.py)")
+  send.add_argument("--workers", type=int, help="SMTP connections per login, overrides [smtp].connections")
+  send.add_argument("--engine", choices=["threads", "asyncio"], help="overrides [smtp].engine")
+  send.add_argument("--processes", type=int, help="worker processes, each sending one shard of the contacts, overrides [smtp].processes")
+  send.add_argument("--batch-recipients", type=int, help="recipients per transaction for identical messages, overrides [smtp].batch_recipients")
+  send.add_argument("--pipelining", action="store_true", help="pipeline MAIL/RCPT commands when the server supports it, overrides [smtp].pipelining")
+  send.add_argument("--domain-concurrency", type=int, help="recipients in flight per recipient domain, overrides [smtp].domain_concurrency")
+  send.add_argument("--domain-max-rate", type=float, help="emails/s per recipient domain, overrides [smtp].domain_max_rate")
+  send.add_argument("--window-hours", type=float, help="spread the campaign evenly over this many hours, overrides [smtp].window_hours")
+  send.add_argument("--resume", action="store_true", help="skip contacts the journal shows as already sent")
+  send.add_argument("--dry-run", choices=["maildir", "mbox"], help="render every message into a Maildir or mbox instead of sending (outputs go to <output folder>/dry-run)")
+  send.add_argument("--dry-run-path", help="Maildir folder or mbox file for --dry-run, overrides [dry_run].path")
+  send.add_argument("--sample", type=int, help="with --dry-run, keep only a random sample of this many messages, overrides [dry_run].sample")
+  send.add_argument("--suppression", help="file of addresses never to mail, overrides [csv].suppression")
+  send.add_argument("--seed", type=int, help="seed for the write-up/sender ID plan, e.g. one from a validate report, overrides [emails].seed")
+  send.add_argument("--progress-interval", type=float, default=1.0, help="seconds between progress lines (default: 1)")
+  send.add_argument("--metrics", action="store_true", help="time each stage and write a metrics-<contacts>.json summary to the output folder")
+  send.add_argument("--metrics-textfile", help="Prometheus textfile to rewrite during the run (implies --metrics)")
+  validate = commands.add_parser("validate", help="check a contacts file against the settings without sending, printing a JSON report")
+  validate.add_argument("contacts_csv", help="contacts list (.csv or .csv.gz)")
+  validate.add_argument("--config", default=str(SETTINGS_PATH), help="settings file (default: settings.toml next to app.py)")
+  validate.add_argument("--seed", type=int, help="seed for the write-up/sender ID plan, overrides [emails].seed")
+  bench = commands.add_parser("bench", help="send a synthetic campaign to a local SMTP sink and report throughput as JSON")
+  bench.add_argument("--contacts", type=int, default=10000, help="synthetic contacts to send (default: 10000)")
+  bench.add_argument("--writeups", type=int, default=3, help="synthetic write-ups (default: 3)")
+  bench.add_argument("--writeup-size", type=int, default=2000, help="characters per write-up (default: 2000)")
+  bench.add_argument("--placeholders", type=int, default=5, help="placeholders used in the write-ups, including email; 0 sends everyone the same text (default: 5)")
+  bench.add_argument("--workers", type=int, default=4, help="SMTP connections (default: 4)")
+  bench.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+  bench.add_argument("--processes", type=int, default=1, help="worker processes sharing the contacts (default: 1)")
+  bench.add_argument("--batch-recipients", type=int, default=1, help="recipients per transaction for identical messages (default: 1)")
+  bench.add_argument("--pipelining", action="store_true", help="pipeline MAIL/RCPT commands")
+  bench.add_argument("--attachment-size", type=int, default=0, help="bytes of a synthetic attachment on every write-up (default: none)")
+  bench.add_argument("--dry-run", choices=["maildir", "mbox"], help="render into a Maildir or mbox instead of sending, to measure rendering alone")
+  bench.add_argument("--latency", type=float, default=0.0, help="seconds the sink waits before accepting each message")
+  bench.add_argument("--error-rate", type=float, default=0.0, help="fraction of recipients the sink rejects")
+  bench.add_argument("--error-code", type=int, default=451, help="reply code for rejected recipients (default: 451)")
+  bench.add_argument("--out", help="JSON results file (default: bench-<timestamp>.json)")
+  return parser.parse_args(arguments)
+
+# Runs a headless command and returns the process exit code
+def command_line(arguments):
+  args = parse_arguments(arguments)
+  if args.command == "bench":
+    results = run_benchmark(args.contacts, args.writeups, args.writeup_size, args.placeholders, args.workers, args.engine, args.latency, args.error_rate, args.error_code, args.processes, args.batch_recipients, args.pipelining, args.attachment_size, args.dry_run)
+    results_file = open(args.out or time.strftime("bench-%Y%m%d-%H%M%S.json"), mode='w', encoding='utf-8')
+    json.dump(results, results_file, indent=2)
+    results_file.close()
+    print(json.dumps(results))
+    return 0 if results["error"] is None else 1
+  if args.command == "validate":
+    try:
+      config = load_campaign_config(args.config)
+      if args.seed: config = config._replace(seed=args.seed)
+      os.makedirs(config.output_folder, exist_ok=True)
+      report = validate_contacts(args.contacts_csv, config, config.output_folder, assignment=AssignmentPlan(config))
+    except (OSError, ValueError) as error:
+      print(json.dumps({"event": "error", "error": f"{type(error).__name__}: {error}"}), file=sys.stderr)
+      return 1
+    print(json.dumps(report))
+    return 0 if report["error"] is None else 1
+  try:
+    settings_toml = get_toml_data(args.config)
+    if is_toml_empty(settings_toml):
+      print(json.dumps({"event": "error", "error": f"Important settings in {args.config} are not yet completed."}), file=sys.stderr)
+      return 2
+    config = load_campaign_config(args.config)
+  except (OSError, ValueError, KeyError) as error:
+    print(json.dumps({"event": "error", "error": f"{type(error).__name__}: {error}"}), file=sys.stderr)
+    return 2
+  if args.workers: config = override_smtp(config, connections=args.workers)
+  if args.engine: config = override_smtp(config, engine=args.engine)
+  if args.processes: config = override_smtp(config, processes=args.processes)
+  if args.batch_recipients: config = override_smtp(config, batch_recipients=args.batch_recipients)
+  if args.pipelining: config = override_smtp(config, pipelining=True)
+  if args.domain_concurrency: config = override_smtp(config, domain_concurrency=args.domain_concurrency)
+  if args.domain_max_rate: config = override_smtp(config, domain_max_rate=args.domain_max_rate)
+  if args.window_hours: config = override_smtp(config, window_hours=args.window_hours)
+  if args.suppression: config = config._replace(suppression=args.suppression)
+  if args.seed: config = config._replace(seed=args.seed)
+  if args.dry_run: config = override_dry_run(config, enabled=True, format=args.dry_run)
+  if args.dry_run_path: config = override_dry_run(config, path=args.dry_run_path)
+  if args.sample: config = override_dry_run(config, sample=args.sample)
+  if args.metrics: config = override_metrics(config, enabled=True)
+  if args.metrics_textfile: config = override_metrics(config, enabled=True, textfile=args.metrics_textfile)
+  progress = JSONProgress(args.progress_interval)
+  try:
+    stats = run_campaign(config, args.contacts_csv, args.resume, progress)
+  except (OSError, smtplib.SMTPException, ValueError) as error:
+    progress.stop()
+    print(json.dumps({"event": "error", "error": f"{type(error).__name__}: {error}"}), file=sys.stderr)
+    return 1
+  return 0 if handled_contacts(stats) >= stats["rows"] else 3
+
 if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    sys.exit(command_line(sys.argv[1:]))
   os.system('mode con: cols=133 lines=47')
   main_page()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import pytest
+
+import app
+from test_campaign_config import settings
+
+# An AssignmentPlan for the given [emails] values, with every row of contact_rows (None for a rejected row) added
+def plan_rows(contact_rows, **emails):
+  config = app.campaign_config(settings(emails))
+  assignment = app.AssignmentPlan(config)
+  assignment.begin(["Email"], 0)
+  for contact_details in contact_rows:
+    assignment.add(contact_details)
+  assignment.end()
+  return assignment
+
+# One row per address
+def rows(contact_emails):
+  return [[contact_email] for contact_email in contact_emails]
+
+@pytest.mark.parametrize("weights, expected", [
+  ([], [1, 1]),
+  ([0.75, 0.25], [3, 1]),
+  ([30, 10], [3, 1]),
+  ([2, 0], [1, 0]),
+  (["0.5", 1.5], [1, 3]),
+])
+# Weights come out as the smallest whole numbers in the same ratio
+def test_integer_weights(weights, expected):
+  assert app.integer_weights(weights, 2, "id_weights") == expected
+
+@pytest.mark.parametrize("weights", [[1], [1, -1], [0, 0], ["a", 1]])
+# Weights of the wrong count, negative, all zero or not numbers are refused, naming the setting
+def test_integer_weights_refuses_bad_lists(weights):
+  with pytest.raises(ValueError, match="id_weights"):
+    app.integer_weights(weights, 2, "id_weights")
+
+# The same seed plans the same write-up and sender ID for every row, and another seed a different plan
+def test_same_seed_gives_the_same_plan():
+  contact_rows = rows(f"u{n}@example.com" for n in range(2000))
+  first = plan_rows(contact_rows, seed=7)
+  second = plan_rows(contact_rows, seed=7)
+  assert first.writeups == second.writeups
+  assert first.ids == second.ids
+  assert plan_rows(contact_rows, seed=8).writeups != first.writeups
+
+# With [3, 1] weights, every prefix of the file is within one block of a 75/25 split, rejected rows left unassigned
+def test_weights_hold_at_every_prefix():
+  contact_rows = [None if n % 7 == 0 else [f"u{n}@example.com"] for n in range(4000)]
+  assignment = plan_rows(contact_rows, seed=3, writeup_weights=[3, 1], id_weights=[1, 3])
+  assert [n for n, writeup in enumerate(assignment.writeups) if writeup == app.UNASSIGNED] == [n for n, contact_details in enumerate(contact_rows) if contact_details is None]
+  firsts, planned = 0, 0
+  for email_writeup_index, sending_email_index in zip(assignment.writeups, assignment.ids):
+    if email_writeup_index == app.UNASSIGNED: continue
+    planned += 1
+    firsts += email_writeup_index == 0
+    assert abs(4 * firsts - 3 * planned) <= 3
+  assert sum(sending_email_index == 1 for sending_email_index in assignment.ids) * 4 == planned * 3
+
+# An ID weighted 0 is never planned, and never chosen by the sender scheduler even once the others run out of quota
+def test_zero_weight_is_never_used():
+  assignment = plan_rows(rows(f"u{n}@example.com" for n in range(500)), id_weights=[1, 0])
+  assert set(assignment.ids) == {0}
+  assert assignment.preview()["ids"][1]["contacts"] == 0
+  scheduler = app.SenderScheduler([{"daily_cap": 5}, {}], weights=[1, 0])
+  assert [scheduler.choose(1) for _ in range(6)] == [0, 0, 0, 0, 0, None]
+
+# stratify = "domain" keeps the split balanced within each recipient domain, however unevenly the domains are mixed
+def test_stratified_plan_balances_each_domain():
+  contact_emails = [f"u{n}@" + ("gmail.com" if n % 5 < 3 else "yahoo.com" if n % 5 == 3 else "example.org") for n in range(3000)]
+  assignment = plan_rows(rows(contact_emails), seed=5, stratify="domain")
+  assert assignment.strata_count == 3
+  balance = {}
+  for contact_email, email_writeup_index, sending_email_index in zip(contact_emails, assignment.writeups, assignment.ids):
+    counts = balance.setdefault(contact_email.rpartition("@")[2], [0, 0])
+    counts[0] += 1 if email_writeup_index == 0 else -1
+    counts[1] += 1 if sending_email_index == 0 else -1
+    assert abs(counts[0]) <= 1 and abs(counts[1]) <= 1
@@ -0,0 +1,133 @@
+import asyncio
+import smtplib
+
+import pytest
+
+import app
+
+# [smtp] settings for a sender ID logging in to a local sink
+def sink_settings(port, **extra):
+  return {"smtp_server": "127.0.0.1", "smtp_port": port, "username": "u", "passkey": "p", "starttls": False, "connections": 2, "retry_backoff": 0.01, **extra}
+
+# One job per recipient (or one batched job for several), built the way run_campaign builds them
+def make_jobs(contact_groups, sending_email_index=0):
+  factory = app.MessageFactory()
+  jobs = []
+  for contact_emails in contact_groups:
+    message = factory.build("a@sender.com", contact_emails[0] if len(contact_emails) == 1 else "undisclosed-recipients:;", "Hello", "Hi\n.dotted\n")
+    jobs.append(("a@sender.com", contact_emails, message, [([contact_email], 0, sending_email_index, 0.0) for contact_email in contact_emails]))
+  return jobs
+
+# Runs send_campaign_async against an AsyncLocalSMTPSink on the same event loop, returning the sink and the sent/failed addresses
+def send_through_sink(jobs, sink_options=None, **smtp_extra):
+  sent, failed = [], []
+
+  async def main():
+    sink = app.AsyncLocalSMTPSink(**(sink_options or {}))
+    await sink.start()
+    try:
+      sender_settings = [sink_settings(sink.port, **smtp_extra), sink_settings(sink.port, **smtp_extra)]
+      await app.send_campaign_async(sender_settings, jobs, lambda details: sent.append(details[0][0]), lambda details, code, reason: failed.append((details[0][0], code)))
+    finally:
+      await sink.close()
+    return sink
+
+  return asyncio.run(main()), sent, failed
+
+@pytest.mark.parametrize("pipelining", [False, True])
+# Every recipient reaches the sink, single and batched jobs alike, with or without pipelining
+def test_send_campaign_async_delivers_everything(pipelining):
+  contact_groups = [[f"u{i}@example.com"] for i in range(20)] + [["b1@example.com", "b2@example.com", "b3@example.com"]]
+  sink, sent, failed = send_through_sink(make_jobs(contact_groups), pipelining=pipelining)
+  assert sink.messages == 21
+  assert sink.recipients == 23
+  assert sorted(sent) == sorted(contact_email for contact_emails in contact_groups for contact_email in contact_emails)
+  assert failed == []
+
+# Recipients refused for good go to on_failed with the server's code and are not retried
+def test_send_campaign_async_reports_permanent_refusals():
+  contact_groups = [[f"u{i}@example.com"] for i in range(5)]
+  sink, sent, failed = send_through_sink(make_jobs(contact_groups), {"error_rate": 1.0, "error_code": 550})
+  assert sent == []
+  assert sorted(failed) == sorted((contact_emails[0], 550) for contact_emails in contact_groups)
+  assert sink.rejected == 5
+
+# Jobs can also come from an async iterator, as the domain scheduler hands them out
+def test_send_campaign_async_accepts_async_jobs():
+  async def paced(jobs):
+    for job in jobs:
+      await asyncio.sleep(0)
+      yield job
+
+  sink, sent, failed = send_through_sink(paced(make_jobs([[f"u{i}@example.com"] for i in range(4)])))
+  assert sink.messages == 4
+  assert len(sent) == 4
+
+# Minimal server that greets, answers EHLO with AUTH PLAIN and replies to AUTH with the given line
+async def auth_server(auth_reply):
+  async def handle(reader, writer):
+    writer.write(b"220 test\r\n")
+    while line := await reader.readline():
+      if line.upper().startswith(b"EHLO"): writer.write(b"250-test\r\n250 AUTH PLAIN\r\n")
+      elif line.upper().startswith(b"AUTH"): writer.write(auth_reply)
+      else: writer.write(b"221 Bye\r\n")
+      await writer.drain()
+    writer.close()
+
+  return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+@pytest.mark.parametrize("auth_reply", [b"503 Already authenticated\r\n", b"535 Authentication failed\r\n"])
+# Only 235 counts as logged in: anything else to AUTH PLAIN is an authentication error
+def test_auth_plain_accepts_only_235(auth_reply):
+  async def main():
+    server = await auth_server(auth_reply)
+    try:
+      with pytest.raises(smtplib.SMTPAuthenticationError):
+        await app.open_smtp_connection_async(sink_settings(server.sockets[0].getsockname()[1]))
+    finally:
+      server.close()
+      await server.wait_closed()
+
+  asyncio.run(main())
+
+# A 235 reply logs in
+def test_auth_plain_logs_in_on_235():
+  async def main():
+    server = await auth_server(b"235 OK\r\n")
+    try:
+      connection = await app.open_smtp_connection_async(sink_settings(server.sockets[0].getsockname()[1]))
+      await app.close_smtp_connection_async(connection)
+    finally:
+      server.close()
+      await server.wait_closed()
+
+  asyncio.run(main())
+
+# Writer stand-in that logs what is written and when the sender waits for it to drain
+class RecordingWriter:
+  def __init__(self):
+    self.log = []
+
+  def write(self, data):
+    self.log.append(data)
+
+  async def drain(self):
+    self.log.append("drain")
+
+@pytest.mark.parametrize("pipelining", [False, True])
+# The pipelined MAIL/RCPT batch and every chunk of the message are drained before the reply to them is awaited
+def test_send_message_async_drains_writes(tmp_path, pipelining):
+  (tmp_path / "report.pdf").write_bytes(bytes(range(256)) * 40)
+  message = app.MessageFactory().build("a@sender.com", "u1@example.com", "Hello", "Hi\n", "plain", (app.load_attachment(str(tmp_path / "report.pdf")),))
+
+  async def main():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"250 OK\r\n250 OK\r\n354 Go ahead\r\n250 OK\r\n")
+    writer = RecordingWriter()
+    assert await app.send_message_async((reader, writer, b"test\nPIPELINING"), "a@sender.com", ["u1@example.com"], message, pipelining) == {}
+    return writer.log
+
+  log = asyncio.run(main())
+  data = log.index(b"DATA\r\n")
+  assert log[data + 1:] == [entry for chunk in (*message, b".\r\n") for entry in (chunk, "drain")]
+  if pipelining: assert log[:2] == [b"MAIL FROM:<a@sender.com>\r\nRCPT TO:<u1@example.com>\r\n", "drain"]
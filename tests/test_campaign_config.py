@@ -0,0 +1,57 @@
+import copy
+import pickle
+import types
+
+import pytest
+
+import app
+
+SETTINGS = {
+  "smtp": {"username": "u", "passkey": "p", "smtp_server": "127.0.0.1", "smtp_port": 25},
+  "emails": {"ids": ["alice@sender.com", "bob@sender.com"], "subjects": ["S1", "S2"], "writeups": ["writeups/intro.txt", "writeups/follow-up.txt"], "isfromfile": [True, True]},
+  "csv": {"titles": ["Email"], "placeholders": ["email"], "output_folder": "output", "segregate_by_writeups": True, "segregate_by_ids": True},
+}
+
+# The settings above with some [emails]/[csv] values replaced
+def settings(emails=None, csv=None):
+  settings_toml = copy.deepcopy(SETTINGS)
+  settings_toml["emails"].update(emails or {})
+  settings_toml["csv"].update(csv or {})
+  return settings_toml
+
+# Distinct write-up and sender ID names each get their own output file
+def test_distinct_output_names_are_accepted():
+  config = app.campaign_config(settings())
+  assert config.writeup_names == ("intro", "follow-up")
+  assert config.id_names == ("alice", "bob")
+
+@pytest.mark.parametrize("emails", [
+  {"writeups": ["writeups/failed.txt", "writeups/follow-up.txt"]},
+  {"writeups": ["writeups/Filtered.txt", "writeups/follow-up.txt"]},
+  {"ids": ["rejected@sender.com", "bob@sender.com"]},
+  {"writeups": ["writeups/alice.txt", "writeups/follow-up.txt"]},
+  {"writeups": ["a/intro.txt", "b/intro.txt"]},
+  {"ids": ["alice@sender.com", "Alice@other.com"]},
+])
+# A write-up or sender ID whose output-<name>.csv is already another one's (or a built-in output) is refused
+def test_colliding_output_names_are_refused(emails):
+  with pytest.raises(ValueError, match="output-"):
+    app.campaign_config(settings(emails))
+
+# Names only matter for the outputs that are actually segregated, and repeating the same write-up is not a clash
+def test_unsegregated_or_repeated_names_are_accepted():
+  app.campaign_config(settings({"writeups": ["writeups/failed.txt", "writeups/follow-up.txt"]}, {"segregate_by_writeups": False}))
+  app.campaign_config(settings({"ids": ["rejected@sender.com", "bob@sender.com"]}, {"segregate_by_ids": False}))
+  app.campaign_config(settings({"writeups": ["writeups/intro.txt", "writeups/intro.txt"]}))
+
+# Configs survive pickling (as they do on their way to spawned shard workers) with their mappings still read-only
+def test_config_pickles_with_read_only_mappings():
+  settings_toml = settings()
+  settings_toml["accounts"] = {"bob@sender.com": {"username": "bob"}}
+  settings_toml["domains"] = {"Gmail.com": {"domain_max_rate": 2}}
+  config = app.campaign_config(settings_toml)
+  for unpickled in (pickle.loads(pickle.dumps(config)), pickle.loads(pickle.dumps(app.shard_campaign_config(config, 0, 2)))):
+    assert isinstance(unpickled.accounts["bob@sender.com"], types.MappingProxyType)
+    assert isinstance(unpickled.domains["gmail.com"], types.MappingProxyType)
+    assert isinstance(unpickled.writeup_index, types.MappingProxyType)
+  assert pickle.loads(pickle.dumps(config)) == config
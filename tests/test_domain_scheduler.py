@@ -0,0 +1,72 @@
+import math
+import time
+
+import app
+
+# One single-recipient job per address, all from sender ID 0
+def make_jobs(contact_emails):
+  return [("a@sender.com", [contact_email], b"message", [([contact_email], 0, 0, 0.0)]) for contact_email in contact_emails]
+
+# A DomainScheduler over jobs for the given addresses
+def scheduler(contact_emails, smtp_settings=None, domains=None, senders=None):
+  return app.DomainScheduler(make_jobs(contact_emails), smtp_settings or {}, domains or {}, len(contact_emails), lambda: 0, senders)
+
+# Domains of the jobs take() hands out until it returns a wait or runs out
+def take_domains(domain_scheduler):
+  domains = []
+  while isinstance(job := domain_scheduler.take(), tuple):
+    domains.append(app.email_domain(job[1][0]))
+  return domains, job
+
+# Jobs are handed out round-robin across domains, each domain's in file order
+def test_domains_are_interleaved():
+  domain_scheduler = scheduler(["a1@a.com", "a2@a.com", "a3@a.com", "b1@b.com", "b2@b.com", "c1@c.com"])
+  assert take_domains(domain_scheduler) == (["a.com", "b.com", "c.com", "a.com", "b.com", "a.com"], None)
+
+# A domain at its domain_concurrency (or its [domains] override) waits for a recipient to finish, while others keep going
+def test_domain_concurrency_is_respected():
+  contact_emails = [f"u{n}@gmail.com" for n in range(4)] + [f"u{n}@yahoo.com" for n in range(3)]
+  domain_scheduler = scheduler(contact_emails, {"domain_concurrency": 2}, {"yahoo.com": {"domain_concurrency": 1}})
+  domains, wait = take_domains(domain_scheduler)
+  assert domains == ["gmail.com", "yahoo.com", "gmail.com"]
+  assert wait == math.inf
+  domain_scheduler.finished("u0@yahoo.com")
+  assert take_domains(domain_scheduler) == (["yahoo.com"], math.inf)
+  domain_scheduler.finished("u0@gmail.com")
+  domain_scheduler.finished("u1@gmail.com")
+  assert take_domains(domain_scheduler) == (["gmail.com", "gmail.com"], math.inf)
+
+# A domain at its domain_max_rate (or its [domains] override) is held back for the time its last release bought it
+def test_domain_max_rate_is_respected():
+  contact_emails = ["u0@fast.com", "u1@fast.com", "u0@slow.com", "u1@slow.com"]
+  domain_scheduler = scheduler(contact_emails, {"domain_max_rate": 20}, {"slow.com": {"domain_max_rate": 0.5}})
+  domains, wait = take_domains(domain_scheduler)
+  assert domains == ["fast.com", "slow.com"]
+  assert 0 < wait <= 0.05
+  domain_scheduler.finished("u0@fast.com")
+  domain_scheduler.finished("u0@slow.com")
+  time.sleep(0.06)
+  domains, wait = take_domains(domain_scheduler)
+  assert domains == ["fast.com"]
+  assert 1.5 < wait <= 2
+
+# Per-minute caps are charged as jobs are released, not when the lookahead reads them in
+def test_minute_caps_are_charged_on_release():
+  senders = app.SenderScheduler([{"minute_cap": 2}], deferred_minute_caps=True)
+  contact_emails = [f"u{n}@example{n}.com" for n in range(5)]
+  jobs = make_jobs(contact_emails)
+
+  # Picks each job's sender as run_campaign does while the scheduler reads ahead
+  def planned():
+    for job in jobs:
+      assert senders.choose(0) == 0
+      yield job
+
+  domain_scheduler = app.DomainScheduler(planned(), {"domain_lookahead": 10}, {}, len(jobs), lambda: 0, senders)
+  domain_scheduler.fill()
+  assert senders.sent_today == [5]
+  assert senders.sent_this_minute == [0]
+  domains, wait = take_domains(domain_scheduler)
+  assert domains == ["example0.com", "example1.com"]
+  assert senders.sent_this_minute == [2]
+  assert 59 < wait <= 60
@@ -0,0 +1,129 @@
+from email.generator import BytesGenerator
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import io
+
+import pytest
+
+import app
+
+BOUNDARY = "===============1234567890123456789=="
+OTHER_BOUNDARY = "===============9876543210987654321=="
+
+# A MessageFactory whose boundaries come from the given list instead of the random generator
+def pinned_factory(*boundaries):
+  factory = app.MessageFactory()
+  boundaries = iter(boundaries or (BOUNDARY,))
+  factory.make_boundary = lambda: next(boundaries)
+  return factory
+
+# What smtplib.send_message hands to sendmail for a message: BytesGenerator output with CRLF line endings
+def flatten(message):
+  buffer = io.BytesIO()
+  BytesGenerator(buffer).flatten(message, linesep="\r\n")
+  return buffer.getvalue()
+
+# The email package's version of the message MessageFactory builds from cached skeletons
+def reference(sending_email, contact_email, email_subject, email_writeup, boundary=BOUNDARY, subtype="plain"):
+  message = MIMEMultipart("alternative", boundary=boundary)
+  message['Subject'] = email_subject
+  message['From'] = sending_email
+  message['To'] = contact_email
+  message.attach(MIMEText(email_writeup, subtype))
+  return flatten(message)
+
+@pytest.mark.parametrize("email_writeup", [
+  "Hello Ann,\nthis is a plain ASCII write-up.\n",
+  "no trailing newline",
+  "",
+  "Grüße aus Köln ✓\nzweite Zeile\n",
+  "From here on\nnot From the start\nFrom the top\n",
+  "From Köln mit Grüßen\n",
+  "windows\r\nold mac\rmixed\nendings\r\n\r\n",
+  "trailing carriage return\r",
+  ".dot at the start\n..two dots\n.\n",
+  "x" * 2000 + "\n" + "y" * 77,
+])
+# Bodies, ASCII or not, come out exactly as MIMEText would encode them
+def test_body_matches_email_package(email_writeup):
+  factory = pinned_factory()
+  assert factory.build("a@sender.com", "ann@example.com", "Hello", email_writeup) == reference("a@sender.com", "ann@example.com", "Hello", email_writeup)
+
+@pytest.mark.parametrize("email_subject", [
+  "Hello",
+  "",
+  "A very long subject line that goes on " * 6,
+  "Grüße aus Köln",
+  "Ünïcödé " * 20,
+  "Subject with \"quotes\", commas; and: colons",
+])
+# Subjects are folded and encoded the way the email package does it
+def test_subject_matches_email_package(email_subject):
+  factory = pinned_factory()
+  assert factory.build("a@sender.com", "ann@example.com", email_subject, "Hi\n") == reference("a@sender.com", "ann@example.com", email_subject, "Hi\n")
+
+# Long recipient addresses are folded the same way too
+def test_long_to_address_matches_email_package():
+  contact_email = "a" * 60 + "@" + "sub." * 15 + "example.com"
+  factory = pinned_factory()
+  assert factory.build("a@sender.com", contact_email, "Hello", "Hi\n") == reference("a@sender.com", contact_email, "Hello", "Hi\n")
+
+# HTML write-ups get a text/html part
+def test_html_matches_email_package():
+  email_writeup = "<p>Hello <b>Ann</b></p>\n"
+  factory = pinned_factory()
+  assert factory.build("a@sender.com", "ann@example.com", "Hello", email_writeup, "html") == reference("a@sender.com", "ann@example.com", "Hello", email_writeup, subtype="html")
+
+# The cached skeleton is reused for every recipient of the same subject and sender, with only To changing
+def test_skeleton_is_reused_per_subject_and_sender():
+  factory = pinned_factory(BOUNDARY, OTHER_BOUNDARY)
+  for contact_email in ("ann@example.com", "bob@example.org"):
+    assert factory.build("a@sender.com", contact_email, "Hello", "Hi\n") == reference("a@sender.com", contact_email, "Hello", "Hi\n")
+  assert factory.build("b@sender.com", "ann@example.com", "Hello", "Hi\n") == reference("b@sender.com", "ann@example.com", "Hello", "Hi\n", OTHER_BOUNDARY)
+
+# A body containing the cached boundary gets a fresh one for that message only
+def test_boundary_collision_picks_a_new_boundary():
+  factory = pinned_factory(BOUNDARY, OTHER_BOUNDARY)
+  email_writeup = "quoting --" + BOUNDARY + "\n"
+  assert factory.build("a@sender.com", "ann@example.com", "Hello", email_writeup) == reference("a@sender.com", "ann@example.com", "Hello", email_writeup, OTHER_BOUNDARY)
+  assert factory.build("a@sender.com", "bob@example.com", "Hello", "Hi\n") == reference("a@sender.com", "bob@example.com", "Hello", "Hi\n")
+
+# Addresses that would need SMTPUTF8 are rejected by validation, and as sender IDs when the settings are loaded
+def test_non_ascii_addresses_are_rejected():
+  assert app.contact_problem(["jürgen@example.de"], 1, 0) == "invalid email"
+  settings_toml = {
+    "smtp": {"username": "u", "passkey": "p", "smtp_server": "127.0.0.1", "smtp_port": 25},
+    "emails": {"ids": ["jürgen@sender.de"], "subjects": ["Hello"], "writeups": ["intro.txt"], "isfromfile": [True]},
+    "csv": {"titles": ["Email"], "placeholders": ["email"], "output_folder": "output", "segregate_by_writeups": False, "segregate_by_ids": False},
+  }
+  with pytest.raises(ValueError, match="only ASCII"):
+    app.campaign_config(settings_toml)
+
+# The email package's version of a message with attachments and inline images, its boundaries set to the given ones
+def reference_with_attachments(factory, email_writeup, attachments, inline):
+  message = MIMEMultipart("mixed" if attachments else "related" if inline else "alternative", boundary=BOUNDARY)
+  message['Subject'] = "Hello"
+  message['From'] = "a@sender.com"
+  message['To'] = "ann@example.com"
+  related = MIMEMultipart("related", boundary="related_" + BOUNDARY) if attachments and inline else message
+  related.attach(MIMEText(email_writeup, "html"))
+  if related is not message: message.attach(related)
+  for attachment, is_inline in [(attachment, True) for attachment in inline] + [(attachment, False) for attachment in attachments]:
+    part = factory.attachment_part(attachment, is_inline)
+    part.set_payload(attachment.encoded.decode("ascii"))
+    (related if is_inline else message).attach(part)
+  return flatten(message)
+
+# Messages with attachments and inline images flatten to the same bytes as the email package's with the same boundaries
+def test_attachments_match_email_package(tmp_path):
+  (tmp_path / "report.pdf").write_bytes(bytes(range(256)) * 40)
+  (tmp_path / "logo.png").write_bytes(b"\x89PNG" + bytes(300))
+  (tmp_path / "empty.txt").write_bytes(b"")
+  attachments = (app.load_attachment(str(tmp_path / "report.pdf")), app.load_attachment(str(tmp_path / "empty.txt")))
+  inline = (app.load_attachment(str(tmp_path / "logo.png")),)
+  email_writeup = '<p>Hello <img src="cid:logo.png"></p>\n'
+  for attachment_parts in ((attachments, ()), ((), inline), (attachments, inline)):
+    factory = pinned_factory()
+    built = factory.build("a@sender.com", "ann@example.com", "Hello", email_writeup, "html", *attachment_parts)
+    assert isinstance(built, app.MessageChunks)
+    assert bytes(built) == reference_with_attachments(factory, email_writeup, *attachment_parts)
@@ -0,0 +1,33 @@
+import io
+import json
+import time
+
+import app
+
+# Parsed JSON lines a JSONProgress wrote
+def events(stream):
+  return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+# Progress lines keep coming every interval while nothing is being sent, and stop once the campaign has finished
+def test_json_progress_writes_while_waiting():
+  stream = io.StringIO()
+  progress = app.JSONProgress(0.05, stream)
+  stats = {"rows": 10, "sent": 0, "skipped": 0, "filtered": 0, "rejected": 0, "failed": 0, "senders": {}}
+  progress.sending(stats, "u0@example.com", "writeup.txt", "a@sender.com")
+  time.sleep(0.32)
+  stats["sent"] = 10
+  progress.finished(stats)
+  written = events(stream)
+  time.sleep(0.1)
+  assert events(stream) == written
+  assert [event["event"] for event in written] == ["progress"] * (len(written) - 1) + ["finished"]
+  assert 5 <= len(written) - 1 <= 8
+  assert written[0]["sent"] == 0 and written[-1]["sent"] == 10
+
+# Nothing is written before the first contact, and a progress that never started stops cleanly
+def test_json_progress_is_quiet_until_sending():
+  stream = io.StringIO()
+  progress = app.JSONProgress(0.01, stream)
+  time.sleep(0.05)
+  progress.stop()
+  assert stream.getvalue() == ""
@@ -0,0 +1,67 @@
+import csv
+import os
+import time
+
+import pytest
+
+import app
+from test_run_campaign import make_campaign, journaled
+
+# A job for the given recipients, its details numbered by position
+def make_job(contact_emails):
+  return ("a@sender.com", contact_emails, b"message", [([contact_email], 0, 0, 0.0) for contact_email in contact_emails])
+
+# Retries come out in the order they come due, ties in the order they were pushed, and none before its time
+def test_retry_queue_pops_due_jobs_in_order():
+  retries = app.RetryQueue()
+  retries.push(0.05, 1, "later")
+  retries.push(0, 2, "first")
+  retries.push(0, 1, "second")
+  assert len(retries) == 3
+  assert retries.pop_due() == (2, "first")
+  assert retries.pop_due() == (1, "second")
+  assert retries.pop_due() is None
+  assert 0 < retries.wait() <= 0.05
+  time.sleep(retries.wait())
+  assert retries.pop_due() == (1, "later")
+  assert retries.wait() is None
+
+# Within one batch, 4xx refusals (and dropped connections) go back on the retry queue as one job, and 5xx ones fail at once
+def test_settle_refusals_retries_4xx_and_fails_5xx():
+  retries, failed = app.RetryQueue(), []
+  job = make_job(["u0@example.com", "u1@example.com", "u2@example.com", "u3@example.com"])
+  refused = {"u0@example.com": (451, b"Try again"), "u1@example.com": (550, b"No such user"), "u2@example.com": (None, "Connection unexpectedly closed")}
+  assert app.settle_refusals(job, 0, refused, {"max_attempts": 3, "retry_backoff": 0}, retries, lambda details, code, reason: failed.append((details[0][0], code, reason)))
+  assert failed == [("u1@example.com", 550, "No such user")]
+  attempt, retry = retries.pop_due()
+  assert attempt == 1
+  assert retry[1] == ["u0@example.com", "u2@example.com"]
+  assert retry[3] == [job[3][0], job[3][2]]
+
+# On the last attempt, 4xx refusals are dead-lettered too, saying how many attempts were made
+def test_settle_refusals_gives_up_after_max_attempts():
+  retries, failed = app.RetryQueue(), []
+  refused = {"u0@example.com": (451, b"Try again")}
+  assert not app.settle_refusals(make_job(["u0@example.com"]), 2, refused, {"max_attempts": 3}, retries, lambda details, code, reason: failed.append((details[0][0], code, reason)))
+  assert failed == [("u0@example.com", 451, "Try again (gave up after 3 attempts)")]
+  assert len(retries) == 0
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("error_code, attempts", [(451, 3), (550, 1)])
+# With every recipient refused, 4xx ones are tried max_attempts times and 5xx ones once, then land in output-failed.csv
+# with the server's code, and in the journal as failed
+def test_refused_contacts_are_dead_lettered(tmp_path, engine, error_code, attempts):
+  sink = app.LocalSMTPSink(error_rate=1.0, error_code=error_code)
+  contacts_csv, settings_toml = make_campaign(str(tmp_path), 10, sink.port, {"engine": engine, "max_attempts": 3})
+  stats = app.run_campaign(app.campaign_config(settings_toml), contacts_csv, progress=app.BenchmarkProgress())
+  sink.shutdown()
+  assert stats["sent"] == sink.messages == 0
+  assert stats["failed"] == 10
+  assert sink.rejected == 10 * attempts
+  failed_file = open(os.path.join(settings_toml["csv"]["output_folder"], "output-failed.csv"), mode='r', encoding='utf-8', newline='')
+  rows = list(csv.DictReader(failed_file))
+  failed_file.close()
+  assert sorted(row["Email"] for row in rows) == sorted(f"user{n}@example{n % 5}.com" for n in range(10))
+  assert all(row["Error Code"] == str(error_code) for row in rows)
+  assert all(("gave up after 3 attempts" in row["Error"]) == (error_code < 500) for row in rows)
+  assert journaled(settings_toml["csv"]["output_folder"], "failed") == 10
@@ -0,0 +1,98 @@
+import asyncio
+import glob
+import gzip
+import os
+import smtplib
+import sqlite3
+import threading
+
+import pytest
+
+import app
+
+# Writes a contacts file and one write-up into folder and returns the contacts path and settings to send them to a local sink
+def make_campaign(folder, contacts, port, smtp=None, emails=None, csv=None):
+  writeup = os.path.join(folder, "writeup.txt")
+  writeup_file = open(writeup, mode='w', encoding='utf-8')
+  writeup_file.write("Hello {name}")
+  writeup_file.close()
+  contacts_csv = os.path.join(folder, "contacts.csv")
+  contacts_file = open(contacts_csv, mode='w', encoding='utf-8')
+  contacts_file.write("Email,Name\n" + "".join(f"user{n}@example{n % 5}.com,Name {n}\n" for n in range(contacts)))
+  contacts_file.close()
+  settings_toml = {
+    "smtp": {"username": "u", "passkey": "p", "smtp_server": "127.0.0.1", "smtp_port": port, "starttls": False, "connections": 2, "retry_backoff": 0.01, **(smtp or {})},
+    "emails": {"ids": ["a@sender.com"], "subjects": ["Hello"], "writeups": [writeup], "isfromfile": [True], **(emails or {})},
+    "csv": {"titles": ["Email", "Name"], "placeholders": ["email", "name"], "output_folder": os.path.join(folder, "output"), "segregate_by_writeups": False, "segregate_by_ids": False, **(csv or {})},
+  }
+  return contacts_csv, settings_toml
+
+# Journal rows with the given status
+def journaled(output_folder, status="sent"):
+  connection = sqlite3.connect(glob.glob(os.path.join(output_folder, "journal-*.sqlite3"))[0])
+  count = connection.execute("SELECT COUNT(*) FROM sends WHERE status = ?", (status,)).fetchone()[0]
+  connection.close()
+  return count
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+# When one login is refused, the other logins' connections finish what they are sending and stop before the journal is
+# closed, so every message the server received is journaled and no sending thread outlives the campaign
+def test_failed_login_stops_every_connection(tmp_path, monkeypatch, engine):
+  sink = app.LocalSMTPSink(latency=0.05)
+  contacts_csv, settings_toml = make_campaign(str(tmp_path), 60, sink.port, {"connections": 4, "engine": engine}, {"ids": ["a@sender.com", "b@sender.com"], "subjects": ["Hello", "Hello"], "isfromfile": [True, True]})
+  settings_toml["emails"]["writeups"] *= 2
+  settings_toml["accounts"] = {"b@sender.com": {"username": "refused"}}
+  open_smtp_connection, open_smtp_connection_async = app.open_smtp_connection, app.open_smtp_connection_async
+
+  def refusing(smtp_settings):
+    if smtp_settings["username"] == "refused": raise smtplib.SMTPAuthenticationError(535, b"Authentication failed")
+    return open_smtp_connection(smtp_settings)
+
+  async def refusing_async(smtp_settings):
+    if smtp_settings["username"] == "refused":
+      await asyncio.sleep(0.1)
+      raise smtplib.SMTPAuthenticationError(535, b"Authentication failed")
+    return await open_smtp_connection_async(smtp_settings)
+
+  monkeypatch.setattr(app, "open_smtp_connection", refusing)
+  monkeypatch.setattr(app, "open_smtp_connection_async", refusing_async)
+  threads = threading.active_count()
+  with pytest.raises(smtplib.SMTPAuthenticationError):
+    app.run_campaign(app.campaign_config(settings_toml), contacts_csv, progress=app.BenchmarkProgress())
+  assert threading.active_count() <= threads
+  assert journaled(settings_toml["csv"]["output_folder"]) == sink.messages
+
+# A compressed contacts file can't be cut into byte ranges, so with [smtp].processes it is sent by one process, with a notice
+def test_compressed_contacts_are_sent_in_one_process(tmp_path, capsys):
+  sink = app.LocalSMTPSink()
+  contacts_csv, settings_toml = make_campaign(str(tmp_path), 30, sink.port, {"processes": 2})
+  contacts_file = open(contacts_csv, mode='rb')
+  compressed_file = gzip.open(contacts_csv + ".gz", mode='wb')
+  compressed_file.write(contacts_file.read())
+  compressed_file.close()
+  contacts_file.close()
+  stats = app.run_campaign(app.campaign_config(settings_toml), contacts_csv + ".gz", progress=app.BenchmarkProgress())
+  sink.shutdown()
+  assert stats["sent"] == sink.messages == 30
+  assert "single process" in capsys.readouterr().err
+
+# A run cut short by its daily cap is resumed: rows the journal has as sent are skipped, the day's sends still count against
+# the cap, and the outputs are appended to without a second header
+def test_resume_skips_sent_rows_and_keeps_daily_caps(tmp_path):
+  sink = app.LocalSMTPSink()
+  contacts_csv, settings_toml = make_campaign(str(tmp_path), 30, sink.port, {"daily_cap": 10}, csv={"segregate_by_writeups": True})
+  stats = app.run_campaign(app.campaign_config(settings_toml), contacts_csv, progress=app.BenchmarkProgress())
+  assert (stats["sent"], stats["skipped"]) == (10, 0)
+  settings_toml["smtp"]["daily_cap"] = 25
+  stats = app.run_campaign(app.campaign_config(settings_toml), contacts_csv, resume=True, progress=app.BenchmarkProgress())
+  assert (stats["sent"], stats["skipped"]) == (15, 10)
+  stats = app.run_campaign(app.campaign_config(settings_toml), contacts_csv, resume=True, progress=app.BenchmarkProgress())
+  assert (stats["sent"], stats["skipped"]) == (0, 25)
+  sink.shutdown()
+  assert sink.messages == journaled(settings_toml["csv"]["output_folder"]) == 25
+  output_file = open(os.path.join(settings_toml["csv"]["output_folder"], "output-writeup.csv"), mode='r', encoding='utf-8', newline='')
+  lines = output_file.read().splitlines()
+  output_file.close()
+  assert lines[0].startswith("Email,Name")
+  assert len(lines) == 26
+  assert len(set(lines)) == 26
@@ -0,0 +1,75 @@
+import itertools
+
+import pytest
+
+import app
+
+# [smtp] settings for a sender ID logging in to a local sink
+def sink_settings(port, **extra):
+  return {"smtp_server": "127.0.0.1", "smtp_port": port, "username": "u", "passkey": "p", "starttls": False, "connections": 2, "retry_backoff": 0.01, **extra}
+
+# One job per recipient (or one batched job for several), built the way run_campaign builds them, as MessageChunks when
+# there are attachments
+def make_jobs(contact_groups, attachments=()):
+  factory = app.MessageFactory()
+  jobs = []
+  for contact_emails in contact_groups:
+    message = factory.build("a@sender.com", contact_emails[0] if len(contact_emails) == 1 else "undisclosed-recipients:;", "Hello", "Hi\n.dotted\n", "plain", attachments)
+    jobs.append(("a@sender.com", contact_emails, message, [([contact_email], 0, 0, 0.0) for contact_email in contact_emails]))
+  return jobs
+
+# Sends jobs through an SMTPPool to a LocalSMTPSink, returning the sink and the sent/failed addresses
+def send_through_pool(jobs, sink_options=None, **smtp_extra):
+  sink = app.LocalSMTPSink(**(sink_options or {}))
+  sent, failed = [], []
+  pool = app.SMTPPool(sink_settings(sink.port, **smtp_extra), 2, lambda details: sent.append(details[0][0]), lambda details, code, reason: failed.append((details[0][0], code, reason)))
+  for job in jobs:
+    pool.submit(job)
+  error = pool.close()
+  sink.shutdown()
+  assert error is None
+  return sink, sent, failed
+
+# Contact groups of 20 single recipients and one batch of three
+CONTACT_GROUPS = [[f"u{i}@example.com"] for i in range(20)] + [["b1@example.com", "b2@example.com", "b3@example.com"]]
+
+@pytest.mark.parametrize("pipelining", [False, True])
+@pytest.mark.parametrize("chunked", [False, True])
+# Every recipient reaches the sink once, single and batched jobs alike, with or without pipelining and attachments
+def test_pool_delivers_everything(tmp_path, pipelining, chunked):
+  attachments = ()
+  if chunked:
+    (tmp_path / "report.pdf").write_bytes(bytes(range(256)) * 40)
+    attachments = (app.load_attachment(str(tmp_path / "report.pdf")),)
+  jobs = make_jobs(CONTACT_GROUPS, attachments)
+  assert all(isinstance(job[2], app.MessageChunks) == chunked for job in jobs)
+  sink, sent, failed = send_through_pool(jobs, pipelining=pipelining)
+  assert sink.messages == 21
+  assert sink.recipients == 23
+  assert sorted(sent) == sorted(contact_email for contact_emails in CONTACT_GROUPS for contact_email in contact_emails)
+  assert failed == []
+
+@pytest.mark.parametrize("pipelining", [False, True])
+@pytest.mark.parametrize("chunked", [False, True])
+# A connection the server drops mid-session is reopened, and the job it was sending goes out on a retry
+def test_pool_reconnects_after_dropped_connection(tmp_path, monkeypatch, pipelining, chunked):
+  feed = app.LocalSMTPSession.feed
+  mails = itertools.count(1)
+
+  # The sink hangs up without a reply on the 5th and 12th MAIL FROM it gets
+  def dropping_feed(session, line):
+    if session.state == "command" and line[:4].upper() == b"MAIL" and next(mails) in (5, 12):
+      session.closed = True
+      return b""
+    return feed(session, line)
+
+  monkeypatch.setattr(app.LocalSMTPSession, "feed", dropping_feed)
+  attachments = ()
+  if chunked:
+    (tmp_path / "report.pdf").write_bytes(bytes(range(256)) * 40)
+    attachments = (app.load_attachment(str(tmp_path / "report.pdf")),)
+  sink, sent, failed = send_through_pool(make_jobs(CONTACT_GROUPS, attachments), pipelining=pipelining)
+  assert next(mails) > 12
+  assert sink.messages == 21
+  assert sorted(sent) == sorted(contact_email for contact_emails in CONTACT_GROUPS for contact_email in contact_emails)
+  assert failed == []
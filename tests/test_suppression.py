@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import app
+
+# Writes a suppression file of count addresses and returns its path
+def make_suppression_file(folder, count=1000):
+  path = os.path.join(folder, "suppression.txt")
+  suppression_file = open(path, mode='w', encoding='utf-8')
+  suppression_file.write("".join(f"X{n}@Ex.com\n" for n in range(count)))
+  suppression_file.close()
+  return path
+
+# Whether an address is on a loaded suppression list
+def suppressed(suppression_list, contact_email):
+  return app.email_fingerprint(app.normalise_email(contact_email)) in suppression_list
+
+# The list is built from the file, written to its .idx sidecar, and read back from the sidecar while the file is unchanged
+def test_sidecar_is_reused(tmp_path):
+  path = make_suppression_file(str(tmp_path))
+  built = app.load_suppression_list(path)
+  assert len(built) == 1000
+  assert os.path.exists(path + ".idx")
+  assert not os.path.exists(path + ".idx.tmp")
+  loaded = app.load_suppression_list(path)
+  assert loaded.fingerprints == built.fingerprints
+  assert suppressed(loaded, "x999@ex.com")
+  assert not suppressed(loaded, "x1000@ex.com")
+
+@pytest.mark.parametrize("keep", [8, 24 + 8 * 100, 24 + 8 * 100 + 3, 24 + 8 * 999 + 7])
+# A sidecar cut short anywhere (in the header, between entries or mid-entry) is rebuilt instead of loaded
+def test_truncated_sidecar_is_rebuilt(tmp_path, keep):
+  path = make_suppression_file(str(tmp_path))
+  app.load_suppression_list(path)
+  os.truncate(path + ".idx", keep)
+  loaded = app.load_suppression_list(path)
+  assert len(loaded) == 1000
+  assert suppressed(loaded, "x999@ex.com")
+  assert os.path.getsize(path + ".idx") == 24 + 8 * 1000
+
+# Extra bytes after the counted entries, or a changed suppression file, also mean a rebuild
+def test_stale_sidecar_is_rebuilt(tmp_path):
+  path = make_suppression_file(str(tmp_path))
+  app.load_suppression_list(path)
+  index_file = open(path + ".idx", mode='ab')
+  index_file.write(b"\0" * 8)
+  index_file.close()
+  assert len(app.load_suppression_list(path)) == 1000
+  make_suppression_file(str(tmp_path), 1500)
+  loaded = app.load_suppression_list(path)
+  assert len(loaded) == 1500
+  assert suppressed(loaded, "x1499@ex.com")
+
+# The duplicate filter's fingerprint table answers like a set as it grows, fingerprint 0 included, at under 25 bytes an address
+def test_fingerprint_set_matches_a_set():
+  fingerprints = [0, 1, 2 ** 64 - 1] + [app.email_fingerprint(f"x{n}@ex.com") for n in range(20000)]
+  seen = app.FingerprintSet()
+  assert [seen.add(fingerprint) for fingerprint in fingerprints] == [True, False, True] + [True] * 20000
+  assert len(seen) == 20002
+  assert all(fingerprint in seen for fingerprint in fingerprints)
+  assert not any(app.email_fingerprint(f"y{n}@ex.com") in seen for n in range(1000))
+  assert sorted(seen) == sorted(set(fingerprints) - {0})
+  assert seen.slots.itemsize * len(seen.slots) < 25 * len(seen)
+
+# A shard is told which of its addresses an earlier shard already has, but not about repeats inside itself
+def test_shard_plan_lists_earlier_duplicates():
+  plan = app.ShardPlan(90, 3)
+  for end, contact_email in enumerate(["a@ex.com", "b@ex.com", "a@ex.com", "c@ex.com", "B@ex.com", "c@ex.com", "d@ex.com", "a@ex.com", "e@ex.com"], 1):
+    plan.add(end * 10, contact_email)
+  plan.end(90)
+  assert [list(shard.duplicates) for shard in plan.shards] == [[], [app.email_fingerprint("b@ex.com")], [app.email_fingerprint("a@ex.com")]]
+  assert [shard.rows for shard in plan.shards] == [3, 3, 3]
+  assert len(plan.earlier_contacts) == 5
@@ -0,0 +1,69 @@
+import asyncio
+import smtplib
+
+import pytest
+
+import app
+
+# [smtp] settings for a sender ID logging in to a local sink
+def sink_settings(port, **extra):
+  return {"smtp_server": "127.0.0.1", "smtp_port": port, "username": "u", "passkey": "p", "starttls": False, "connections": 1, "retry_backoff": 0.01, **extra}
+
+# One batched job for the given recipients, built the way run_campaign builds them
+def batch_job(contact_emails):
+  message = app.MessageFactory().build("a@sender.com", "undisclosed-recipients:;", "Hello", "Hi\n")
+  return ("a@sender.com", contact_emails, message, [([contact_email], 0, 0, 0.0) for contact_email in contact_emails])
+
+@pytest.mark.parametrize("code, reply, throttled, reconnect", [
+  (421, b"4.7.0 Too many connections, closing", True, True),
+  (450, b"4.7.28 Our system has detected an unusual rate of unsolicited mail", True, False),
+  (452, b"4.7.0 Too many recipients this hour", True, False),
+  (451, b"4.7.1 Greylisted, please try again later", False, False),
+  (450, b"4.2.0 Greylisted", False, False),
+  (452, b"4.2.2 Mailbox full", False, False),
+  (550, b"5.7.1 Relaying denied", False, False),
+])
+# A recipient refusal throttles the login when it is a 421 or a rate-limit policy reply, and only a 421 means reconnecting
+def test_recipient_refusals_that_throttle(code, reply, throttled, reconnect):
+  error = smtplib.SMTPRecipientsRefused({"u1@example.com": (code, reply)})
+  assert app.is_throttled(error) == throttled
+  assert app.needs_reconnect(error) == reconnect
+
+# Recipients a server never got to (or had accepted) before closing with a 421 to RCPT are refused with that 421 too
+def test_recipients_after_a_421_share_its_refusal():
+  error = smtplib.SMTPRecipientsRefused({"u1@example.com": (421, b"closing")})
+  assert app.send_refusals(error, ["u0@example.com", "u1@example.com", "u2@example.com"]) == dict.fromkeys(["u0@example.com", "u1@example.com", "u2@example.com"], (421, b"closing"))
+
+@pytest.mark.parametrize("pipelining", [False, True])
+# A 421 to RCPT slows the login down and reconnects, and no recipient of the batch is counted as sent
+def test_pool_reconnects_after_421_to_rcpt(pipelining):
+  sink = app.LocalSMTPSink(error_rate=1.0, error_code=421)
+  sent, failed = [], []
+  pool = app.SMTPPool(sink_settings(sink.port, max_rate=1000, max_attempts=2, pipelining=pipelining), 1, lambda details: sent.append(details[0][0]), lambda details, code, reason: failed.append((details[0][0], code, reason)))
+  pool.submit(batch_job(["u1@example.com", "u2@example.com"]))
+  assert pool.close() is None
+  sink.shutdown()
+  assert sent == []
+  assert sorted(contact_email for contact_email, code, reason in failed) == ["u1@example.com", "u2@example.com"]
+  assert all(code == 421 and "gave up after 2 attempts" in reason for contact_email, code, reason in failed)
+  assert sink.rejected == 2
+  assert pool.limiter.rate < 1000
+
+@pytest.mark.parametrize("pipelining", [False, True])
+# The asyncio engine treats a 421 to RCPT the same way
+def test_async_reconnects_after_421_to_rcpt(pipelining):
+  sent, failed = [], []
+
+  async def main():
+    sink = app.AsyncLocalSMTPSink(error_rate=1.0, error_code=421)
+    await sink.start()
+    try:
+      await app.send_campaign_async([sink_settings(sink.port, max_attempts=2, pipelining=pipelining)], [batch_job(["u1@example.com", "u2@example.com"])], lambda details: sent.append(details[0][0]), lambda details, code, reason: failed.append((details[0][0], code)))
+    finally:
+      await sink.close()
+    return sink
+
+  sink = asyncio.run(main())
+  assert sent == []
+  assert sorted(failed) == [("u1@example.com", 421), ("u2@example.com", 421)]
+  assert sink.rejected == 2